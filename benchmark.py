@@ -0,0 +1,397 @@
+#!/usr/bin/env python2.7
+
+from decimal import Decimal
+from moneycalc.money import money
+from moneycalc.tax import TaxEffect
+import argparse
+import collections
+import datetime
+import json
+import moneycalc.account
+import moneycalc.incremental
+import moneycalc.loanbook
+import moneycalc.money
+import moneycalc.montecarlo
+import moneycalc.tax
+import moneycalc.time
+import moneycalc.timeline
+import moneycalc.util
+import operator
+import platform
+import re
+import resource
+import subprocess
+import sys
+import timeit
+
+def legacy_iter_merge_sort(iterables, key):
+    '''
+    The linear-scan iter_merge_sort which predates the heap-based merge.
+    Kept for comparison.
+    '''
+    iterators = list(map(iter, iterables))
+    cur_values = list(map(lambda iterator: next(iterator, None), iterators))
+    active_indexes = set(index for (index, value) in enumerate(cur_values) if value is not None)
+    while active_indexes:
+        index = min(active_indexes, key=lambda index: key(cur_values[index]))
+        assert cur_values[index] is not None
+        yield cur_values[index]
+        new_value = next(iterators[index], None)
+        cur_values[index] = new_value
+        if new_value is None:
+            active_indexes.remove(index)
+
+def make_merge_sort_streams(fan_in, total_items):
+    '''
+    Returns fan_in sorted streams of (day, source) pairs with about
+    total_items items in total, each recurring with a different period.
+    '''
+    items_per_stream = max(1, total_items // fan_in)
+    streams = []
+    for source in range(fan_in):
+        period = 1 + source % 31
+        streams.append([(source % 7 + period * i, source) for i in range(items_per_stream)])
+    return streams
+
+# Each benchmark is a function which does any setup, then returns a tuple of
+# a function to time and a dict of parameters describing the run.
+_benchmarks = collections.OrderedDict()
+
+def benchmark(name):
+    def register(func):
+        _benchmarks[name] = func
+        return func
+    return register
+
+def _register_scenario_benchmarks():
+    import strager_mortgage
+
+    def heloc(years):
+        # Without a long enough draw term, the HELOC stops at the start of
+        # its (unimplemented) repayment term.
+        return strager_mortgage.HELOCScenario(years=years, draw_years=years)
+
+    def fixed_rate_mortgage(years):
+        return strager_mortgage.FixedRateMortgageScenario(years=years)
+
+    for (scenario_name, scenario_factory) in [('HELOCScenario', heloc), ('FixedRateMortgageScenario', fixed_rate_mortgage)]:
+        for years in [30, 60, 100]:
+            def scenario_benchmark(scenario_factory=scenario_factory, years=years):
+                def run():
+                    result = scenario_factory(years).play()
+                    if result.error is not None:
+                        raise Exception(str(result.error))
+                return (run, {'years': years})
+            benchmark('scenario.{}.{}y'.format(scenario_name, years))(scenario_benchmark)
+
+        def compiled_scenario_benchmark(scenario_factory=scenario_factory):
+            spec = scenario_factory(30).spec()
+            def run():
+                result = strager_mortgage.SpecScenario(spec).play()
+                if result.error is not None:
+                    raise Exception(str(result.error))
+            return (run, {'years': 30})
+        benchmark('scenario.{}.30y.compiled'.format(scenario_name))(compiled_scenario_benchmark)
+
+    @benchmark('scenario.incremental_change')
+    def bench_incremental_change():
+        run = moneycalc.incremental.IncrementalRun(fixed_rate_mortgage(30))
+        # Overriding one month's expenses with their usual amount replays
+        # 2040 and converges on 2041-01-01.
+        return (lambda: run.change('expenses', money('1873.61'), start_date=datetime.date(2040, 3, 1), end_date=datetime.date(2040, 4, 1)), {'years': 30})
+
+    @benchmark('montecarlo.HELOCScenario.30y')
+    def bench_monte_carlo():
+        paths = 1000
+        model = moneycalc.montecarlo.MeanRevertingPrimeRateModel(
+            start_yearly_rate=Decimal('0.0425'),
+            long_term_yearly_rate=Decimal('0.05'),
+            reversion=Decimal('0.2'),
+            volatility=Decimal('0.005'),
+            start_year=2017,
+        )
+        spec = heloc(30).spec()
+        # One process, so the benchmark measures batching across paths, not
+        # parallelism.
+        return (lambda: moneycalc.montecarlo.simulate(spec, model, count=paths, seed=1, processes=1), {'paths': paths, 'years': 30})
+
+_register_scenario_benchmarks()
+
+def _register_merge_sort_benchmarks():
+    key = operator.itemgetter(0)
+    total_items = 20000
+    for fan_in in [2, 10, 100, 1000]:
+        implementations = [('heap', moneycalc.util.iter_merge_sort)]
+        if fan_in <= 100:
+            # The legacy merge takes seconds at higher fan-ins.
+            implementations.append(('legacy', legacy_iter_merge_sort))
+        for (implementation_name, merge) in implementations:
+            def merge_sort_benchmark(fan_in=fan_in, merge=merge):
+                streams = make_merge_sort_streams(fan_in=fan_in, total_items=total_items)
+                return (lambda: collections.deque(merge(streams, key=key), maxlen=0), {'fan_in': fan_in, 'items': sum(map(len, streams))})
+            benchmark('iter_merge_sort.{}.k{}'.format(implementation_name, fan_in))(merge_sort_benchmark)
+
+_register_merge_sort_benchmarks()
+
+@benchmark('line_of_credit.daily_accrual')
+def bench_line_of_credit_daily_accrual():
+    years = 15
+    start_date = datetime.date(2017, 1, 1)
+    draw_end_date = datetime.date(start_date.year + years, 1, 1)
+    interest_rate = moneycalc.account.VariableDailyInterestRate(prime_rate=moneycalc.account.YearlySteppingPrimeRate(
+        start_yearly_rate=Decimal('0.0425'),
+        start_year=start_date.year,
+        yearly_increase=Decimal('0.005'),
+    ))
+    def run():
+        timeline = moneycalc.timeline.Timeline()
+        account = moneycalc.account.LineOfCreditAccount(
+            name='HELOC',
+            interest_rate=interest_rate,
+            draw_term=moneycalc.time.Period(start_date, draw_end_date),
+            repayment_term=moneycalc.time.Period(draw_end_date, draw_end_date),
+        )
+        account.withdraw(timeline=timeline, date=start_date, amount=money('1000000.00'), description='Draw')
+        # A deposit every day forces the finance charge to accrue day by
+        # day.
+        date = start_date + datetime.timedelta(days=1)
+        one_day = datetime.timedelta(days=1)
+        amount = money('300.00')
+        while date < draw_end_date:
+            account.deposit(timeline=timeline, date=date, amount=amount, description='Payment')
+            date += one_day
+    return (run, {'years': years})
+
+def _bench_amortized_loan_minimum_deposit(follow_schedule):
+    years = 30
+    start_date = datetime.date(2017, 1, 1)
+    amount = money('975000.00')
+    interest_rate = moneycalc.account.FixedMonthlyInterestRate(yearly_rate=Decimal('0.04125'))
+    term = moneycalc.time.Period(start_date, datetime.date(start_date.year + years, 1, 1))
+    schedule = moneycalc.account.AmortizedMonthlyLoan(name='Mortgage', amount=amount, interest_rate=interest_rate, term=term).schedule()
+    def run():
+        timeline = moneycalc.timeline.Timeline()
+        loan = moneycalc.account.AmortizedMonthlyLoan(name='Mortgage', amount=amount, interest_rate=interest_rate, term=term)
+        if follow_schedule:
+            loan.follow_schedule(schedule)
+        date = start_date
+        for _ in range(years * 12):
+            loan.deposit(timeline=timeline, date=date, amount=loan.minimum_deposit(date=date), description='Payment')
+            date = moneycalc.time.add_month(date)
+    return (run, {'months': years * 12, 'follow_schedule': follow_schedule})
+
+@benchmark('amortized_loan.minimum_deposit')
+def bench_amortized_loan_minimum_deposit():
+    return _bench_amortized_loan_minimum_deposit(follow_schedule=False)
+
+@benchmark('amortized_loan.minimum_deposit.scheduled')
+def bench_amortized_loan_minimum_deposit_scheduled():
+    return _bench_amortized_loan_minimum_deposit(follow_schedule=True)
+
+@benchmark('loan_book.pay_minimum')
+def bench_loan_book_pay_minimum():
+    loans = 1000
+    years = 30
+    start_date = datetime.date(2017, 1, 1)
+    interest_rate = moneycalc.account.FixedMonthlyInterestRate(yearly_rate=Decimal('0.04125'))
+    def run():
+        timeline = moneycalc.timeline.Timeline()
+        book = moneycalc.loanbook.LoanBook(name='Book')
+        for i in range(loans):
+            # 100 distinct amounts and 12 distinct start dates.
+            loan_start_date = datetime.date(start_date.year, i % 12 + 1, 1)
+            term = moneycalc.time.Period(loan_start_date, datetime.date(loan_start_date.year + years, loan_start_date.month, 1))
+            book.add_loans(amount=money(100000 + 1000 * (i % 100)), interest_rate=interest_rate, term=term)
+        while book.next_payment_date is not None:
+            book.pay_minimum(timeline=timeline, date=book.next_payment_date, description='Payment')
+    return (run, {'loans': loans, 'months': years * 12})
+
+@benchmark('tax.tax_due')
+def bench_tax_due():
+    count = 200000
+    date = datetime.date(2017, 6, 1)
+    tax_effects = [TaxEffect.NONE, TaxEffect.CASH_INCOME, TaxEffect.CASH_WITHHELD, TaxEffect.DEDUCTIBLE]
+    events = [
+        moneycalc.timeline.Timeline.Event(date=date, account=None, amount=money(i % 5000) - money('0.37'), description='Event', tax_effect=tax_effects[i % len(tax_effects)])
+        for i in range(count)
+    ]
+    return (lambda: moneycalc.tax.tax_due(events, year=date.year), {'events': count})
+
+@benchmark('tax.income_tax_cents')
+def bench_income_tax_cents():
+    count = 200000
+    years = [2017 + i % 30 for i in range(count)]
+    incomes_cents = [(i * 7919) % 50000000 for i in range(count)]
+    return (lambda: moneycalc.tax.income_tax_cents(years, incomes_cents), {'points': count})
+
+def _bench_money(representation):
+    count = 100000
+    amounts = []
+    for i in range(count):
+        if i % 3 == 0:
+            amounts.append('{}.{:02}'.format(i, i % 100))
+        elif i % 3 == 1:
+            amounts.append(Decimal(i) / 7)
+        else:
+            amounts.append(i)
+    def run():
+        with moneycalc.money.using_money_representation(representation):
+            for amount in amounts:
+                money(amount)
+    return (run, {'amounts': count})
+
+@benchmark('money.decimal')
+def bench_money_decimal():
+    return _bench_money(moneycalc.money.MoneyRepresentation.DECIMAL)
+
+@benchmark('money.cents')
+def bench_money_cents():
+    return _bench_money(moneycalc.money.MoneyRepresentation.CENTS)
+
+def _max_rss_kb():
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        # macOS reports bytes, Linux kilobytes.
+        max_rss //= 1024
+    return max_rss
+
+def measure_memory(name):
+    '''
+    Runs a benchmark once and returns a dict of the process's peak resident
+    set size before and after running it, in kilobytes.
+
+    Peak RSS never goes down, so measure each benchmark in a fresh process.
+    '''
+    (run, _params) = _benchmarks[name]()
+    setup_kb = _max_rss_kb()
+    run()
+    return {'setup_peak_rss_kb': setup_kb, 'peak_rss_kb': _max_rss_kb()}
+
+def measure_memory_in_subprocess(name):
+    output = subprocess.check_output([sys.executable, __file__, '--measure-memory', name])
+    return json.loads(output.decode('utf-8'))
+
+def run_benchmarks(names, repeat, memory):
+    results = collections.OrderedDict()
+    for name in names:
+        (run, params) = _benchmarks[name]()
+        times = timeit.repeat(run, number=1, repeat=repeat)
+        seconds = min(times)
+        # How much the repeats disagree. With one repeat, the noise is
+        # unknown.
+        seconds_spread = max(times) - seconds
+        result = collections.OrderedDict([('seconds', seconds), ('seconds_spread', seconds_spread), ('params', params)])
+        if memory:
+            result.update(sorted(measure_memory_in_subprocess(name).items()))
+        results[name] = result
+        sys.stderr.write('{:<50} {:10.4f}s +{:.4f}s{}\n'.format(
+            name,
+            seconds,
+            seconds_spread,
+            ' {:8} KB peak'.format(result['peak_rss_kb']) if memory else '',
+        ))
+    return collections.OrderedDict([
+        ('python', platform.python_version()),
+        ('repeat', repeat),
+        ('benchmarks', results),
+    ])
+
+# Peak RSS is measured in pages and allocator arenas, so growth smaller than
+# this is not counted as a regression.
+_RSS_NOISE_KB = 1024
+
+def _comparable_measures(result):
+    '''
+    Returns a dict mapping measure names of a benchmark result to (value,
+    noise) pairs. Growth within the noise is not a regression.
+    '''
+    measures = {}
+    if 'seconds' in result:
+        measures['seconds'] = (result['seconds'], result.get('seconds_spread', 0))
+    if 'peak_rss_kb' in result and 'setup_peak_rss_kb' in result:
+        # Peak RSS includes the interpreter and the benchmark's setup, which
+        # would hide the run's own growth.
+        measures['run_rss_kb'] = (result['peak_rss_kb'] - result['setup_peak_rss_kb'], _RSS_NOISE_KB)
+    return measures
+
+def compare_results(baseline, current, threshold):
+    '''
+    Returns a list of (name, measure, baseline value, current value) tuples
+    for measures which grew by more than threshold (a fraction) from
+    baseline to current, plus the noise of either run (the spread of its
+    repeats, for times).
+    '''
+    regressions = []
+    for (name, result) in current['benchmarks'].items():
+        baseline_result = baseline['benchmarks'].get(name)
+        if baseline_result is None:
+            continue
+        baseline_measures = _comparable_measures(baseline_result)
+        for (measure, (value, noise)) in sorted(_comparable_measures(result).items()):
+            if measure not in baseline_measures:
+                continue
+            (baseline_value, baseline_noise) = baseline_measures[measure]
+            if value > baseline_value * (1 + threshold) + max(noise, baseline_noise):
+                regressions.append((name, measure, baseline_value, value))
+    return regressions
+
+def write_comparison(baseline, current, out):
+    if current.get('repeat', 1) < 2 or baseline.get('repeat', 1) < 2:
+        out.write('With one repeat, timing noise is unknown; use --repeat 3 or more.\n')
+    out.write('{:<50} {:>12} {:>12} {:>8} {:>8}\n'.format('benchmark', 'baseline', 'current', 'change', 'noise'))
+    for (name, result) in current['benchmarks'].items():
+        baseline_result = baseline['benchmarks'].get(name)
+        if baseline_result is None:
+            out.write('{:<50} {:>12} {:>12.4f}\n'.format(name, 'new', result['seconds']))
+            continue
+        noise = max(result.get('seconds_spread', 0), baseline_result.get('seconds_spread', 0))
+        out.write('{:<50} {:>12.4f} {:>12.4f} {:>+7.1f}% {:>7.1f}%\n'.format(
+            name,
+            baseline_result['seconds'],
+            result['seconds'],
+            (result['seconds'] / baseline_result['seconds'] - 1) * 100,
+            noise / baseline_result['seconds'] * 100,
+        ))
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmarks for moneycalc.')
+    parser.add_argument('--filter', default=None, help='only run benchmarks whose names match this regular expression')
+    parser.add_argument('--list', action='store_true', help='list benchmark names and exit')
+    parser.add_argument('--repeat', type=int, default=3, help='runs per benchmark; the fastest is reported, and the spread is used as the noise for --compare')
+    parser.add_argument('--no-memory', action='store_true', help='do not measure peak memory (which runs each benchmark again in a subprocess)')
+    parser.add_argument('--output', default=None, help='write JSON results to this file instead of stdout')
+    parser.add_argument('--compare', default=None, metavar='BASELINE', help='compare against JSON results from an earlier run and exit with status 1 on regressions')
+    parser.add_argument('--threshold', type=float, default=0.10, help='fractional slowdown or memory growth (beyond the noise) counted as a regression (default: %(default)s)')
+    parser.add_argument('--measure-memory', default=None, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.measure_memory is not None:
+        sys.stdout.write('{}\n'.format(json.dumps(measure_memory(args.measure_memory))))
+        return
+
+    names = [name for name in _benchmarks if args.filter is None or re.search(args.filter, name)]
+    if args.list:
+        for name in names:
+            sys.stdout.write('{}\n'.format(name))
+        return
+
+    current = run_benchmarks(names, repeat=args.repeat, memory=not args.no_memory)
+    text = json.dumps(current, indent=2, separators=(',', ': '))
+    if args.output is None:
+        sys.stdout.write('{}\n'.format(text))
+    else:
+        with open(args.output, 'w') as out:
+            out.write('{}\n'.format(text))
+
+    if args.compare is not None:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        write_comparison(baseline, current, out=sys.stderr)
+        regressions = compare_results(baseline, current, threshold=args.threshold)
+        for (name, measure, baseline_value, current_value) in regressions:
+            sys.stderr.write('REGRESSION: {} {}: {} -> {}\n'.format(name, measure, baseline_value, current_value))
+        if regressions:
+            sys.exit(1)
+
+if __name__ == '__main__':
+    main()
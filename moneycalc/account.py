@@ -1,18 +1,32 @@
 from decimal import Decimal
 from moneycalc.money import money
+from moneycalc.money import money_from_cents
+from moneycalc.money import money_to_cents
 from moneycalc.tax import TaxEffect
 from moneycalc.time import Period
 from moneycalc.time import add_month
 from moneycalc.time import sub_month
+from moneycalc.util import ChunkedArray
+from moneycalc.util import _INT64_TYPECODE
 import abc
+import array
+import bisect
+import copy
 import datetime
 import math
 import moneycalc.time
+import moneycalc.timeline
+import unittest
 
 class OverdraftError(ValueError):
     pass
 
 class PrimeRate(object):
+    def __deepcopy__(self, memo):
+        # Prime rates are immutable (apart from caches), so copies of
+        # accounts can share them.
+        return self
+
     @abc.abstractmethod
     def prime_rate_and_change_date(self, date):
         '''
@@ -22,6 +36,14 @@ class PrimeRate(object):
         '''
         raise NotImplementedError()
 
+    @abc.abstractmethod
+    def describe(self):
+        '''
+        Returns a tuple of plain values (strings, numbers, dates and
+        tuples) which is equal for prime rates with equal rates.
+        '''
+        raise NotImplementedError()
+
 class YearlySteppingPrimeRate(PrimeRate):
     def __init__(self, start_yearly_rate, start_year, yearly_increase):
         self.__start_yearly_rate = start_yearly_rate
@@ -35,34 +57,74 @@ class YearlySteppingPrimeRate(PrimeRate):
         rate = self.__start_yearly_rate + self.__yearly_increase * years_since_start
         return (rate, datetime.date(year=date.year + 1, month=1, day=1))
 
+    def describe(self):
+        return ('YearlySteppingPrimeRate', self.__start_yearly_rate, self.__start_year, self.__yearly_increase)
+
 class YearlySampledPrimeRate(PrimeRate):
     def __init__(self, base_prime_rate, sample_date):
         self.__base_prime_rate = base_prime_rate
         self.__sample_month = sample_date.month
         self.__sample_day = sample_date.day
 
+    def describe(self):
+        return ('YearlySampledPrimeRate', self.__base_prime_rate.describe(), self.__sample_month, self.__sample_day)
+
     def prime_rate_and_change_date(self, date):
         (prime_rate, _change_date) = self.__base_prime_rate.prime_rate_and_change_date(datetime.date(year=date.year, month=self.__sample_month, day=self.__sample_day))
-        return (prime_rate, datetime.datetime(year=date.year + 1, month=self.__sample_month, day=self.__sample_day))
+        return (prime_rate, datetime.date(year=date.year + 1, month=self.__sample_month, day=self.__sample_day))
 
 class InterestRate(object):
+    def __deepcopy__(self, memo):
+        # Interest rates are immutable (apart from caches), so copies of
+        # accounts can share them.
+        return self
+
     @abc.abstractmethod
     def period_interest_rate(self, period):
         raise NotImplementedError()
 
+    @abc.abstractmethod
+    def describe(self):
+        '''
+        Returns a tuple of plain values (strings, numbers, dates and
+        tuples) which is equal for interest rates with equal rates.
+        '''
+        raise NotImplementedError()
+
+    def daily_interest_rate_and_change_date(self, date):
+        '''
+        Returns a tuple of the interest rate for the day starting at the
+        given date and the next date the daily interest rate could change.
+
+        Every day from the given date up to (but not including) the
+        returned change date has the same interest rate.
+        '''
+        tomorrow = date + datetime.timedelta(days=1)
+        return (self.period_interest_rate(Period(date, tomorrow)), tomorrow)
+
 class FixedDailyInterstRate(InterestRate):
     def __init__(self, yearly_rate):
         self.__yearly_rate = yearly_rate
 
+    def describe(self):
+        return ('FixedDailyInterstRate', self.__yearly_rate)
+
     def period_interest_rate(self, period):
         if not period.is_day:
             raise NotImplementedError()
         return self.__yearly_rate / moneycalc.time.days_in_year(period.start_date.year)
 
+    def daily_interest_rate_and_change_date(self, date):
+        rate = self.__yearly_rate / moneycalc.time.days_in_year(date.year)
+        return (rate, datetime.date(year=date.year + 1, month=1, day=1))
+
 class FixedMonthlyInterestRate(InterestRate):
     def __init__(self, yearly_rate):
         self.__yearly_rate = yearly_rate
 
+    def describe(self):
+        return ('FixedMonthlyInterestRate', self.__yearly_rate)
+
     def period_interest_rate(self, period):
         if not period.is_month:
             raise NotImplementedError()
@@ -72,6 +134,9 @@ class VariableDailyInterestRate(InterestRate):
     def __init__(self, prime_rate):
         self.__prime_rate = prime_rate
 
+    def describe(self):
+        return ('VariableDailyInterestRate', self.__prime_rate.describe())
+
     def period_interest_rate(self, period):
         if not period.is_day:
             raise NotImplementedError()
@@ -80,10 +145,19 @@ class VariableDailyInterestRate(InterestRate):
             raise NotImplementedError()
         return prime_rate / moneycalc.time.days_in_year(period.start_date.year)
 
+    def daily_interest_rate_and_change_date(self, date):
+        (prime_rate, next_prime_rate_change) = self.__prime_rate.prime_rate_and_change_date(date)
+        next_year = datetime.date(year=date.year + 1, month=1, day=1)
+        rate = prime_rate / moneycalc.time.days_in_year(date.year)
+        return (rate, min(next_prime_rate_change, next_year))
+
 class VariableMonthlyInterestRate(InterestRate):
     def __init__(self, prime_rate):
         self.__prime_rate = prime_rate
 
+    def describe(self):
+        return ('VariableMonthlyInterestRate', self.__prime_rate.describe())
+
     def period_interest_rate(self, period):
         if not period.is_month:
             raise NotImplementedError()
@@ -98,6 +172,14 @@ class AdjustableRateMortgageInterestRate(InterestRate):
         self.__fixed_interest_rate = FixedMonthlyInterestRate(fixed_yearly_rate)
         self.__variable_interest_rate = VariableMonthlyInterestRate(prime_rate)
 
+    def describe(self):
+        return (
+            'AdjustableRateMortgageInterestRate',
+            (self.__fixed_period.start_date, self.__fixed_period.end_date),
+            self.__fixed_interest_rate.describe(),
+            self.__variable_interest_rate.describe(),
+        )
+
     def period_interest_rate(self, period):
         if period.intersects(self.__fixed_period):
             if period not in self.__fixed_period:
@@ -108,13 +190,306 @@ class AdjustableRateMortgageInterestRate(InterestRate):
         assert period.start_date >= self.__fixed_period.end_date
         return self.__variable_interest_rate.period_interest_rate(period)
 
+class BalanceHistory(object):
+    '''
+    An append-only record of an account's balance over time.
+
+    Each entry is a date ordinal and the balance in cents at the end of that
+    date. Before the first entry, the balance is 0.
+
+    Copies (with copy.deepcopy) share entries copy-on-write.
+    '''
+    def __init__(self):
+        self.__date_ordinals = ChunkedArray('i')
+        self.__balance_cents = ChunkedArray(_INT64_TYPECODE)
+        # The latest recorded date ordinal and balance, not yet appended to
+        # the arrays because the date's balance might change again.
+        self.__last_ordinal = None
+        self.__last_balance = None
+
+    def __deepcopy__(self, memo):
+        self.__append_last()
+        history = BalanceHistory.__new__(BalanceHistory)
+        history.__date_ordinals = self.__date_ordinals.fork()
+        history.__balance_cents = self.__balance_cents.fork()
+        history.__last_ordinal = None
+        history.__last_balance = None
+        return history
+
+    def __len__(self):
+        self.__append_last()
+        return len(self.__date_ordinals)
+
+    def record(self, date, balance):
+        '''
+        Records the balance at the end of the given date, which must not be
+        before the last recorded date.
+        '''
+        ordinal = date.toordinal()
+        last_ordinal = self.__last_ordinal
+        if ordinal != last_ordinal:
+            if last_ordinal is not None:
+                assert ordinal > last_ordinal
+                self.__append_last()
+            elif self.__date_ordinals:
+                appended_ordinal = self.__date_ordinals[-1]
+                assert ordinal >= appended_ordinal
+                if ordinal == appended_ordinal:
+                    # The date was appended (e.g. by balance_at) already.
+                    self.__balance_cents[-1] = money_to_cents(balance)
+                    return
+            self.__last_ordinal = ordinal
+        self.__last_balance = balance
+
+    def extend(self, other, start_date=None, end_date=None):
+        '''
+        Appends the entries of another BalanceHistory from start_date
+        (inclusive) to end_date (exclusive), which must be after this
+        history's entries.
+        '''
+        (date_ordinals, balance_cents) = other.arrays(start_date=start_date, end_date=end_date)
+        if not date_ordinals:
+            return
+        self.__append_last()
+        assert not self.__date_ordinals or date_ordinals[0] > self.__date_ordinals[-1]
+        for (ordinal, cents) in zip(date_ordinals, balance_cents):
+            self.__date_ordinals.append(ordinal)
+            self.__balance_cents.append(cents)
+
+    def __append_last(self):
+        if self.__last_ordinal is not None:
+            self.__date_ordinals.append(self.__last_ordinal)
+            self.__balance_cents.append(money_to_cents(self.__last_balance))
+            self.__last_ordinal = None
+            self.__last_balance = None
+
+    def balance_at(self, date):
+        '''
+        Returns the balance at the end of the given date.
+        '''
+        self.__append_last()
+        index = bisect.bisect_right(self.__date_ordinals, date.toordinal())
+        if index == 0:
+            return money(0)
+        return money_from_cents(self.__balance_cents[index - 1])
+
+    def __range(self, start_date, end_date):
+        self.__append_last()
+        date_ordinals = self.__date_ordinals
+        start = 0 if start_date is None else bisect.bisect_left(date_ordinals, start_date.toordinal())
+        end = len(date_ordinals) if end_date is None else bisect.bisect_left(date_ordinals, end_date.toordinal())
+        return (start, max(start, end))
+
+    def items(self, start_date=None, end_date=None):
+        '''
+        Yields the (date, balance) entries from start_date (inclusive) to
+        end_date (exclusive). Either can be None for no limit.
+        '''
+        (start, end) = self.__range(start_date, end_date)
+        date_ordinals = self.__date_ordinals
+        balance_cents = self.__balance_cents
+        for index in range(start, end):
+            yield (datetime.date.fromordinal(date_ordinals[index]), money_from_cents(balance_cents[index]))
+
+    def arrays(self, start_date=None, end_date=None):
+        '''
+        Returns a tuple of an array of date ordinals and an array of
+        balances in cents, for the entries like items.
+        '''
+        (start, end) = self.__range(start_date, end_date)
+        return (
+            _array_slice(self.__date_ordinals, start, end),
+            _array_slice(self.__balance_cents, start, end),
+        )
+
+    def to_numpy(self, start_date=None, end_date=None):
+        '''
+        Returns a tuple of a NumPy datetime64[D] array of dates and a NumPy
+        int64 array of balances in cents, for the entries like items.
+
+        Requires NumPy.
+        '''
+        import numpy
+        (date_ordinals, balance_cents) = self.arrays(start_date=start_date, end_date=end_date)
+        days_since_epoch = numpy.frombuffer(date_ordinals, dtype=numpy.int32).astype(numpy.int64) - _UNIX_EPOCH_ORDINAL
+        return (days_since_epoch.astype('datetime64[D]'), numpy.frombuffer(balance_cents, dtype=numpy.int64).copy())
+
+_UNIX_EPOCH_ORDINAL = datetime.date(1970, 1, 1).toordinal()
+
+def _array_slice(chunked_array, start, end):
+    '''
+    Returns the values of a ChunkedArray between start and end as an
+    array.array.
+    '''
+    result = array.array(chunked_array.typecode)
+    offset = 0
+    for chunk in chunked_array.chunks():
+        chunk_end = offset + len(chunk)
+        if chunk_end > start and offset < end:
+            result.extend(chunk[max(start - offset, 0):min(end, chunk_end) - offset])
+        offset = chunk_end
+    return result
+
 class Account(object):
     def __init__(self, name):
         self.__name = name
+        self.balance_history = BalanceHistory()
 
     def __str__(self):
         return self.__name
 
+    def record_balance(self, timeline, date):
+        '''
+        Records the balance after a change at the given date into
+        balance_history, unless the timeline streams its events (i.e. does
+        not keep them), so streamed scenarios use constant memory.
+        '''
+        if timeline.keeps_events:
+            self.balance_history.record(date, self.balance)
+
+    @abc.abstractmethod
+    def state_key(self):
+        '''
+        Returns a tuple of plain values which is equal for accounts which
+        behave the same way from now on.
+        '''
+        raise NotImplementedError()
+
+def amortized_monthly_payment(balance, interest_rate, months_remaining):
+    '''
+    Returns the monthly payment which pays off the given balance in the given
+    number of months, rounded like AmortizedMonthlyLoan.minimum_deposit.
+    '''
+    if months_remaining == 1:
+        interest = money(interest_rate * balance)
+        return money(interest + balance)
+    tmp = Decimal(math.pow(Decimal(1) + interest_rate, months_remaining))
+    return money(balance * (interest_rate * tmp) / (tmp - Decimal(1)))
+
+class AmortizationMode(object):
+    # Round every payment, interest and principal amount to the cent exactly
+    # like AmortizedMonthlyLoan.deposit.
+    EXACT = 'EXACT'
+    # Use unrounded floats. Faster, but drifts from EXACT by fractions of a
+    # cent per month.
+    FLOAT = 'FLOAT'
+
+class AmortizationSchedule(object):
+    '''
+    The remaining month-by-month payments of an AmortizedMonthlyLoan which
+    receives exactly its minimum payment every month.
+
+    Each column has one entry per payment. balances holds the balance after
+    each payment, and start_balance is the balance before the first payment.
+    In AmortizationMode.EXACT, amounts are money Decimals; in
+    AmortizationMode.FLOAT, amounts are array('d') floats.
+    '''
+    def __init__(self, mode, start_balance, dates, interest_rates, payments, interests, principals, balances):
+        self.mode = mode
+        self.start_balance = start_balance
+        self.dates = dates
+        self.interest_rates = interest_rates
+        self.payments = payments
+        self.interests = interests
+        self.principals = principals
+        self.balances = balances
+
+    def __len__(self):
+        return len(self.dates)
+
+    def __deepcopy__(self, memo):
+        # Schedules are never modified, so copies of loans can share them.
+        return self
+
+    @staticmethod
+    def compute(balance, interest_rate, first_payment_date, months_remaining, mode=AmortizationMode.EXACT):
+        dates = []
+        interest_rates = []
+        date = first_payment_date
+        for _ in range(months_remaining):
+            dates.append(date)
+            next_date = add_month(date)
+            interest_rates.append(interest_rate.period_interest_rate(Period(date, next_date)))
+            date = next_date
+        return AmortizationSchedule.from_interest_rates(balance=balance, dates=dates, interest_rates=interest_rates, mode=mode)
+
+    @staticmethod
+    def from_interest_rates(balance, dates, interest_rates, mode=AmortizationMode.EXACT):
+        '''
+        Like compute, but with each payment's date and period interest rate
+        given, so loans with the same rate and term can share them.
+        '''
+        if mode == AmortizationMode.EXACT:
+            return AmortizationSchedule.__compute_exact(balance, dates, interest_rates)
+        elif mode == AmortizationMode.FLOAT:
+            return AmortizationSchedule.__compute_float(balance, dates, interest_rates)
+        else:
+            raise ValueError('Unknown amortization mode: {}'.format(mode))
+
+    @staticmethod
+    def __compute_exact(balance, dates, interest_rates):
+        start_balance = balance
+        payments = []
+        interests = []
+        principals = []
+        balances = []
+        months_remaining = len(dates)
+        for interest_rate in interest_rates:
+            payment = amortized_monthly_payment(balance, interest_rate, months_remaining)
+            interest = money(interest_rate * balance)
+            principal = money(payment - interest)
+            balance = money(balance - principal)
+            payments.append(payment)
+            interests.append(interest)
+            principals.append(principal)
+            balances.append(balance)
+            months_remaining -= 1
+        return AmortizationSchedule(
+            mode=AmortizationMode.EXACT,
+            start_balance=start_balance,
+            dates=dates,
+            interest_rates=interest_rates,
+            payments=payments,
+            interests=interests,
+            principals=principals,
+            balances=balances,
+        )
+
+    @staticmethod
+    def __compute_float(balance, dates, interest_rates):
+        payments = array.array('d')
+        interests = array.array('d')
+        principals = array.array('d')
+        balances = array.array('d')
+        balance = float(balance)
+        start_balance = balance
+        months_remaining = len(dates)
+        for interest_rate in interest_rates:
+            interest_rate = float(interest_rate)
+            interest = interest_rate * balance
+            if months_remaining == 1:
+                payment = interest + balance
+            else:
+                tmp = (1.0 + interest_rate) ** months_remaining
+                payment = balance * (interest_rate * tmp) / (tmp - 1.0)
+            principal = payment - interest
+            balance -= principal
+            payments.append(payment)
+            interests.append(interest)
+            principals.append(principal)
+            balances.append(balance)
+            months_remaining -= 1
+        return AmortizationSchedule(
+            mode=AmortizationMode.FLOAT,
+            start_balance=start_balance,
+            dates=dates,
+            interest_rates=array.array('d', map(float, interest_rates)),
+            payments=payments,
+            interests=interests,
+            principals=principals,
+            balances=balances,
+        )
+
 class AmortizedMonthlyLoan(Account):
     def __init__(self, name, amount, interest_rate, term):
         super(AmortizedMonthlyLoan, self).__init__(name=name)
@@ -124,21 +499,79 @@ class AmortizedMonthlyLoan(Account):
         self.term = term
         self.__next_payment_due = term.start_date
         self.__maturity_date = sub_month(self.term.end_date)
+        self.__months_remaining = moneycalc.time.diff_months(self.term.end_date, self.term.start_date)
+        # An AmortizationSchedule computed by schedule() and the index of
+        # the next payment within it.
+        self.__schedule = None
+        self.__schedule_index = 0
+        self.balance_history.record(term.start_date, amount)
+
+    def schedule(self, mode=AmortizationMode.EXACT):
+        '''
+        Returns the AmortizationSchedule of the remaining payments, assuming
+        only minimum payments are made.
+
+        The EXACT schedule is remembered, and minimum_deposit uses its rows
+        while the loan stays on schedule.
+        '''
+        schedule = AmortizationSchedule.compute(
+            balance=self.balance,
+            interest_rate=self.interest_rate,
+            first_payment_date=self.__next_payment_due,
+            months_remaining=self.__months_remaining,
+            mode=mode,
+        )
+        if mode == AmortizationMode.EXACT:
+            self.__schedule = schedule
+            self.__schedule_index = 0
+        return schedule
+
+    def follow_schedule(self, schedule):
+        '''
+        Makes minimum_deposit use the rows of the given EXACT
+        AmortizationSchedule, which was computed by an identical loan's
+        schedule().
+        '''
+        if schedule.mode != AmortizationMode.EXACT:
+            raise ValueError('Only EXACT schedules can be followed')
+        if schedule.start_balance != self.balance or schedule.dates[:1] != [self.__next_payment_due]:
+            raise ValueError('Schedule does not start at the loan\'s next payment')
+        self.__schedule = schedule
+        self.__schedule_index = 0
 
     def minimum_deposit(self, date):
         if date > self.__maturity_date:
             raise NotImplementedError()
         if date != self.__next_payment_due:
             raise NotImplementedError()
+        scheduled_payment = self.__scheduled_payment()
+        if scheduled_payment is not None:
+            return scheduled_payment
         current_period = Period(date, add_month(date))
         interest_rate = self.interest_rate.period_interest_rate(current_period)
-        if date == self.__maturity_date:
-            interest = money(interest_rate * self.balance)
-            return money(interest + self.balance)
-        else:
-            months_remaining = moneycalc.time.diff_months(self.term.end_date, current_period.start_date)
-            tmp = Decimal(math.pow(Decimal(1) + interest_rate, months_remaining))
-            return money(self.balance * (interest_rate * tmp) / (tmp - Decimal(1)))
+        return amortized_monthly_payment(self.balance, interest_rate, self.__months_remaining)
+
+    def payoff_deposit(self, date):
+        '''
+        Returns the deposit at the given date which pays off the loan.
+        '''
+        if date != self.__next_payment_due:
+            raise NotImplementedError()
+        interest_rate = self.interest_rate.period_interest_rate(Period(date, add_month(date)))
+        return money(money(interest_rate * self.balance) + self.balance)
+
+    def __scheduled_payment(self):
+        schedule = self.__schedule
+        if schedule is None:
+            return None
+        index = self.__schedule_index
+        if index >= len(schedule):
+            return None
+        balance_before = schedule.balances[index - 1] if index > 0 else schedule.start_balance
+        if balance_before != self.balance:
+            # Off schedule (e.g. because of an extra payment).
+            return None
+        return schedule.payments[index]
 
     def deposit(self, timeline, date, amount, description):
         assert amount >= 0
@@ -157,7 +590,13 @@ class AmortizedMonthlyLoan(Account):
         timeline.add_interest_deposit(date=date, account=self, amount=interest, description='{} (interest ({:.5}%))'.format(description, interest_rate * Decimal(12) * Decimal(100)))
         timeline.add_principal_deposit(date=date, account=self, amount=principal, description='{} (principal)'.format(description))
         self.balance = money(self.balance - principal)
+        self.record_balance(timeline, date)
         self.__next_payment_due = current_period.end_date
+        self.__months_remaining -= 1
+        self.__schedule_index += 1
+
+    def state_key(self):
+        return (self.balance, self.__next_payment_due, self.__months_remaining, self.__schedule_index)
 
 class CheckingAccount(Account):
     def __init__(self, name):
@@ -169,12 +608,16 @@ class CheckingAccount(Account):
     def balance(self):
         return self.__balance
 
+    def state_key(self):
+        return (self.__balance,)
+
     def deposit(self, timeline, date, amount, description):
         assert amount >= 0
         assert amount == money(amount)
         assert self.__last_update is None or date >= self.__last_update
         timeline.add_generic_deposit(date=date, account=self, amount=amount, description=description)
         self.__balance = money(self.__balance + amount)
+        self.record_balance(timeline, date)
         self.__last_update = date
 
     def withdraw(self, timeline, date, amount, description, tax_effect=TaxEffect.NONE):
@@ -185,6 +628,7 @@ class CheckingAccount(Account):
             raise OverdraftError()
         timeline.add_withdrawl(date=date, account=self, amount=amount, description=description, tax_effect=tax_effect)
         self.__balance = money(self.__balance - amount)
+        self.record_balance(timeline, date)
         self.__last_update = date
 
 class LineOfCreditAccount(Account):
@@ -209,6 +653,9 @@ class LineOfCreditAccount(Account):
     def balance(self):
         return self.__balance
 
+    def state_key(self):
+        return (self.__balance, self.__period_finance_charge, self.__due_finance_charge, self.__last_update)
+
     def deposit(self, timeline, date, amount, description):
         assert amount >= 0
         assert amount == money(amount)
@@ -224,6 +671,7 @@ class LineOfCreditAccount(Account):
                 principal_amount -= finance_charge_payment
         timeline.add_generic_deposit(date=date, account=self, amount=principal_amount, description=description)
         self.__balance = money(self.__balance + principal_amount)
+        self.record_balance(timeline, date)
         self.__last_update = date
 
     def withdraw(self, timeline, date, amount, description, tax_effect=TaxEffect.NONE):
@@ -237,6 +685,7 @@ class LineOfCreditAccount(Account):
         self.__update_finance_charge(date)
         timeline.add_withdrawl(date=date, account=self, amount=amount, description=description, tax_effect=tax_effect)
         self.__balance = money(self.__balance - amount)
+        self.record_balance(timeline, date)
         self.__last_update = date
 
     def __update_finance_charge(self, date):
@@ -257,20 +706,177 @@ class LineOfCreditAccount(Account):
                     raise NotImplementedError()
                 self.__due_finance_charge = self.__period_finance_charge
                 self.__period_finance_charge = money(0)
-            tomorrow = now + datetime.timedelta(days=1)
+            # Accrue a segment of days at once. Within a segment, the
+            # balance and the daily interest rate are constant, so every day
+            # accrues the same rounded finance charge.
+            segment_end = min(date, datetime.date.fromordinal(moneycalc.time.ordinal_next_month_start(now.toordinal())))
             if self.__balance < money(0):
                 if now in self.__draw_term:
-                    interest_rate = self.__interest_rate.period_interest_rate(Period(now, tomorrow))
+                    (interest_rate, rate_change_date) = self.__interest_rate.daily_interest_rate_and_change_date(now)
+                    assert rate_change_date > now
+                    segment_end = min(segment_end, rate_change_date, self.__draw_term.end_date)
                     finance_charge = money(interest_rate * -self.__balance)
-                    self.__period_finance_charge += finance_charge
+                    self.__period_finance_charge += finance_charge * (segment_end - now).days
                 elif now in self.__repayment_term:
                     raise NotImplementedError()
                 else:
                     raise NotImplementedError()
-            self.__last_update = tomorrow
-            now = tomorrow
+            self.__last_update = segment_end
+            now = segment_end
         assert self.__last_update == date
 
 def transfer(timeline, date, from_account, to_account, amount, description):
     from_account.withdraw(timeline=timeline, date=date, amount=amount, description=description)
     to_account.deposit(timeline=timeline, date=date, amount=amount, description=description)
+
+class TestBalanceHistory(unittest.TestCase):
+    def make_history(self):
+        history = BalanceHistory()
+        history.record(datetime.date(2017, 1, 5), money('10.00'))
+        history.record(datetime.date(2017, 1, 5), money('12.00'))
+        history.record(datetime.date(2017, 2, 1), money('-3.50'))
+        history.record(datetime.date(2017, 3, 1), money('7.25'))
+        return history
+
+    def test_balance_at(self):
+        history = self.make_history()
+        self.assertEqual(len(history), 3)
+        self.assertEqual(history.balance_at(datetime.date(2017, 1, 4)), money(0))
+        self.assertEqual(history.balance_at(datetime.date(2017, 1, 5)), money('12.00'))
+        self.assertEqual(history.balance_at(datetime.date(2017, 1, 31)), money('12.00'))
+        self.assertEqual(history.balance_at(datetime.date(2017, 2, 1)), money('-3.50'))
+        self.assertEqual(history.balance_at(datetime.date(2030, 1, 1)), money('7.25'))
+
+    def test_ranges(self):
+        history = self.make_history()
+        self.assertEqual(list(history.items(start_date=datetime.date(2017, 1, 6), end_date=datetime.date(2017, 3, 1))), [
+            (datetime.date(2017, 2, 1), money('-3.50')),
+        ])
+        (date_ordinals, balance_cents) = history.arrays(start_date=datetime.date(2017, 1, 5))
+        self.assertEqual(list(date_ordinals), [datetime.date(2017, 1, 5).toordinal(), datetime.date(2017, 2, 1).toordinal(), datetime.date(2017, 3, 1).toordinal()])
+        self.assertEqual(list(balance_cents), [1200, -350, 725])
+        self.assertEqual(list(history.items(start_date=datetime.date(2018, 1, 1))), [])
+
+    def test_numpy_export(self):
+        try:
+            import numpy
+        except ImportError:
+            self.skipTest('NumPy is not installed')
+        (dates, balance_cents) = self.make_history().to_numpy(end_date=datetime.date(2017, 3, 1))
+        self.assertEqual(list(dates.astype(str)), ['2017-01-05', '2017-02-01'])
+        self.assertEqual(list(balance_cents), [1200, -350])
+
+    def test_copies_are_independent(self):
+        history = self.make_history()
+        history_copy = copy.deepcopy(history)
+        history.record(datetime.date(2017, 3, 1), money('1.00'))
+        history_copy.record(datetime.date(2017, 4, 1), money('2.00'))
+        self.assertEqual([balance for (_date, balance) in history.items()], [money('12.00'), money('-3.50'), money('1.00')])
+        self.assertEqual([balance for (_date, balance) in history_copy.items()], [money('12.00'), money('-3.50'), money('7.25'), money('2.00')])
+
+    def test_accounts_record_balances(self):
+        timeline = moneycalc.timeline.Timeline()
+        account = CheckingAccount(name='Checking')
+        account.deposit(timeline=timeline, date=datetime.date(2017, 1, 1), amount=money('100.00'), description='Deposit')
+        account.withdraw(timeline=timeline, date=datetime.date(2017, 1, 1), amount=money('30.00'), description='Withdrawal')
+        account.withdraw(timeline=timeline, date=datetime.date(2017, 1, 9), amount=money('20.00'), description='Withdrawal')
+        self.assertEqual(list(account.balance_history.items()), [
+            (datetime.date(2017, 1, 1), money('70.00')),
+            (datetime.date(2017, 1, 9), money('50.00')),
+        ])
+
+    def test_accounts_do_not_record_balances_of_streamed_timelines(self):
+        timeline = moneycalc.timeline.Timeline(keep_events=False)
+        account = CheckingAccount(name='Checking')
+        for day in range(1, 29):
+            account.deposit(timeline=timeline, date=datetime.date(2017, 1, day), amount=money('1.00'), description='Deposit')
+        self.assertEqual(account.balance, money('28.00'))
+        self.assertEqual(len(account.balance_history), 0)
+
+class TestLineOfCreditAccount(unittest.TestCase):
+    def test_finance_charge_matches_daily_accrual(self):
+        interest_rate = VariableDailyInterestRate(
+            prime_rate=YearlySteppingPrimeRate(
+                start_yearly_rate=Decimal('0.0425'),
+                start_year=2017,
+                yearly_increase=Decimal('0.005'),
+            )
+        )
+        account = LineOfCreditAccount(
+            name='HELOC',
+            interest_rate=interest_rate,
+            draw_term=Period(datetime.date(2017, 1, 1), datetime.date(2032, 1, 1)),
+            repayment_term=Period(datetime.date(2032, 1, 1), datetime.date(2047, 1, 1)),
+        )
+        timeline = moneycalc.timeline.Timeline()
+        account.withdraw(timeline=timeline, date=datetime.date(2017, 1, 1), amount=money('975000.00'), description='Purchase')
+        payment_date = datetime.date(2017, 2, 3)
+        while payment_date < datetime.date(2019, 1, 1):
+            account.deposit(timeline=timeline, date=payment_date, amount=money('7000.00'), description='Payment')
+            payment_date = add_month(payment_date)
+
+        # Replay the account one day at a time, rounding each day's finance
+        # charge, and compare against the interest actually paid.
+        expected_interest = []
+        balance = money('-975000.00')
+        period_finance_charge = money(0)
+        due_finance_charge = money(0)
+        now = datetime.date(2017, 1, 1)
+        while now < datetime.date(2019, 1, 1):
+            if now.day == 1:
+                due_finance_charge = period_finance_charge
+                period_finance_charge = money(0)
+            if now.day == 3 and now != datetime.date(2017, 1, 3):
+                expected_interest.append(due_finance_charge)
+                balance += money('7000.00') - due_finance_charge
+                due_finance_charge = money(0)
+            tomorrow = now + datetime.timedelta(days=1)
+            rate = interest_rate.period_interest_rate(Period(now, tomorrow))
+            period_finance_charge += money(rate * -balance)
+            now = tomorrow
+        interest = [event.amount for event in timeline if event.description == 'Payment (interest)']
+        self.assertEqual(interest, expected_interest)
+        self.assertEqual(account.balance, balance)
+
+class TestAmortizedMonthlyLoan(unittest.TestCase):
+    def make_loan(self):
+        return AmortizedMonthlyLoan(
+            name='Mortgage',
+            amount=money('975000.00'),
+            interest_rate=FixedMonthlyInterestRate(yearly_rate=Decimal('0.04125')),
+            term=Period(datetime.date(2017, 1, 1), datetime.date(2047, 1, 1)),
+        )
+
+    def pay_minimum(self, loan, months):
+        timeline = moneycalc.timeline.Timeline()
+        date = loan.term.start_date
+        for _ in range(months):
+            loan.deposit(timeline=timeline, date=date, amount=loan.minimum_deposit(date), description='Payment')
+            date = add_month(date)
+        return list(timeline)
+
+    def test_exact_schedule_matches_deposits(self):
+        loan = self.make_loan()
+        schedule = self.make_loan().schedule()
+        events = self.pay_minimum(loan, months=360)
+        self.assertEqual(len(schedule), 360)
+        self.assertEqual([e.amount for e in events[0::2]], schedule.interests)
+        self.assertEqual([e.amount for e in events[1::2]], schedule.principals)
+        self.assertEqual(schedule.balances[-1], money(0))
+        self.assertEqual(loan.balance, money(0))
+
+    def test_scheduled_loan_pays_like_unscheduled_loan(self):
+        loan = self.make_loan()
+        scheduled_loan = self.make_loan()
+        scheduled_loan.schedule()
+        self.assertEqual(
+            [str(e.amount) for e in self.pay_minimum(scheduled_loan, months=360)],
+            [str(e.amount) for e in self.pay_minimum(loan, months=360)])
+
+    def test_float_schedule_approximates_exact_schedule(self):
+        exact = self.make_loan().schedule(mode=AmortizationMode.EXACT)
+        approximate = self.make_loan().schedule(mode=AmortizationMode.FLOAT)
+        self.assertEqual(len(approximate), len(exact))
+        self.assertAlmostEqual(approximate.payments[0], float(exact.payments[0]), places=2)
+        self.assertAlmostEqual(sum(approximate.interests), float(sum(exact.interests)), delta=5.0)
+        self.assertAlmostEqual(approximate.balances[-1], 0.0, places=6)
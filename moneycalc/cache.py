@@ -0,0 +1,492 @@
+from __future__ import absolute_import
+
+from moneycalc.curve import CacheStatistics
+from moneycalc.money import money_from_cents
+from moneycalc.money import money_representation
+from moneycalc.money import money_to_cents
+from moneycalc.timeline import Timeline
+import array
+import contextlib
+import copy
+import datetime
+import errno
+import glob
+import hashlib
+import inspect
+import mmap
+import os
+import pickle
+import shutil
+import struct
+import sys
+import tempfile
+import time
+import unittest
+
+try:
+    import fcntl
+except ImportError:
+    # Windows.
+    fcntl = None
+
+# Bump whenever the file format changes.
+_FORMAT_VERSION = 2
+_MAGIC = b'moneycalc result\n'
+_HEADER_LENGTH = struct.Struct('<I')
+_RESULT_SUFFIX = '.result'
+_TEMPORARY_SUFFIX = '.tmp'
+# What reading a corrupt entry can raise. mmap raises ValueError for empty
+# files.
+_CORRUPT_ENTRY_ERRORS = (
+    AttributeError,
+    EOFError,
+    ImportError,
+    IndexError,
+    KeyError,
+    TypeError,
+    ValueError,
+    pickle.UnpicklingError,
+    struct.error,
+)
+# Temporary files older than this were left by writers which died.
+_STALE_TEMPORARY_SECONDS = 60 * 60
+
+_source_digests = {}
+
+def _source_digest(path):
+    digest = _source_digests.get(path)
+    if digest is None:
+        with open(path, 'rb') as f:
+            digest = hashlib.sha256(f.read()).hexdigest()
+        _source_digests[path] = digest
+    return digest
+
+def model_version(extra_paths=()):
+    '''
+    Returns a string which changes whenever the source code of moneycalc (or
+    of any of the given extra files) changes.
+    '''
+    directory = os.path.dirname(os.path.abspath(__file__))
+    paths = sorted(glob.glob(os.path.join(directory, '*.py'))) + sorted(os.path.abspath(path) for path in extra_paths)
+    hash = hashlib.sha256()
+    for path in paths:
+        hash.update(os.path.basename(path).encode('utf-8'))
+        hash.update(_source_digest(path).encode('ascii'))
+    return hash.hexdigest()
+
+def _array_from_bytes(typecode, data):
+    values = array.array(typecode)
+    if hasattr(values, 'frombytes'):
+        values.frombytes(data)
+    else:
+        values.fromstring(data)
+    return values
+
+def _array_to_bytes(values):
+    if hasattr(values, 'tobytes'):
+        return values.tobytes()
+    return values.tostring()
+
+def _encode_timeline(timeline):
+    '''
+    Returns a tuple of a picklable description of the given Timeline and its
+    columns as arrays.
+    '''
+    (accounts, descriptions, columns) = timeline.to_columns()
+    description = {
+        'account_names': [None if account is None else str(account) for account in accounts],
+        'descriptions': descriptions,
+        'event_count': len(timeline),
+        'total_interest_cents': money_to_cents(timeline.total_interest),
+    }
+    return (description, columns)
+
+def _decode_timeline(description, columns):
+    '''
+    Rebuilds a Timeline from the output of _encode_timeline. Accounts are
+    replaced by their names.
+    '''
+    return Timeline.from_columns(
+        accounts=description['account_names'],
+        descriptions=description['descriptions'],
+        columns=columns,
+        event_count=description['event_count'],
+        total_interest=money_from_cents(description['total_interest_cents']),
+    )
+
+def _write_entry(out, result):
+    '''
+    Writes a scenario result to a file.
+
+    The file holds _MAGIC, the length of a pickled header, the header, then
+    the timeline's columns as raw arrays, each aligned to 8 bytes so the file
+    can be memory-mapped. The header holds the result without its timeline
+    and the position of each column.
+    '''
+    result = copy.copy(result)
+    timeline = result.timeline
+    result.timeline = None
+    if timeline is None:
+        (timeline_description, columns) = (None, [])
+    else:
+        (timeline_description, columns) = _encode_timeline(timeline)
+
+    column_layout = []
+    offset = 0
+    for column in columns:
+        size = len(column) * column.itemsize
+        column_layout.append((column.typecode, offset, size))
+        offset += size + (-size % 8)
+    header = pickle.dumps({
+        'byteorder': sys.byteorder,
+        'columns': column_layout,
+        'result': result,
+        'timeline': timeline_description,
+    }, protocol=2)
+
+    out.write(_MAGIC)
+    out.write(_HEADER_LENGTH.pack(len(header)))
+    out.write(header)
+    position = len(_MAGIC) + _HEADER_LENGTH.size + len(header)
+    out.write(b'\0' * (-position % 8))
+    for column in columns:
+        data = _array_to_bytes(column)
+        out.write(data)
+        out.write(b'\0' * (-len(data) % 8))
+
+def _read_entry(data):
+    '''
+    Returns the scenario result in the given contents of a file written by
+    _write_entry.
+    '''
+    if data[:len(_MAGIC)] != _MAGIC:
+        raise ValueError('Not a result cache entry')
+    position = len(_MAGIC)
+    (header_length,) = _HEADER_LENGTH.unpack(data[position:position + _HEADER_LENGTH.size])
+    position += _HEADER_LENGTH.size
+    header = pickle.loads(data[position:position + header_length])
+    position += header_length
+    position += -position % 8
+
+    result = header['result']
+    if header['timeline'] is not None:
+        columns = []
+        for (typecode, offset, size) in header['columns']:
+            if position + offset + size > len(data):
+                raise ValueError('Truncated result cache entry')
+            column = _array_from_bytes(typecode, data[position + offset:position + offset + size])
+            if header['byteorder'] != sys.byteorder:
+                column.byteswap()
+            columns.append(column)
+        result.timeline = _decode_timeline(header['timeline'], columns)
+    return result
+
+class ResultCache(object):
+    '''
+    Stores scenario results on disk, keyed by a hash of everything which
+    affects them: the scenario's describe(), the money representation, and
+    the source code of moneycalc and of the scenario's module. Changing any
+    model code invalidates every entry.
+
+    Entries are files in directory. Several processes can share a directory:
+    entries are written to temporary files and atomically renamed into
+    place, and eviction holds an exclusive lock (where fcntl is available;
+    elsewhere, processes should not share a directory). When the entries
+    exceed max_bytes, the least recently used entries are deleted.
+
+    Timelines loaded from the cache have account names in place of
+    accounts.
+    '''
+    def __init__(self, directory, max_bytes=256 * 1024 * 1024):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.statistics = CacheStatistics()
+
+    def __getstate__(self):
+        # Statistics are per process.
+        return (self.directory, self.max_bytes)
+
+    def __setstate__(self, state):
+        (self.directory, self.max_bytes) = state
+        self.statistics = CacheStatistics()
+
+    def key(self, scenario, keep_timeline=False):
+        description = (
+            _FORMAT_VERSION,
+            sys.version_info[0],
+            model_version(extra_paths=[inspect.getsourcefile(type(scenario))]),
+            money_representation(),
+            keep_timeline,
+            scenario.describe(),
+        )
+        return hashlib.sha256(repr(description).encode('utf-8')).hexdigest()
+
+    def __path(self, key):
+        return os.path.join(self.directory, key + _RESULT_SUFFIX)
+
+    def get(self, key):
+        '''
+        Returns the scenario result stored with the given key, or None.
+        '''
+        path = self.__path(key)
+        try:
+            f = open(path, 'rb')
+        except (IOError, OSError) as e:
+            if e.errno != errno.ENOENT:
+                raise
+            self.statistics.misses += 1
+            return None
+        with f:
+            try:
+                data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                try:
+                    result = _read_entry(data)
+                finally:
+                    data.close()
+            except _CORRUPT_ENTRY_ERRORS:
+                # The entry will never be readable (e.g. it was truncated by
+                # a full disk), so treat it as a miss and evict it.
+                _unlink_if_exists(path)
+                self.statistics.misses += 1
+                self.statistics.evictions += 1
+                return None
+        try:
+            os.utime(path, None)
+        except OSError as e:
+            # The entry was evicted while we read it.
+            if e.errno != errno.ENOENT:
+                raise
+        self.statistics.hits += 1
+        return result
+
+    def put(self, key, result):
+        '''
+        Stores a scenario result with the given key, then evicts entries
+        until the cache fits in max_bytes.
+        '''
+        self.__ensure_directory()
+        (fd, temporary_path) = tempfile.mkstemp(suffix=_TEMPORARY_SUFFIX, dir=self.directory)
+        try:
+            with os.fdopen(fd, 'wb') as out:
+                _write_entry(out, result)
+            os.rename(temporary_path, self.__path(key))
+        except BaseException:
+            os.unlink(temporary_path)
+            raise
+        self.evict()
+
+    def play(self, scenario, keep_timeline=False):
+        '''
+        Returns the cached result of scenario.play(keep_timeline), playing
+        and caching it if needed.
+        '''
+        key = self.key(scenario, keep_timeline=keep_timeline)
+        result = self.get(key)
+        if result is None:
+            result = scenario.play(keep_timeline=keep_timeline)
+            self.put(key, result)
+        return result
+
+    def evict(self):
+        with self.__lock():
+            entries = []
+            total_size = 0
+            now = time.time()
+            for name in os.listdir(self.directory):
+                path = os.path.join(self.directory, name)
+                try:
+                    stat = os.stat(path)
+                except OSError as e:
+                    if e.errno != errno.ENOENT:
+                        raise
+                    continue
+                if name.endswith(_TEMPORARY_SUFFIX):
+                    if now - stat.st_mtime > _STALE_TEMPORARY_SECONDS:
+                        _unlink_if_exists(path)
+                elif name.endswith(_RESULT_SUFFIX):
+                    entries.append((stat.st_mtime, path, stat.st_size))
+                    total_size += stat.st_size
+            entries.sort()
+            for (_mtime, path, size) in entries:
+                if total_size <= self.max_bytes:
+                    break
+                _unlink_if_exists(path)
+                total_size -= size
+                self.statistics.evictions += 1
+
+    def clear(self):
+        with self.__lock():
+            for name in os.listdir(self.directory):
+                if name.endswith(_RESULT_SUFFIX):
+                    _unlink_if_exists(os.path.join(self.directory, name))
+
+    @contextlib.contextmanager
+    def __lock(self):
+        self.__ensure_directory()
+        if fcntl is None:
+            yield
+            return
+        fd = os.open(os.path.join(self.directory, 'lock'), os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            yield
+        finally:
+            os.close(fd)
+
+    def __ensure_directory(self):
+        try:
+            os.makedirs(self.directory)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+
+def _unlink_if_exists(path):
+    try:
+        os.unlink(path)
+    except OSError as e:
+        if e.errno != errno.ENOENT:
+            raise
+
+class CachedScenarioFactory(object):
+    '''
+    A scenario factory whose scenarios play through a ResultCache.
+    '''
+    def __init__(self, scenario_factory, cache):
+        self.scenario_factory = scenario_factory
+        self.cache = cache
+
+    @property
+    def __name__(self):
+        return self.scenario_factory.__name__
+
+    def __call__(self, *args, **kwargs):
+        return _CachedScenario(self.scenario_factory(*args, **kwargs), self.cache)
+
+class _CachedScenario(object):
+    def __init__(self, scenario, cache):
+        self.__scenario = scenario
+        self.__cache = cache
+
+    def __str__(self):
+        return str(self.__scenario)
+
+    def play(self, keep_timeline=False):
+        return self.__cache.play(self.__scenario, keep_timeline=keep_timeline)
+
+class _FakeResult(object):
+    def __init__(self, total_interest, timeline):
+        self.total_interest = total_interest
+        self.timeline = timeline
+
+class _FakeScenario(object):
+    def __init__(self, rate):
+        self.rate = rate
+        self.plays = 0
+
+    def describe(self):
+        return ('_FakeScenario', self.rate)
+
+    def play(self, keep_timeline=False):
+        self.plays += 1
+        timeline = Timeline()
+        account = 'Checking'
+        for month in range(1, 13):
+            date = datetime.date(2017, month, 1)
+            timeline.add_income(date=date, amount=money_from_cents(100000), description='Salary')
+            timeline.add_generic_deposit(date=date, account=account, amount=money_from_cents(80000), description='Salary (net)')
+            timeline.add_interest_deposit(date=date, account=account, amount=money_from_cents(-self.rate), description='Interest')
+        return _FakeResult(total_interest=timeline.total_interest, timeline=timeline if keep_timeline else None)
+
+class TestResultCache(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_results_round_trip(self):
+        cache = ResultCache(self.directory)
+        scenario = _FakeScenario(rate=1234)
+        expected = scenario.play(keep_timeline=True)
+        self.assertEqual(cache.play(scenario, keep_timeline=True).total_interest, expected.total_interest)
+        result = ResultCache(self.directory).play(scenario, keep_timeline=True)
+        self.assertEqual(scenario.plays, 2)
+        self.assertEqual(result.total_interest, expected.total_interest)
+        self.assertEqual(
+            [(event.date, event.account, event.amount, event.description, event.tax_effect) for event in result.timeline],
+            [(event.date, event.account, event.amount, event.description, event.tax_effect) for event in expected.timeline])
+        self.assertEqual(result.timeline.tax_ledger.year_totals(2017).deductible, expected.timeline.tax_ledger.year_totals(2017).deductible)
+
+    def test_hits_match_misses(self):
+        scenario = _FakeScenario(rate=1234)
+        miss = ResultCache(self.directory).play(scenario, keep_timeline=True)
+        hit = ResultCache(self.directory).play(scenario, keep_timeline=True)
+        self.assertEqual(scenario.plays, 1)
+        self.assertEqual(hit.timeline.total_interest, miss.timeline.total_interest)
+        self.assertEqual(hit.timeline.total_interest, money_from_cents(-12 * 1234))
+        self.assertEqual(len(hit.timeline), len(miss.timeline))
+        self.assertEqual(hit.timeline.tax_ledger.tax_due(2017), miss.timeline.tax_ledger.tax_due(2017))
+        self.assertEqual(
+            list(hit.timeline.account_summary(account='Checking', year=2017).description_totals.items()),
+            list(miss.timeline.account_summary(account='Checking', year=2017).description_totals.items()))
+        self.assertEqual(
+            [(event.date, event.amount) for event in hit.timeline.events_for_account('Checking', year=2017)],
+            [(event.date, event.amount) for event in miss.timeline.events_for_account('Checking', year=2017)])
+
+    def test_corrupt_entries_are_misses(self):
+        cache = ResultCache(self.directory)
+        scenario = _FakeScenario(rate=1234)
+        cache.play(scenario, keep_timeline=True)
+        key = cache.key(scenario, keep_timeline=True)
+        path = os.path.join(self.directory, key + _RESULT_SUFFIX)
+        size = os.path.getsize(path)
+        for length in [0, len(_MAGIC) + 2, size - 8]:
+            cache.play(scenario, keep_timeline=True)
+            with open(path, 'r+b') as f:
+                f.truncate(length)
+            self.assertIsNone(cache.get(key))
+            self.assertFalse(os.path.exists(path))
+        self.assertEqual(cache.statistics.evictions, 3)
+        self.assertEqual(cache.play(scenario, keep_timeline=True).total_interest, money_from_cents(-12 * 1234))
+
+    def test_keys_depend_on_scenario_description(self):
+        cache = ResultCache(self.directory)
+        self.assertEqual(cache.key(_FakeScenario(rate=1)), cache.key(_FakeScenario(rate=1)))
+        self.assertNotEqual(cache.key(_FakeScenario(rate=1)), cache.key(_FakeScenario(rate=2)))
+        self.assertNotEqual(cache.key(_FakeScenario(rate=1)), cache.key(_FakeScenario(rate=1), keep_timeline=True))
+        scenario = _FakeScenario(rate=1)
+        cache.play(scenario)
+        cache.play(_FakeScenario(rate=2))
+        cache.play(scenario)
+        self.assertEqual(scenario.plays, 1)
+        self.assertEqual((cache.statistics.hits, cache.statistics.misses), (1, 2))
+
+    def test_least_recently_used_entries_are_evicted(self):
+        cache = ResultCache(self.directory)
+        scenarios = [_FakeScenario(rate=rate) for rate in range(3)]
+        for (age, scenario) in enumerate(scenarios):
+            cache.play(scenario, keep_timeline=True)
+            path = os.path.join(self.directory, cache.key(scenario, keep_timeline=True) + _RESULT_SUFFIX)
+            os.utime(path, (1000 + age, 1000 + age))
+        entry_size = os.path.getsize(path)
+        cache.get(cache.key(scenarios[0], keep_timeline=True))
+        cache.max_bytes = entry_size * 2
+        cache.evict()
+        self.assertEqual(cache.statistics.evictions, 1)
+        self.assertIsNone(cache.get(cache.key(scenarios[1], keep_timeline=True)))
+        self.assertIsNotNone(cache.get(cache.key(scenarios[0], keep_timeline=True)))
+        self.assertIsNotNone(cache.get(cache.key(scenarios[2], keep_timeline=True)))
+
+    def test_caches_work_without_fcntl(self):
+        global fcntl
+        real_fcntl = fcntl
+        fcntl = None
+        try:
+            cache = ResultCache(self.directory)
+            scenario = _FakeScenario(rate=1)
+            cache.play(scenario, keep_timeline=True)
+            cache.evict()
+            cache.clear()
+            self.assertIsNone(cache.get(cache.key(scenario, keep_timeline=True)))
+        finally:
+            fcntl = real_fcntl
@@ -0,0 +1,246 @@
+from decimal import Decimal
+from moneycalc.account import FixedMonthlyInterestRate
+from moneycalc.account import InterestRate
+from moneycalc.account import PrimeRate
+from moneycalc.account import VariableDailyInterestRate
+from moneycalc.account import YearlySteppingPrimeRate
+from moneycalc.time import Period
+import bisect
+import collections
+import datetime
+import unittest
+
+class CacheStatistics(object):
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @property
+    def hit_rate(self):
+        lookups = self.hits + self.misses
+        if lookups == 0:
+            return None
+        return float(self.hits) / lookups
+
+    def __repr__(self):
+        return 'CacheStatistics(hits={}, misses={}, evictions={})'.format(self.hits, self.misses, self.evictions)
+
+class LRUCache(object):
+    '''
+    A dict-like cache which holds at most max_size items, evicting the least
+    recently used item first.
+    '''
+    def __init__(self, max_size):
+        if max_size < 1:
+            raise ValueError('max_size must be at least 1')
+        self.__max_size = max_size
+        self.__items = collections.OrderedDict()
+        self.statistics = CacheStatistics()
+
+    def __len__(self):
+        return len(self.__items)
+
+    def get(self, key, compute):
+        items = self.__items
+        try:
+            value = items.pop(key)
+        except KeyError:
+            self.statistics.misses += 1
+            value = compute()
+            if len(items) >= self.__max_size:
+                items.popitem(last=False)
+                self.statistics.evictions += 1
+        else:
+            self.statistics.hits += 1
+        items[key] = value
+        return value
+
+    def clear(self):
+        self.__items.clear()
+
+class PiecewiseConstantCurve(object):
+    '''
+    Caches a function of date ordinals which is constant over runs of
+    consecutive ordinals.
+
+    compute(ordinal) returns a tuple of the value at ordinal and the ordinal
+    at which the value could next change. The curve remembers each such
+    segment and answers lookups within it in O(log n) without calling
+    compute. At most max_segments segments are kept; the least recently used
+    segment is evicted first, so open-ended curves stay bounded.
+    '''
+    def __init__(self, compute, max_segments=4096):
+        if max_segments < 1:
+            raise ValueError('max_segments must be at least 1')
+        self.__compute = compute
+        self.__max_segments = max_segments
+        # Sorted start ordinals of the segments in __segments.
+        self.__starts = []
+        # Maps start ordinal to (end ordinal, value), least recently used
+        # first.
+        self.__segments = collections.OrderedDict()
+        self.statistics = CacheStatistics()
+
+    def __len__(self):
+        return len(self.__segments)
+
+    def value_and_end(self, ordinal):
+        '''
+        Returns a tuple of the value at ordinal and the ordinal at which the
+        value could next change.
+        '''
+        starts = self.__starts
+        index = bisect.bisect_right(starts, ordinal) - 1
+        if index >= 0:
+            start = starts[index]
+            (end, value) = self.__segments[start]
+            if ordinal < end:
+                # Mark the segment as most recently used.
+                self.__segments[start] = self.__segments.pop(start)
+                self.statistics.hits += 1
+                return (value, end)
+        self.statistics.misses += 1
+        (value, end) = self.__compute(ordinal)
+        assert end > ordinal
+        if len(self.__segments) >= self.__max_segments:
+            (evicted_start, _segment) = self.__segments.popitem(last=False)
+            del starts[bisect.bisect_left(starts, evicted_start)]
+            self.statistics.evictions += 1
+        bisect.insort(starts, ordinal)
+        self.__segments[ordinal] = (end, value)
+        return (value, end)
+
+    def clear(self):
+        '''
+        Forgets every segment, e.g. because compute's results changed.
+        '''
+        del self.__starts[:]
+        self.__segments.clear()
+
+class CachedPrimeRate(PrimeRate):
+    '''
+    A PrimeRate which remembers the rates of another PrimeRate in a
+    PiecewiseConstantCurve.
+    '''
+    def __init__(self, prime_rate, max_segments=4096):
+        self.__prime_rate = prime_rate
+        self.__curve = PiecewiseConstantCurve(self.__compute, max_segments=max_segments)
+
+    @property
+    def statistics(self):
+        return self.__curve.statistics
+
+    def __compute(self, ordinal):
+        (prime_rate, change_date) = self.__prime_rate.prime_rate_and_change_date(datetime.date.fromordinal(ordinal))
+        return ((prime_rate, change_date), change_date.toordinal())
+
+    def prime_rate_and_change_date(self, date):
+        (value, _end) = self.__curve.value_and_end(date.toordinal())
+        return value
+
+    def describe(self):
+        # Caching does not change rates.
+        return self.__prime_rate.describe()
+
+class InterestRateCurve(InterestRate):
+    '''
+    An InterestRate which remembers the rates of another InterestRate.
+
+    Daily rates are kept in a PiecewiseConstantCurve fed by the wrapped
+    rate's daily_interest_rate_and_change_date. Rates of other periods (e.g.
+    months) are kept in an LRUCache keyed by the period's ordinals.
+    '''
+    def __init__(self, interest_rate, max_segments=4096, max_periods=4096):
+        self.__interest_rate = interest_rate
+        self.__daily_curve = PiecewiseConstantCurve(self.__compute_daily, max_segments=max_segments)
+        self.__period_cache = LRUCache(max_size=max_periods)
+
+    @property
+    def daily_statistics(self):
+        return self.__daily_curve.statistics
+
+    @property
+    def period_statistics(self):
+        return self.__period_cache.statistics
+
+    def __compute_daily(self, ordinal):
+        (rate, change_date) = self.__interest_rate.daily_interest_rate_and_change_date(datetime.date.fromordinal(ordinal))
+        return ((rate, change_date), change_date.toordinal())
+
+    def daily_interest_rate_and_change_date(self, date):
+        (value, _end) = self.__daily_curve.value_and_end(date.toordinal())
+        return value
+
+    def clear(self):
+        '''
+        Forgets every remembered rate, e.g. because the wrapped rate's
+        inputs changed.
+        '''
+        self.__daily_curve.clear()
+        self.__period_cache.clear()
+
+    def describe(self):
+        # Caching does not change rates.
+        return self.__interest_rate.describe()
+
+    def period_interest_rate(self, period):
+        start_ordinal = period.start_date.toordinal()
+        end_ordinal = period.end_date.toordinal()
+        if end_ordinal == start_ordinal + 1:
+            ((rate, _change_date), _end) = self.__daily_curve.value_and_end(start_ordinal)
+            return rate
+        return self.__period_cache.get((start_ordinal, end_ordinal), lambda: self.__interest_rate.period_interest_rate(period))
+
+class TestPiecewiseConstantCurve(unittest.TestCase):
+    def test_lookups_within_a_segment_hit(self):
+        calls = []
+        def compute(ordinal):
+            calls.append(ordinal)
+            return (ordinal // 10, (ordinal // 10 + 1) * 10)
+        curve = PiecewiseConstantCurve(compute)
+        self.assertEqual(curve.value_and_end(13), (1, 20))
+        self.assertEqual(curve.value_and_end(19), (1, 20))
+        self.assertEqual(curve.value_and_end(15), (1, 20))
+        self.assertEqual(curve.value_and_end(20), (2, 30))
+        self.assertEqual(curve.value_and_end(5), (0, 10))
+        self.assertEqual(curve.value_and_end(14), (1, 20))
+        self.assertEqual(calls, [13, 20, 5])
+        self.assertEqual((curve.statistics.hits, curve.statistics.misses), (3, 3))
+
+    def test_least_recently_used_segment_is_evicted(self):
+        curve = PiecewiseConstantCurve(lambda ordinal: (ordinal // 10, (ordinal // 10 + 1) * 10), max_segments=2)
+        curve.value_and_end(0)
+        curve.value_and_end(10)
+        curve.value_and_end(1)
+        curve.value_and_end(20)
+        self.assertEqual(len(curve), 2)
+        self.assertEqual(curve.statistics.evictions, 1)
+        curve.value_and_end(2)
+        self.assertEqual(curve.statistics.misses, 3)
+        curve.value_and_end(11)
+        self.assertEqual(curve.statistics.misses, 4)
+
+class TestInterestRateCurve(unittest.TestCase):
+    def test_curve_matches_wrapped_rate(self):
+        prime_rate = YearlySteppingPrimeRate(
+            start_yearly_rate=Decimal('0.0425'),
+            start_year=2017,
+            yearly_increase=Decimal('0.005'),
+        )
+        interest_rate = VariableDailyInterestRate(prime_rate=prime_rate)
+        curve = InterestRateCurve(VariableDailyInterestRate(prime_rate=CachedPrimeRate(prime_rate)))
+        date = datetime.date(2017, 1, 1)
+        while date < datetime.date(2021, 1, 1):
+            tomorrow = date + datetime.timedelta(days=1)
+            self.assertEqual(curve.period_interest_rate(Period(date, tomorrow)), interest_rate.period_interest_rate(Period(date, tomorrow)))
+            self.assertEqual(curve.daily_interest_rate_and_change_date(date), interest_rate.daily_interest_rate_and_change_date(date))
+            date = tomorrow
+        self.assertEqual(curve.daily_statistics.misses, 4)
+
+    def test_monthly_rates_are_cached_by_period(self):
+        curve = InterestRateCurve(FixedMonthlyInterestRate(yearly_rate=Decimal('0.04125')))
+        january = Period(datetime.date(2017, 1, 1), datetime.date(2017, 2, 1))
+        self.assertEqual(curve.period_interest_rate(january), Decimal('0.04125') / 12)
+        self.assertEqual(curve.period_interest_rate(january), Decimal('0.04125') / 12)
+        self.assertEqual((curve.period_statistics.hits, curve.period_statistics.misses), (1, 1))
@@ -0,0 +1,352 @@
+from decimal import Decimal
+from moneycalc.account import BalanceHistory
+from moneycalc.account import PrimeRate
+from moneycalc.account import YearlySteppingPrimeRate
+from moneycalc.money import money
+from moneycalc.time import Period
+import bisect
+import copy
+import datetime
+import unittest
+
+_MIN_ORDINAL = datetime.date.min.toordinal()
+_MAX_ORDINAL = datetime.date.max.toordinal()
+
+class Inputs(object):
+    '''
+    Named inputs of a scenario (e.g. 'expenses' or 'prime rate') which can
+    be overridden for ranges of dates, and which can remember the dates
+    they were read at.
+
+    Handlers read an input with get, passing the value the scenario would
+    use without overrides. After track_reads, reads are remembered (as
+    merged ranges of dates), and IncrementalRun uses them to find the
+    earliest date an override affects.
+
+    Copies (with copy.deepcopy) share the original, so every fork of a
+    scenario sees the same overrides.
+    '''
+    def __init__(self):
+        # Maps names to lists of (start ordinal, end ordinal, value), in the
+        # order they were set. Later overrides win.
+        self.__overrides = {}
+        # If reads are tracked, maps names to pairs of sorted lists of the
+        # start and end ordinals of disjoint ranges of dates whose
+        # simulation read the input. Otherwise, None.
+        self.__reads = None
+        self.__listeners = []
+
+    def __deepcopy__(self, memo):
+        return self
+
+    def describe(self):
+        '''
+        Returns a tuple of plain values which is equal for Inputs with equal
+        overrides.
+        '''
+        return tuple(
+            (name, start_ordinal, end_ordinal, str(value))
+            for name in sorted(self.__overrides)
+            for (start_ordinal, end_ordinal, value) in self.__overrides[name]
+        )
+
+    def track_reads(self):
+        '''
+        Starts remembering reads for first_read_date.
+        '''
+        if self.__reads is None:
+            self.__reads = {}
+
+    def add_listener(self, listener):
+        '''
+        Calls listener(name) after every call to set, e.g. to forget values
+        cached from the input.
+        '''
+        self.__listeners.append(listener)
+
+    def set(self, name, value, start_date=None, end_date=None):
+        '''
+        Overrides the named input with value from start_date (inclusive) to
+        end_date (exclusive). Either can be None for no limit.
+        '''
+        start_ordinal = _MIN_ORDINAL if start_date is None else start_date.toordinal()
+        end_ordinal = _MAX_ORDINAL if end_date is None else end_date.toordinal()
+        self.__overrides.setdefault(name, []).append((start_ordinal, end_ordinal, value))
+        for listener in self.__listeners:
+            listener(name)
+
+    def get(self, name, date, default, until=None):
+        '''
+        Returns the named input's value at the given date, or default if it
+        is not overridden there.
+
+        The value is assumed to be used for every date from date up to (but
+        not including) until, which defaults to the next day.
+        '''
+        ordinal = date.toordinal()
+        if self.__reads is not None:
+            self.__add_read(name, ordinal, ordinal + 1 if until is None else until.toordinal())
+        overrides = self.__overrides.get(name)
+        if overrides:
+            for (start_ordinal, end_ordinal, value) in reversed(overrides):
+                if start_ordinal <= ordinal < end_ordinal:
+                    return value
+        return default
+
+    def __add_read(self, name, start_ordinal, end_ordinal):
+        reads = self.__reads.get(name)
+        if reads is None:
+            reads = ([], [])
+            self.__reads[name] = reads
+        (starts, ends) = reads
+        # Merge with the ranges which overlap or touch [start, end).
+        # Scenarios play in date order, so this is usually the last range.
+        first = bisect.bisect_left(ends, start_ordinal)
+        last = bisect.bisect_right(starts, end_ordinal)
+        if first < last:
+            start_ordinal = min(start_ordinal, starts[first])
+            end_ordinal = max(end_ordinal, ends[last - 1])
+        starts[first:last] = [start_ordinal]
+        ends[first:last] = [end_ordinal]
+
+    def next_change_date(self, name, date, change_date):
+        '''
+        Returns the earliest date after the given date at which an override
+        of the named input starts or ends, or change_date if it is earlier.
+        '''
+        ordinal = date.toordinal()
+        change_ordinal = change_date.toordinal()
+        for (start_ordinal, end_ordinal, _value) in self.__overrides.get(name, ()):
+            for boundary in (start_ordinal, end_ordinal):
+                if ordinal < boundary < change_ordinal:
+                    change_ordinal = boundary
+        return datetime.date.fromordinal(change_ordinal)
+
+    def first_read_date(self, name, start_date=None, end_date=None):
+        '''
+        Returns the earliest date from start_date (inclusive) to end_date
+        (exclusive) at which the named input was read since track_reads, or
+        None if it was not read in that range.
+        '''
+        start_ordinal = _MIN_ORDINAL if start_date is None else start_date.toordinal()
+        end_ordinal = _MAX_ORDINAL if end_date is None else end_date.toordinal()
+        (starts, ends) = (self.__reads or {}).get(name, ((), ()))
+        # The first range which ends after start_date.
+        index = bisect.bisect_right(ends, start_ordinal)
+        if index == len(ends) or starts[index] >= end_ordinal:
+            return None
+        return datetime.date.fromordinal(max(starts[index], start_ordinal))
+
+class InputPrimeRate(PrimeRate):
+    '''
+    A PrimeRate which follows another PrimeRate except where the named input
+    of inputs (an Inputs) is overridden.
+    '''
+    def __init__(self, inputs, name, prime_rate):
+        self.__inputs = inputs
+        self.__name = name
+        self.__prime_rate = prime_rate
+
+    def describe(self):
+        # Overrides are described by the scenario's Inputs.
+        return self.__prime_rate.describe()
+
+    def prime_rate_and_change_date(self, date):
+        (prime_rate, change_date) = self.__prime_rate.prime_rate_and_change_date(date)
+        change_date = self.__inputs.next_change_date(self.__name, date, change_date)
+        return (self.__inputs.get(self.__name, date, prime_rate, until=change_date), change_date)
+
+class _Checkpoint(object):
+    def __init__(self, date, scenario, state_key, total_interest):
+        self.date = date
+        # A fork of the scenario, played until (but not including) date.
+        self.scenario = scenario
+        self.state_key = state_key
+        # The run's interest before date. (scenario's own timeline might
+        # have a stale history; see IncrementalRun.)
+        self.total_interest = total_interest
+
+class IncrementalRun(object):
+    '''
+    A played scenario whose result is updated by replaying only the part
+    which an edit of its inputs affects.
+
+    The scenario is forked at its start and at the start of every year,
+    and each checkpoint remembers the scenario's state_key. change
+    overrides an input, then replays from the latest checkpoint before the
+    input's first read in the edited range. Once the edited range is over
+    and the replay reaches a checkpoint with the same state as before, the
+    rest of the previous result is reused.
+
+    Checkpoints after such a convergence keep the histories (timeline,
+    balance histories and year summaries) of the run they were taken in,
+    so results are stitched together from the result before the replay,
+    the replay, and the previous result after it.
+
+    A replay replaces every checkpoint it passes with a fork of the replayed
+    scenario, so later changes replay from the checkpoint nearest to them.
+    Forks share their history copy-on-write, so this costs a small fraction
+    of playing a year.
+    '''
+    def __init__(self, scenario):
+        self.inputs = scenario.inputs
+        self.inputs.track_reads()
+        # The Period replayed by the latest change, or None if it did not
+        # replay anything.
+        self.last_replay = None
+        scenario.start()
+        self.__checkpoints = []
+        date = scenario.start_date
+        while date <= scenario.end_date:
+            scenario.play_until(date)
+            self.__checkpoints.append(_Checkpoint(
+                date=date,
+                scenario=scenario.fork(),
+                state_key=scenario.state_key(),
+                total_interest=scenario.timeline.total_interest,
+            ))
+            date = datetime.date(year=date.year + 1, month=1, day=1)
+        scenario.play_until(None)
+        tax_ledger = scenario.timeline.tax_ledger
+        self.__taxes = dict((year, tax_ledger.tax(year)) for year in range(scenario.start_date.year, scenario.end_date.year))
+        self.result = scenario.finish()
+
+    def change(self, name, value, start_date=None, end_date=None):
+        '''
+        Overrides the named input (see Inputs.set) and returns the updated
+        ScenarioResult.
+        '''
+        self.inputs.set(name, value, start_date=start_date, end_date=end_date)
+        first_read_date = self.inputs.first_read_date(name, start_date=start_date, end_date=end_date)
+        if first_read_date is None:
+            self.last_replay = None
+            return self.result
+        # Replay from the latest checkpoint before anything read the edited
+        # input.
+        start_index = 0
+        for (index, checkpoint) in enumerate(self.__checkpoints):
+            if checkpoint.date <= first_read_date:
+                start_index = index
+        self.__replay(start_index, converge_date=end_date)
+        return self.result
+
+    def __replay(self, start_index, converge_date):
+        checkpoints = self.__checkpoints
+        start = checkpoints[start_index]
+        scenario = start.scenario.fork()
+        start_interest = scenario.timeline.total_interest
+        converged_index = None
+        for index in range(start_index + 1, len(checkpoints)):
+            old = checkpoints[index]
+            scenario.play_until(old.date)
+            state_key = scenario.state_key()
+            total_interest = start.total_interest + scenario.timeline.total_interest - start_interest
+            if converge_date is not None and old.date >= converge_date and state_key == old.state_key:
+                converged_index = index
+                break
+            checkpoints[index] = _Checkpoint(date=old.date, scenario=scenario.fork(), state_key=state_key, total_interest=total_interest)
+
+        old_result = self.result
+        if converged_index is None:
+            scenario.play_until(None)
+            end_date = None
+            interest_change = start.total_interest + scenario.timeline.total_interest - start_interest - old_result.total_interest
+        else:
+            end_date = checkpoints[converged_index].date
+            interest_change = total_interest - checkpoints[converged_index].total_interest
+            for checkpoint in checkpoints[converged_index:]:
+                checkpoint.total_interest += interest_change
+        end_year = scenario.end_date.year if end_date is None else end_date.year
+        tax_ledger = scenario.timeline.tax_ledger
+        for year in range(start.date.year, end_year):
+            self.__taxes[year] = tax_ledger.tax(year)
+        replay_result = scenario.finish()
+
+        # Year summaries are made on January 1 for the year before.
+        start_summary_year = start.date.year - 1
+        end_summary_year = None if end_date is None else end_date.year - 1
+        def replayed(year):
+            return year >= start_summary_year and (end_summary_year is None or year < end_summary_year)
+        year_summaries = [summary for summary in old_result.year_summaries if summary.year < start_summary_year]
+        year_summaries.extend(summary for summary in replay_result.year_summaries if replayed(summary.year))
+        if end_summary_year is not None:
+            year_summaries.extend(summary for summary in old_result.year_summaries if summary.year >= end_summary_year)
+
+        old_balance_histories = dict(old_result.balance_histories)
+        replay_balance_histories = dict(replay_result.balance_histories)
+        balance_histories = []
+        for (account_name, _history) in (replay_result if end_date is None else old_result).balance_histories:
+            history = BalanceHistory()
+            old_history = old_balance_histories.get(account_name)
+            if old_history is not None:
+                history.extend(old_history, end_date=start.date)
+            replay_history = replay_balance_histories.get(account_name)
+            if replay_history is not None:
+                history.extend(replay_history, start_date=start.date, end_date=end_date)
+            if end_date is not None and old_history is not None:
+                history.extend(old_history, start_date=end_date)
+            balance_histories.append((account_name, history))
+
+        result = copy.copy(replay_result if end_date is None else old_result)
+        result.year_summaries = year_summaries
+        result.total_interest = old_result.total_interest + interest_change
+        result.total_tax = sum((self.__taxes[year] for year in sorted(self.__taxes)), money(0))
+        result.balance_histories = balance_histories
+        result.timeline = None
+        result.profile = None
+        self.result = result
+        self.last_replay = Period(start.date, scenario.end_date if end_date is None else end_date)
+
+class TestInputs(unittest.TestCase):
+    def test_later_overrides_win(self):
+        inputs = Inputs()
+        inputs.set('rent', 100, start_date=datetime.date(2017, 1, 1))
+        inputs.set('rent', 150, start_date=datetime.date(2018, 1, 1), end_date=datetime.date(2018, 2, 1))
+        self.assertEqual(inputs.get('rent', datetime.date(2016, 12, 1), 90), 90)
+        self.assertEqual(inputs.get('rent', datetime.date(2017, 12, 1), 90), 100)
+        self.assertEqual(inputs.get('rent', datetime.date(2018, 1, 1), 90), 150)
+        self.assertEqual(inputs.get('rent', datetime.date(2018, 2, 1), 90), 100)
+        self.assertEqual(inputs.get('food', datetime.date(2018, 1, 1), 10), 10)
+        self.assertIs(copy.deepcopy(inputs), inputs)
+
+    def test_first_read_date(self):
+        inputs = Inputs()
+        inputs.get('rent', datetime.date(2017, 1, 1), 90)
+        self.assertIsNone(inputs.first_read_date('rent'))
+        inputs.track_reads()
+        inputs.get('rent', datetime.date(2017, 3, 1), 90)
+        inputs.get('rent', datetime.date(2017, 2, 1), 90)
+        inputs.get('rate', datetime.date(2017, 1, 1), 5, until=datetime.date(2018, 1, 1))
+        self.assertEqual(inputs.first_read_date('rent'), datetime.date(2017, 2, 1))
+        self.assertEqual(inputs.first_read_date('rent', start_date=datetime.date(2017, 2, 2)), datetime.date(2017, 3, 1))
+        self.assertIsNone(inputs.first_read_date('rent', start_date=datetime.date(2017, 3, 2)))
+        self.assertIsNone(inputs.first_read_date('rent', end_date=datetime.date(2017, 2, 1)))
+        self.assertEqual(inputs.first_read_date('rate', start_date=datetime.date(2017, 6, 1)), datetime.date(2017, 6, 1))
+        self.assertIsNone(inputs.first_read_date('rate', start_date=datetime.date(2018, 1, 1)))
+
+    def test_reads_are_merged(self):
+        inputs = Inputs()
+        inputs.track_reads()
+        for day in [5, 1, 2, 3, 9, 4, 8]:
+            inputs.get('rent', datetime.date(2017, 1, day), 90)
+        inputs.get('rent', datetime.date(2017, 1, 20), 90, until=datetime.date(2017, 2, 1))
+        inputs.get('rent', datetime.date(2017, 1, 25), 90, until=datetime.date(2017, 2, 5))
+        self.assertEqual(inputs.first_read_date('rent', start_date=datetime.date(2017, 1, 3)), datetime.date(2017, 1, 3))
+        self.assertEqual(inputs.first_read_date('rent', start_date=datetime.date(2017, 1, 6)), datetime.date(2017, 1, 8))
+        self.assertEqual(inputs.first_read_date('rent', start_date=datetime.date(2017, 1, 10)), datetime.date(2017, 1, 20))
+        self.assertEqual(inputs.first_read_date('rent', start_date=datetime.date(2017, 2, 3)), datetime.date(2017, 2, 3))
+        self.assertIsNone(inputs.first_read_date('rent', start_date=datetime.date(2017, 1, 10), end_date=datetime.date(2017, 1, 20)))
+        self.assertIsNone(inputs.first_read_date('rent', start_date=datetime.date(2017, 2, 5)))
+
+class TestInputPrimeRate(unittest.TestCase):
+    def test_overrides_split_steps(self):
+        inputs = Inputs()
+        prime_rate = InputPrimeRate(inputs, 'prime rate', YearlySteppingPrimeRate(
+            start_yearly_rate=Decimal('0.0425'),
+            start_year=2017,
+            yearly_increase=Decimal('0.005'),
+        ))
+        inputs.set('prime rate', Decimal('0.06'), start_date=datetime.date(2018, 7, 1), end_date=datetime.date(2019, 1, 1))
+        self.assertEqual(prime_rate.prime_rate_and_change_date(datetime.date(2018, 1, 1)), (Decimal('0.0475'), datetime.date(2018, 7, 1)))
+        self.assertEqual(prime_rate.prime_rate_and_change_date(datetime.date(2018, 7, 1)), (Decimal('0.06'), datetime.date(2019, 1, 1)))
+        self.assertEqual(prime_rate.prime_rate_and_change_date(datetime.date(2019, 1, 1)), (Decimal('0.0525'), datetime.date(2020, 1, 1)))
@@ -0,0 +1,189 @@
+from __future__ import absolute_import
+
+import cProfile
+import collections
+import marshal
+import moneycalc.money
+import pstats
+import sys
+import timeit
+import unittest
+
+_get_allocated_blocks = getattr(sys, 'getallocatedblocks', None)
+
+class CategoryStatistics(object):
+    '''
+    Totals over every call to the handlers of one category.
+    '''
+    def __init__(self):
+        self.calls = 0
+        self.seconds = 0.0
+        # Net number of memory blocks allocated by the handlers (i.e.
+        # allocations minus frees). None if the Python implementation cannot
+        # tell.
+        self.allocated_blocks = 0 if _get_allocated_blocks is not None else None
+        self.timeline_events = 0
+        self.money_calls = 0
+
+    def as_dict(self):
+        return collections.OrderedDict([
+            ('calls', self.calls),
+            ('seconds', self.seconds),
+            ('allocated_blocks', self.allocated_blocks),
+            ('timeline_events', self.timeline_events),
+            ('money_calls', self.money_calls),
+        ])
+
+class ScenarioProfile(object):
+    '''
+    Records what a scenario's handlers cost, grouped by category (e.g.
+    'salary' or 'mortgage payment'): calls, wall time, net allocations,
+    events added to the timeline, and calls to money() (each of which
+    rounds a Decimal or makes a Cents).
+
+    Pass a ScenarioProfile to Scenario.play to fill it in. If use_cprofile
+    is True, handlers also run under cProfile, and dump_stats writes a file
+    which pstats can read.
+    '''
+    def __init__(self, use_cprofile=False):
+        self.categories = collections.OrderedDict()
+        self.__profiler = cProfile.Profile() if use_cprofile else None
+        # The stats of __profiler in the format of pstats.Stats.stats.
+        self.__cprofile_stats = None
+
+    def __getstate__(self):
+        # cProfile.Profile cannot be pickled, but its stats can.
+        return (self.categories, self.cprofile_stats)
+
+    def __setstate__(self, state):
+        (self.categories, self.__cprofile_stats) = state
+        self.__profiler = None
+
+    def call(self, category, handler, date, timeline):
+        '''
+        Calls handler(date), adding its costs to the given category.
+        '''
+        statistics = self.categories.get(category)
+        if statistics is None:
+            statistics = CategoryStatistics()
+            self.categories[category] = statistics
+        counter = moneycalc.money.MoneyCallCounter()
+        old_counter = moneycalc.money.set_money_call_counter(counter)
+        profiler = self.__profiler
+        event_count = len(timeline)
+        allocated_blocks = _get_allocated_blocks() if _get_allocated_blocks is not None else 0
+        start_time = timeit.default_timer()
+        try:
+            if profiler is None:
+                handler(date)
+            else:
+                profiler.enable()
+                try:
+                    handler(date)
+                finally:
+                    profiler.disable()
+        finally:
+            statistics.seconds += timeit.default_timer() - start_time
+            if _get_allocated_blocks is not None:
+                statistics.allocated_blocks += _get_allocated_blocks() - allocated_blocks
+            statistics.calls += 1
+            statistics.timeline_events += len(timeline) - event_count
+            moneycalc.money.set_money_call_counter(old_counter)
+            statistics.money_calls += counter.count
+            if old_counter is not None:
+                old_counter.count += counter.count
+        self.__cprofile_stats = None
+
+    @property
+    def cprofile_stats(self):
+        if self.__cprofile_stats is None and self.__profiler is not None:
+            self.__cprofile_stats = pstats.Stats(self.__profiler).stats
+        return self.__cprofile_stats
+
+    def dump_stats(self, path):
+        '''
+        Writes the cProfile statistics of the handlers in the format of
+        cProfile.Profile.dump_stats.
+        '''
+        stats = self.cprofile_stats
+        if stats is None:
+            raise ValueError('Profile was not created with use_cprofile=True')
+        with open(path, 'wb') as f:
+            marshal.dump(stats, f)
+
+    def as_dict(self):
+        return collections.OrderedDict((category, statistics.as_dict()) for (category, statistics) in self.categories.items())
+
+    def write_report(self, out):
+        out.write('{:<20} {:>8} {:>10} {:>10} {:>8} {:>8}\n'.format('category', 'calls', 'seconds', 'blocks', 'events', 'money()'))
+        categories = sorted(self.categories.items(), key=lambda item: -item[1].seconds)
+        for (category, statistics) in categories:
+            out.write('{:<20} {:>8} {:>10.4f} {:>10} {:>8} {:>8}\n'.format(
+                category,
+                statistics.calls,
+                statistics.seconds,
+                'n/a' if statistics.allocated_blocks is None else statistics.allocated_blocks,
+                statistics.timeline_events,
+                statistics.money_calls,
+            ))
+
+class ProfiledScenarioFactory(object):
+    '''
+    A scenario factory whose scenarios play with a new ScenarioProfile. The
+    profile is returned in the ScenarioResult.
+    '''
+    def __init__(self, scenario_factory, use_cprofile=False):
+        self.scenario_factory = scenario_factory
+        self.use_cprofile = use_cprofile
+
+    @property
+    def __name__(self):
+        return self.scenario_factory.__name__
+
+    def __call__(self, *args, **kwargs):
+        return _ProfiledScenario(self.scenario_factory(*args, **kwargs), use_cprofile=self.use_cprofile)
+
+class _ProfiledScenario(object):
+    def __init__(self, scenario, use_cprofile):
+        self.__scenario = scenario
+        self.__use_cprofile = use_cprofile
+
+    def __str__(self):
+        return str(self.__scenario)
+
+    def play(self, **kwargs):
+        return self.__scenario.play(profile=ScenarioProfile(use_cprofile=self.__use_cprofile), **kwargs)
+
+class _FakeTimeline(object):
+    def __init__(self):
+        self.events = []
+
+    def __len__(self):
+        return len(self.events)
+
+class TestScenarioProfile(unittest.TestCase):
+    def test_costs_are_grouped_by_category(self):
+        timeline = _FakeTimeline()
+        def pay(date):
+            timeline.events.append(moneycalc.money.money('1.00'))
+            timeline.events.append(moneycalc.money.money('2.00'))
+        def summarize(date):
+            pass
+        profile = ScenarioProfile()
+        for date in range(3):
+            profile.call('payment', pay, date, timeline=timeline)
+        profile.call('summary', summarize, 3, timeline=timeline)
+        self.assertEqual(list(profile.categories), ['payment', 'summary'])
+        payment = profile.categories['payment']
+        self.assertEqual((payment.calls, payment.timeline_events, payment.money_calls), (3, 6, 6))
+        summary = profile.categories['summary']
+        self.assertEqual((summary.calls, summary.timeline_events, summary.money_calls), (1, 0, 0))
+        self.assertEqual(profile.as_dict()['payment']['calls'], 3)
+        self.assertIsNone(moneycalc.money.set_money_call_counter(None))
+
+    def test_cprofile_stats_include_handlers(self):
+        def handler(date):
+            sorted(range(date))
+        profile = ScenarioProfile(use_cprofile=True)
+        profile.call('sort', handler, 10, timeline=_FakeTimeline())
+        self.assertTrue(any(function_name == 'handler' for (_file, _line, function_name) in profile.cprofile_stats))
@@ -0,0 +1,414 @@
+from decimal import Decimal
+from moneycalc.account import Account
+from moneycalc.account import AmortizationMode
+from moneycalc.account import AmortizationSchedule
+from moneycalc.account import AmortizedMonthlyLoan
+from moneycalc.account import BalanceHistory
+from moneycalc.account import FixedMonthlyInterestRate
+from moneycalc.account import amortized_monthly_payment
+from moneycalc.money import money
+from moneycalc.money import money_from_cents
+from moneycalc.money import money_to_cents
+from moneycalc.time import Period
+from moneycalc.time import add_month
+from moneycalc.util import _INT64_TYPECODE
+import array
+import bisect
+import datetime
+import moneycalc.time
+import moneycalc.timeline
+import unittest
+
+class LoanBook(Account):
+    '''
+    Many AmortizedMonthlyLoan-s which are paid every month, advanced
+    together.
+
+    Each loan receives its minimum payment plus its cohort's extra monthly
+    payment (capped at its payoff amount), and chosen loans can be paid off
+    at any of their payment dates.
+
+    Loans with the same amount, interest rate, term and extra payment form
+    a cohort which follows one shared AmortizationSchedule, and loans with
+    the same interest rate and term share their period interest rates.
+    Each payment date's total payment, interest and principal (in cents)
+    are summed over every cohort once, so paying costs the same for ten
+    loans as for ten thousand.
+
+    Every loan pays exactly like an AmortizedMonthlyLoan would, but the
+    timeline gets one interest event and one principal event per payment
+    date for the whole book, and balance_history holds the whole book's
+    balance (counting loans which start later at their full amount).
+    '''
+    def __init__(self, name):
+        super(LoanBook, self).__init__(name=name)
+        # Per loan: the index of its cohort, and the date ordinal it was
+        # paid off at (or 0).
+        self.__loan_cohorts = array.array('i')
+        self.__loan_payoff_ordinals = array.array('i')
+        # Per cohort: the number of loans not paid off, and a schedule whose
+        # amounts are in cents.
+        self.__cohort_counts = array.array('i')
+        self.__cohort_schedules = []
+        self.__cohorts_by_key = {}
+        # Maps (interest rate description, first payment date, months) to
+        # (dates, period interest rates).
+        self.__interest_rates_by_key = {}
+        # Sorted payment date ordinals with the total payment, interest and
+        # principal due at each. Computed lazily by __totals.
+        self.__due_ordinals = None
+        self.__due_payments = None
+        self.__due_interests = None
+        self.__due_principals = None
+        # The ordinal of the last payment date paid, or None.
+        self.__paid_through_ordinal = None
+        self.__balance_cents = 0
+
+    def __len__(self):
+        return len(self.__loan_cohorts)
+
+    @property
+    def balance(self):
+        return money_from_cents(self.__balance_cents)
+
+    def state_key(self):
+        return (self.__balance_cents, self.__paid_through_ordinal, len(self.__loan_cohorts), tuple(self.__cohort_counts))
+
+    def add_loans(self, amount, interest_rate, term, count=1, extra_monthly_payment=money(0)):
+        '''
+        Adds count identical loans, each like AmortizedMonthlyLoan(amount=amount,
+        interest_rate=interest_rate, term=term), and returns the range of
+        their indexes.
+
+        Each month, each loan is paid its minimum payment plus
+        extra_monthly_payment, or its payoff amount if that is less.
+
+        Loans cannot be added once payments have been made.
+        '''
+        assert amount == money(amount)
+        assert extra_monthly_payment >= 0
+        assert extra_monthly_payment == money(extra_monthly_payment)
+        if self.__paid_through_ordinal is not None:
+            raise ValueError('Cannot add loans to a book which has been paid')
+        cohort = self.__cohort(amount=amount, interest_rate=interest_rate, term=term, extra_monthly_payment=extra_monthly_payment)
+        first_index = len(self.__loan_cohorts)
+        self.__loan_cohorts.extend([cohort] * count)
+        self.__loan_payoff_ordinals.extend([0] * count)
+        self.__cohort_counts[cohort] += count
+        self.__balance_cents += money_to_cents(amount) * count
+        self.__due_ordinals = None
+        # Record the initial balance of every loan at the book's first
+        # payment date. No payments were made, so the history holds nothing
+        # else, and can start over if the first payment date moved.
+        self.balance_history = BalanceHistory()
+        self.balance_history.record(self.next_payment_date, self.balance)
+        return range(first_index, first_index + count)
+
+    def __cohort(self, amount, interest_rate, term, extra_monthly_payment):
+        rate_description = interest_rate.describe()
+        key = (money_to_cents(amount), rate_description, term.start_date, term.end_date, money_to_cents(extra_monthly_payment))
+        cohort = self.__cohorts_by_key.get(key)
+        if cohort is not None:
+            return cohort
+        months = moneycalc.time.diff_months(term.end_date, term.start_date)
+        rates_key = (rate_description, term.start_date, months)
+        dates_and_rates = self.__interest_rates_by_key.get(rates_key)
+        if dates_and_rates is None:
+            dates = []
+            interest_rates = []
+            date = term.start_date
+            for _ in range(months):
+                dates.append(date)
+                next_date = add_month(date)
+                interest_rates.append(interest_rate.period_interest_rate(Period(date, next_date)))
+                date = next_date
+            dates_and_rates = (dates, interest_rates)
+            self.__interest_rates_by_key[rates_key] = dates_and_rates
+        (dates, interest_rates) = dates_and_rates
+        if extra_monthly_payment:
+            schedule = _extra_payment_schedule(balance=amount, dates=dates, interest_rates=interest_rates, extra_monthly_payment=extra_monthly_payment)
+        else:
+            schedule = AmortizationSchedule.from_interest_rates(balance=amount, dates=dates, interest_rates=interest_rates)
+        cohort = len(self.__cohort_schedules)
+        self.__cohort_schedules.append(_CentsSchedule(schedule))
+        self.__cohort_counts.append(0)
+        self.__cohorts_by_key[key] = cohort
+        return cohort
+
+    def __totals(self):
+        if self.__due_ordinals is None:
+            totals = {}
+            for (count, schedule) in zip(self.__cohort_counts, self.__cohort_schedules):
+                if not count:
+                    continue
+                for (ordinal, payment, interest, principal) in zip(schedule.date_ordinals, schedule.payments, schedule.interests, schedule.principals):
+                    total = totals.get(ordinal)
+                    if total is None:
+                        total = [0, 0, 0]
+                        totals[ordinal] = total
+                    total[0] += payment * count
+                    total[1] += interest * count
+                    total[2] += principal * count
+            ordinals = sorted(totals)
+            self.__due_ordinals = array.array('i', ordinals)
+            self.__due_payments = array.array(_INT64_TYPECODE, (totals[ordinal][0] for ordinal in ordinals))
+            self.__due_interests = array.array(_INT64_TYPECODE, (totals[ordinal][1] for ordinal in ordinals))
+            self.__due_principals = array.array(_INT64_TYPECODE, (totals[ordinal][2] for ordinal in ordinals))
+        return self.__due_ordinals
+
+    def __next_due_index(self):
+        due_ordinals = self.__totals()
+        if self.__paid_through_ordinal is None:
+            return 0
+        return bisect.bisect_right(due_ordinals, self.__paid_through_ordinal)
+
+    @property
+    def next_payment_date(self):
+        '''
+        The next date on which any loan's payment is due, or None if every
+        loan is paid off.
+        '''
+        index = self.__next_due_index()
+        if index >= len(self.__due_ordinals):
+            return None
+        return datetime.date.fromordinal(self.__due_ordinals[index])
+
+    def minimum_deposit(self, date, pay_off=()):
+        '''
+        Returns the total of every loan's payment due at the given date,
+        which must be next_payment_date, where the loans whose indexes are
+        in pay_off are paid off instead.
+        '''
+        index = self.__due_index(date)
+        payoff_principal = self.__payoff_principal(date, pay_off)
+        return money_from_cents(self.__due_payments[index] + payoff_principal)
+
+    def __due_index(self, date):
+        if date != self.next_payment_date:
+            raise NotImplementedError()
+        return self.__next_due_index()
+
+    def __payoff_principal(self, date, pay_off):
+        '''
+        Returns the principal (in cents) which paying off the given loans at
+        the given date pays on top of their scheduled principal.
+        '''
+        ordinal = date.toordinal()
+        principal = 0
+        for loan in set(pay_off):
+            if self.__loan_payoff_ordinals[loan]:
+                raise NotImplementedError()
+            schedule = self.__cohort_schedules[self.__loan_cohorts[loan]]
+            row = bisect.bisect_left(schedule.date_ordinals, ordinal)
+            if row >= len(schedule.date_ordinals) or schedule.date_ordinals[row] != ordinal:
+                # The loan has no payment due at the given date.
+                raise NotImplementedError()
+            balance_before = schedule.balances[row - 1] if row else schedule.start_balance
+            principal += balance_before - schedule.principals[row]
+        return principal
+
+    def pay_minimum(self, timeline, date, description):
+        '''
+        Makes the payment of every loan due at the given date, which must
+        be next_payment_date.
+        '''
+        self.pay(timeline=timeline, date=date, description=description)
+
+    def pay(self, timeline, date, description, pay_off=()):
+        '''
+        Makes the payment of every loan due at the given date, which must
+        be next_payment_date, and pays off the loans whose indexes are in
+        pay_off.
+        '''
+        pay_off = set(pay_off)
+        index = self.__due_index(date)
+        interest = self.__due_interests[index]
+        principal = self.__due_principals[index] + self.__payoff_principal(date, pay_off)
+        timeline.add_interest_deposit(date=date, account=self, amount=money_from_cents(interest), description='{} (interest)'.format(description))
+        timeline.add_principal_deposit(date=date, account=self, amount=money_from_cents(principal), description='{} (principal)'.format(description))
+        self.__balance_cents -= principal
+        self.__paid_through_ordinal = date.toordinal()
+        if pay_off:
+            for loan in pay_off:
+                self.__loan_payoff_ordinals[loan] = self.__paid_through_ordinal
+                self.__cohort_counts[self.__loan_cohorts[loan]] -= 1
+            self.__due_ordinals = None
+        self.record_balance(timeline, date)
+
+    def loan_balance(self, index):
+        '''
+        Returns the balance of the loan with the given index.
+        '''
+        if self.__loan_payoff_ordinals[index]:
+            return money(0)
+        schedule = self.__cohort_schedules[self.__loan_cohorts[index]]
+        if self.__paid_through_ordinal is None:
+            return money_from_cents(schedule.start_balance)
+        paid = bisect.bisect_right(schedule.date_ordinals, self.__paid_through_ordinal)
+        return money_from_cents(schedule.balances[paid - 1] if paid else schedule.start_balance)
+
+def _extra_payment_schedule(balance, dates, interest_rates, extra_monthly_payment):
+    '''
+    Returns the EXACT AmortizationSchedule of an AmortizedMonthlyLoan which
+    is paid its minimum payment plus extra_monthly_payment every month (or
+    its payoff amount if that is less), ending once it is paid off.
+    '''
+    start_balance = balance
+    payments = []
+    interests = []
+    principals = []
+    balances = []
+    months_remaining = len(dates)
+    for interest_rate in interest_rates:
+        if not balance:
+            break
+        interest = money(interest_rate * balance)
+        payment = min(
+            money(amortized_monthly_payment(balance, interest_rate, months_remaining) + extra_monthly_payment),
+            money(interest + balance),
+        )
+        principal = money(payment - interest)
+        balance = money(balance - principal)
+        payments.append(payment)
+        interests.append(interest)
+        principals.append(principal)
+        balances.append(balance)
+        months_remaining -= 1
+    return AmortizationSchedule(
+        mode=AmortizationMode.EXACT,
+        start_balance=start_balance,
+        dates=dates[:len(payments)],
+        interest_rates=interest_rates[:len(payments)],
+        payments=payments,
+        interests=interests,
+        principals=principals,
+        balances=balances,
+    )
+
+class _CentsSchedule(object):
+    '''
+    The columns of an EXACT AmortizationSchedule as arrays of cents.
+    '''
+    def __init__(self, schedule):
+        self.start_balance = money_to_cents(schedule.start_balance)
+        self.date_ordinals = array.array('i', (date.toordinal() for date in schedule.dates))
+        self.payments = array.array(_INT64_TYPECODE, (money_to_cents(amount) for amount in schedule.payments))
+        self.interests = array.array(_INT64_TYPECODE, (money_to_cents(amount) for amount in schedule.interests))
+        self.principals = array.array(_INT64_TYPECODE, (money_to_cents(amount) for amount in schedule.principals))
+        self.balances = array.array(_INT64_TYPECODE, (money_to_cents(amount) for amount in schedule.balances))
+
+class TestLoanBook(unittest.TestCase):
+    def make_loan_parameters(self):
+        fixed = FixedMonthlyInterestRate(yearly_rate=Decimal('0.04125'))
+        other_fixed = FixedMonthlyInterestRate(yearly_rate=Decimal('0.05'))
+        return [
+            (money('975000.00'), fixed, Period(datetime.date(2017, 1, 1), datetime.date(2047, 1, 1)), 3),
+            (money('250000.00'), fixed, Period(datetime.date(2017, 1, 1), datetime.date(2047, 1, 1)), 2),
+            (money('250000.00'), other_fixed, Period(datetime.date(2017, 3, 1), datetime.date(2032, 3, 1)), 1),
+            (money('80000.00'), fixed, Period(datetime.date(2017, 2, 1), datetime.date(2022, 2, 1)), 4),
+        ]
+
+    def test_book_pays_like_individual_loans(self):
+        loans = []
+        book = LoanBook(name='Book')
+        for (amount, interest_rate, term, count) in self.make_loan_parameters():
+            for _ in range(count):
+                loans.append(AmortizedMonthlyLoan(name='Loan', amount=amount, interest_rate=interest_rate, term=term))
+            book.add_loans(amount=amount, interest_rate=interest_rate, term=term, count=count)
+        self.assertEqual(len(book), len(loans))
+
+        loan_timeline = moneycalc.timeline.Timeline()
+        book_timeline = moneycalc.timeline.Timeline()
+        next_dates = [loan.term.start_date for loan in loans]
+        checked_loan_balances = False
+        while book.next_payment_date is not None:
+            date = book.next_payment_date
+            expected_payment = money(0)
+            for (i, loan) in enumerate(loans):
+                if next_dates[i] == date and date < loan.term.end_date:
+                    payment = loan.minimum_deposit(date)
+                    expected_payment += payment
+                    loan.deposit(timeline=loan_timeline, date=date, amount=payment, description='Payment')
+                    next_dates[i] = add_month(date)
+            self.assertEqual(book.minimum_deposit(date), expected_payment)
+            book.pay_minimum(timeline=book_timeline, date=date, description='Payment')
+            self.assertEqual(book.balance, sum((loan.balance for loan in loans), money(0)))
+            self.assertEqual(book.balance_history.balance_at(date), book.balance)
+            if date == datetime.date(2019, 6, 1):
+                self.assertEqual([book.loan_balance(i) for i in range(len(loans))], [loan.balance for loan in loans])
+                checked_loan_balances = True
+        self.assertTrue(checked_loan_balances)
+        self.assertEqual(book.balance, money(0))
+        self.assertEqual(len(book.balance_history), len(set(date for loan in loans for (date, _balance) in loan.balance_history.items())))
+        self.assertEqual(book.balance_history.balance_at(datetime.date(2016, 12, 31)), money(0))
+        self.assertEqual(book.balance_history.balance_at(datetime.date(2020, 2, 29)), sum((loan.balance_history.balance_at(datetime.date(2020, 2, 29)) for loan in loans), money(0)))
+        self.assertEqual(book_timeline.total_interest, loan_timeline.total_interest)
+        for year in range(2017, 2048):
+            self.assertEqual(book_timeline.tax_ledger.year_totals(year).deductible, loan_timeline.tax_ledger.year_totals(year).deductible)
+
+    def test_book_pays_extra_and_pays_off_like_individual_loans(self):
+        loans = []
+        extra_payments = []
+        book = LoanBook(name='Book')
+        for (i, (amount, interest_rate, term, count)) in enumerate(self.make_loan_parameters()):
+            extra_monthly_payment = money(i * 500)
+            for _ in range(count):
+                loans.append(AmortizedMonthlyLoan(name='Loan', amount=amount, interest_rate=interest_rate, term=term))
+                extra_payments.append(extra_monthly_payment)
+            book.add_loans(amount=amount, interest_rate=interest_rate, term=term, count=count, extra_monthly_payment=extra_monthly_payment)
+        payoffs = {
+            datetime.date(2018, 1, 1): [0, 5],
+            datetime.date(2019, 6, 1): [1, 7, 8],
+            datetime.date(2025, 3, 1): [4],
+        }
+
+        loan_timeline = moneycalc.timeline.Timeline()
+        book_timeline = moneycalc.timeline.Timeline()
+        next_dates = [loan.term.start_date for loan in loans]
+        while book.next_payment_date is not None:
+            date = book.next_payment_date
+            pay_off = payoffs.get(date, [])
+            expected_payment = money(0)
+            for (i, loan) in enumerate(loans):
+                if next_dates[i] == date and date < loan.term.end_date and loan.balance:
+                    if i in pay_off:
+                        payment = loan.payoff_deposit(date)
+                    else:
+                        payment = min(loan.minimum_deposit(date) + extra_payments[i], loan.payoff_deposit(date))
+                    expected_payment += payment
+                    loan.deposit(timeline=loan_timeline, date=date, amount=payment, description='Payment')
+                    next_dates[i] = add_month(date)
+            self.assertEqual(book.minimum_deposit(date, pay_off=pay_off), expected_payment)
+            book.pay(timeline=book_timeline, date=date, description='Payment', pay_off=pay_off)
+            self.assertEqual(book.balance, sum((loan.balance for loan in loans), money(0)))
+            self.assertEqual(book.balance_history.balance_at(date), book.balance)
+            self.assertEqual([book.loan_balance(i) for i in range(len(loans))], [loan.balance for loan in loans])
+        self.assertEqual(book.balance, money(0))
+        self.assertEqual(book_timeline.total_interest, loan_timeline.total_interest)
+        for year in range(2017, 2048):
+            self.assertEqual(book_timeline.tax_ledger.year_totals(year).deductible, loan_timeline.tax_ledger.year_totals(year).deductible)
+
+    def test_only_due_loans_can_be_paid_off(self):
+        book = LoanBook(name='Book')
+        for (amount, interest_rate, term, count) in self.make_loan_parameters():
+            book.add_loans(amount=amount, interest_rate=interest_rate, term=term, count=count)
+        timeline = moneycalc.timeline.Timeline()
+        with self.assertRaises(NotImplementedError):
+            # The 2017-02-01 loans are not due yet.
+            book.pay(timeline=timeline, date=datetime.date(2017, 1, 1), description='Payment', pay_off=[9])
+        book.pay(timeline=timeline, date=datetime.date(2017, 1, 1), description='Payment', pay_off=[0])
+        book.pay_minimum(timeline=timeline, date=datetime.date(2017, 2, 1), description='Payment')
+        with self.assertRaises(NotImplementedError):
+            book.pay(timeline=timeline, date=datetime.date(2017, 3, 1), description='Payment', pay_off=[0])
+        self.assertEqual(book.loan_balance(0), money(0))
+
+    def test_payments_must_be_made_in_order(self):
+        book = LoanBook(name='Book')
+        for (amount, interest_rate, term, count) in self.make_loan_parameters():
+            book.add_loans(amount=amount, interest_rate=interest_rate, term=term, count=count)
+        timeline = moneycalc.timeline.Timeline()
+        with self.assertRaises(NotImplementedError):
+            book.pay_minimum(timeline=timeline, date=datetime.date(2017, 2, 1), description='Payment')
+        book.pay_minimum(timeline=timeline, date=datetime.date(2017, 1, 1), description='Payment')
+        with self.assertRaises(ValueError):
+            book.add_loans(amount=money('1000.00'), interest_rate=FixedMonthlyInterestRate(yearly_rate=Decimal('0.05')), term=Period(datetime.date(2017, 2, 1), datetime.date(2018, 2, 1)))
@@ -1,9 +1,290 @@
 from decimal import Decimal
+import contextlib
 import decimal
+import unittest
 
 money_context = decimal.BasicContext.copy()
 money_context.prec = 20
 money_context.rounding = decimal.ROUND_HALF_UP # FIXME(strager)
 
+_CENT = Decimal('0.01')
+
+class MoneyRepresentation(object):
+    # money() returns Decimals quantized to cents.
+    DECIMAL = 'DECIMAL'
+    # money() returns Cents, which add, subtract and compare as ints.
+    CENTS = 'CENTS'
+
+_representation = MoneyRepresentation.DECIMAL
+
+def money_representation():
+    return _representation
+
+def set_money_representation(representation):
+    '''
+    Selects what money() returns for the whole process. Switch before
+    creating any accounts or amounts; mixing representations within a
+    simulation works but is slower.
+    '''
+    global _representation
+    if representation not in (MoneyRepresentation.DECIMAL, MoneyRepresentation.CENTS):
+        raise ValueError('Unknown money representation: {}'.format(representation))
+    _representation = representation
+
+@contextlib.contextmanager
+def using_money_representation(representation):
+    old_representation = _representation
+    set_money_representation(representation)
+    try:
+        yield
+    finally:
+        set_money_representation(old_representation)
+
+class MoneyCallCounter(object):
+    def __init__(self):
+        self.count = 0
+
+# If not None, a MoneyCallCounter counting calls to money().
+_money_call_counter = None
+
+def set_money_call_counter(counter):
+    '''
+    Makes money() count its calls in the given MoneyCallCounter (or stop
+    counting, if counter is None). Returns the previous counter.
+    '''
+    global _money_call_counter
+    old_counter = _money_call_counter
+    _money_call_counter = counter
+    return old_counter
+
 def money(amount):
-    return Decimal(amount).quantize(Decimal('0.01'), context=money_context)
+    if _money_call_counter is not None:
+        _money_call_counter.count += 1
+    if type(amount) is Cents:
+        return amount
+    if _representation is MoneyRepresentation.CENTS:
+        return Cents.from_amount(amount)
+    return Decimal(amount).quantize(_CENT, context=money_context)
+
+def money_to_cents(amount):
+    '''
+    Returns the number of cents in a money() amount as an int.
+    '''
+    if type(amount) is Cents:
+        return amount.cents
+    scaled = Decimal(amount).scaleb(2)
+    cents = int(scaled)
+    if cents != scaled:
+        raise ValueError('Amount has fractional cents: {}'.format(amount))
+    return cents
+
+def money_from_cents(cents):
+    '''
+    Returns an int number of cents as a money() amount.
+    '''
+    if _representation is MoneyRepresentation.CENTS:
+        return Cents(cents)
+    return Decimal(cents).scaleb(-2)
+
+try:
+    _integer_types = (int, long)
+except NameError:
+    _integer_types = (int,)
+
+class Cents(object):
+    '''
+    An amount of money stored as an integer number of cents.
+
+    Cents behave like the Decimals returned by money() in the DECIMAL
+    representation. Adding, subtracting and comparing Cents are integer
+    operations. Multiplying or dividing by a Decimal gives an exact Decimal
+    which money() rounds with ROUND_HALF_UP, like the Decimal
+    representation.
+    '''
+    __slots__ = ('cents',)
+
+    def __init__(self, cents):
+        self.cents = cents
+
+    @staticmethod
+    def from_amount(amount):
+        if isinstance(amount, _integer_types):
+            return Cents(amount * 100)
+        return Cents(int(Decimal(amount).quantize(_CENT, context=money_context).scaleb(2)))
+
+    def to_decimal(self):
+        return Decimal(self.cents).scaleb(-2)
+
+    def __reduce__(self):
+        return (Cents, (self.cents,))
+
+    def __repr__(self):
+        return 'Cents({})'.format(self.cents)
+
+    def __str__(self):
+        return str(self.to_decimal())
+
+    def __format__(self, format_spec):
+        return format(self.to_decimal(), format_spec)
+
+    def __hash__(self):
+        return hash(self.to_decimal())
+
+    def __float__(self):
+        return self.cents / 100.0
+
+    def __int__(self):
+        return int(self.to_decimal())
+
+    def __bool__(self):
+        return self.cents != 0
+    __nonzero__ = __bool__
+
+    def __neg__(self):
+        return Cents(-self.cents)
+
+    def __pos__(self):
+        return self
+
+    def __abs__(self):
+        return Cents(abs(self.cents))
+
+    def __add__(self, other):
+        if type(other) is Cents:
+            return Cents(self.cents + other.cents)
+        if isinstance(other, _integer_types):
+            return Cents(self.cents + other * 100)
+        if isinstance(other, Decimal):
+            return self.to_decimal() + other
+        return NotImplemented
+    __radd__ = __add__
+
+    def __sub__(self, other):
+        if type(other) is Cents:
+            return Cents(self.cents - other.cents)
+        if isinstance(other, _integer_types):
+            return Cents(self.cents - other * 100)
+        if isinstance(other, Decimal):
+            return self.to_decimal() - other
+        return NotImplemented
+
+    def __rsub__(self, other):
+        if isinstance(other, _integer_types):
+            return Cents(other * 100 - self.cents)
+        if isinstance(other, Decimal):
+            return other - self.to_decimal()
+        return NotImplemented
+
+    def __mul__(self, other):
+        if isinstance(other, _integer_types):
+            return Cents(self.cents * other)
+        if isinstance(other, Decimal):
+            return self.to_decimal() * other
+        return NotImplemented
+    __rmul__ = __mul__
+
+    def __truediv__(self, other):
+        if isinstance(other, _integer_types + (Decimal,)):
+            return self.to_decimal() / other
+        return NotImplemented
+    __div__ = __truediv__
+
+    def __compare_key(self, other):
+        if type(other) is Cents:
+            return (self.cents, other.cents)
+        if isinstance(other, _integer_types):
+            return (self.cents, other * 100)
+        if isinstance(other, Decimal):
+            return (self.to_decimal(), other)
+        return None
+
+    def __eq__(self, other):
+        key = self.__compare_key(other)
+        if key is None:
+            return NotImplemented
+        return key[0] == key[1]
+
+    def __ne__(self, other):
+        key = self.__compare_key(other)
+        if key is None:
+            return NotImplemented
+        return key[0] != key[1]
+
+    def __lt__(self, other):
+        key = self.__compare_key(other)
+        if key is None:
+            return NotImplemented
+        return key[0] < key[1]
+
+    def __le__(self, other):
+        key = self.__compare_key(other)
+        if key is None:
+            return NotImplemented
+        return key[0] <= key[1]
+
+    def __gt__(self, other):
+        key = self.__compare_key(other)
+        if key is None:
+            return NotImplemented
+        return key[0] > key[1]
+
+    def __ge__(self, other):
+        key = self.__compare_key(other)
+        if key is None:
+            return NotImplemented
+        return key[0] >= key[1]
+
+class TestCents(unittest.TestCase):
+    def test_cents_conversions_round_trip(self):
+        for representation in [MoneyRepresentation.DECIMAL, MoneyRepresentation.CENTS]:
+            with using_money_representation(representation):
+                for amount in ['0.00', '-0.01', '1234.56', '-975000.00']:
+                    self.assertEqual(money_from_cents(money_to_cents(money(amount))), money(amount))
+        self.assertEqual(money_to_cents(Decimal('-12.30')), -1230)
+        with self.assertRaises(ValueError):
+            money_to_cents(Decimal('0.001'))
+
+    def test_money_rounds_like_decimal_representation(self):
+        amounts = [
+            0, 1, -1, 1234,
+            '0.005', '-0.005', '0.015', '1.004999', '-2.675', '7553.31',
+            Decimal('0.0425') / 365 * Decimal('975000.00'),
+            Decimal('-0.0425') / 366 * Decimal('910117.53'),
+            7553.31 * 0.215,
+            Decimal(7553.31) * Decimal(0.215),
+        ]
+        for amount in amounts:
+            with using_money_representation(MoneyRepresentation.DECIMAL):
+                expected = money(amount)
+            with using_money_representation(MoneyRepresentation.CENTS):
+                actual = money(amount)
+            self.assertIsInstance(actual, Cents)
+            self.assertEqual(actual, expected)
+            self.assertEqual(str(actual), str(expected).replace('-0.00', '0.00'))
+            self.assertEqual('{:16}'.format(actual), '{:16}'.format(expected).replace('-0.00', ' 0.00'))
+
+    def test_arithmetic_matches_decimal(self):
+        a = Cents(123456)
+        b = Cents(-789)
+        rate = Decimal('0.04125') / 12
+        self.assertEqual(a + b, Cents(122667))
+        self.assertEqual(a - b, Cents(124245))
+        self.assertEqual(-b, Cents(789))
+        self.assertEqual(abs(b), Cents(789))
+        self.assertEqual(a * 3, Cents(370368))
+        self.assertEqual(sum([a, b]), Cents(122667))
+        self.assertEqual(a * rate, Decimal('1234.56') * rate)
+        self.assertEqual(rate * a, rate * Decimal('1234.56'))
+        self.assertEqual(a / 2, Decimal('617.28'))
+        self.assertEqual(a + Decimal('0.001'), Decimal('1234.561'))
+
+    def test_comparisons(self):
+        self.assertTrue(Cents(1) > 0)
+        self.assertTrue(Cents(-1) < 0)
+        self.assertTrue(Cents(0) == 0)
+        self.assertTrue(Cents(100) == Decimal('1.00'))
+        self.assertTrue(Decimal('1.01') > Cents(100))
+        self.assertEqual(max((Cents(-5), Cents(0))), Cents(0))
+        self.assertEqual(min(Cents(5), Cents(3)), Cents(3))
+        self.assertEqual(hash(Cents(150)), hash(Decimal('1.50')))
+        self.assertFalse(Cents(0))
@@ -0,0 +1,781 @@
+from decimal import Decimal
+from moneycalc.account import FixedDailyInterstRate
+from moneycalc.account import FixedMonthlyInterestRate
+from moneycalc.account import PrimeRate
+from moneycalc.account import VariableDailyInterestRate
+from moneycalc.account import VariableMonthlyInterestRate
+from moneycalc.account import amortized_monthly_payment
+from moneycalc.money import money
+from moneycalc.money import money_from_cents
+from moneycalc.money import money_to_cents
+from moneycalc.tax import TaxEffect
+from moneycalc.tax import income_tax_cents
+import array
+import datetime
+import moneycalc.plan
+import moneycalc.runner
+import moneycalc.sweep
+import moneycalc.time
+import multiprocessing
+import random
+import unittest
+
+class MeanRevertingPrimeRateModel(object):
+    '''
+    A stochastic prime rate which changes once a year.
+
+    Each year, the rate moves towards long_term_yearly_rate by reversion
+    (a fraction between 0 and 1) of the difference, then by a normally
+    distributed shock with standard deviation volatility. With a reversion
+    of 0, the rate is a random walk. Rates are rounded to basis points and
+    never fall below floor_yearly_rate.
+    '''
+    def __init__(self, start_yearly_rate, long_term_yearly_rate, reversion, volatility, start_year, floor_yearly_rate=Decimal('0')):
+        self.start_yearly_rate = start_yearly_rate
+        self.long_term_yearly_rate = long_term_yearly_rate
+        self.reversion = reversion
+        self.volatility = volatility
+        self.start_year = start_year
+        self.floor_yearly_rate = floor_yearly_rate
+
+    def paths(self, count, years, seed):
+        '''
+        Returns count paths, each an array('d') of years yearly rates
+        starting at start_year. The same seed always gives the same paths.
+        '''
+        rng = random.Random(seed)
+        start = float(self.start_yearly_rate)
+        long_term = float(self.long_term_yearly_rate)
+        reversion = float(self.reversion)
+        volatility = float(self.volatility)
+        floor = float(self.floor_yearly_rate)
+        paths = []
+        for _ in range(count):
+            path = array.array('d', [start])
+            rate = start
+            for _ in range(years - 1):
+                rate += reversion * (long_term - rate) + rng.gauss(0.0, volatility)
+                rate = max(floor, round(rate, 4))
+                path.append(rate)
+            paths.append(path)
+        return paths
+
+    def prime_rates(self, count, years, seed):
+        '''
+        Returns the paths of paths() as PathPrimeRate-s.
+        '''
+        return [PathPrimeRate(start_year=self.start_year, yearly_rates=path) for path in self.paths(count=count, years=years, seed=seed)]
+
+class PathPrimeRate(PrimeRate):
+    '''
+    A prime rate which follows a given path of yearly rates, changing every
+    January 1st.
+    '''
+    def __init__(self, start_year, yearly_rates):
+        self.__start_year = start_year
+        # Rates were rounded to basis points, so going through str gives the
+        # exact Decimal rate.
+        self.__yearly_rates = [Decimal(str(rate)).quantize(Decimal('0.0001')) for rate in yearly_rates]
+
+    def describe(self):
+        return ('PathPrimeRate', self.__start_year, tuple(self.__yearly_rates))
+
+    def prime_rate_and_change_date(self, date):
+        index = date.year - self.__start_year
+        if index < 0 or index >= len(self.__yearly_rates):
+            raise NotImplementedError()
+        return (self.__yearly_rates[index], datetime.date(year=date.year + 1, month=1, day=1))
+
+def percentile(sorted_values, percent):
+    '''
+    Returns the nearest-rank percentile of the given sorted values.
+    '''
+    if not sorted_values:
+        raise ValueError('No values')
+    rank = -(-len(sorted_values) * percent // 100)
+    return sorted_values[max(0, min(len(sorted_values), int(rank)) - 1)]
+
+class MonteCarloResult(object):
+    def __init__(self, table):
+        # A moneycalc.sweep.ResultTable with a 'path' parameter column.
+        self.table = table
+
+    @property
+    def failures(self):
+        return sum(1 for error in self.table.columns['error'] if error is not None)
+
+    def percentiles(self, measure_name, percents=(5, 25, 50, 75, 95)):
+        '''
+        Returns a dict mapping each percent to that percentile of the given
+        measure over all paths which completed without error.
+        '''
+        values = sorted(
+            value
+            for (value, error) in zip(self.table.columns[measure_name], self.table.columns['error'])
+            if error is None)
+        return dict((percent, percentile(values, percent)) for percent in percents)
+
+_UNPAID_FINANCE_CHARGE = moneycalc.runner.TaskError(type_name='NotImplementedError', message='Finance charge was not paid within its month')
+_UNDRAWN_BALANCE = moneycalc.runner.TaskError(type_name='NotImplementedError', message='Line of credit owes money outside its draw term')
+_UNKNOWN_PRIME_RATE = moneycalc.runner.TaskError(type_name='NotImplementedError', message='Prime rate path does not cover the year')
+_UNSUPPORTED_LOAN_CHANGE = moneycalc.runner.TaskError(type_name='NotImplementedError', message='Loan cannot be changed like this on this date')
+
+def _scaled_daily_rates(interest_rates, date):
+    '''
+    Returns a tuple of the daily interest rates of the given InterestRate-s
+    on the given date as ints, and the power of 10 which they are scaled by.
+    '''
+    rates = [interest_rate.daily_interest_rate_and_change_date(date)[0] for interest_rate in interest_rates]
+    places = max(max(-rate.as_tuple().exponent, 0) for rate in rates)
+    return ([int(rate.scaleb(places)) for rate in rates], 10 ** places)
+
+class _PathCheckingAccounts(object):
+    '''
+    The CheckingAccount of every path, with balances in cents as a column
+    indexed by path.
+    '''
+    def __init__(self, name, paths):
+        self.name = name
+        self.is_open = True
+        self.balances = [0] * paths.count
+
+    def deposit(self, ordinal, amounts):
+        self.balances = [balance + amount for (balance, amount) in zip(self.balances, amounts)]
+
+    def withdraw(self, ordinal, amounts):
+        self.balances = [balance - amount for (balance, amount) in zip(self.balances, amounts)]
+
+class _PathLinesOfCredit(object):
+    '''
+    The LineOfCreditAccount of every path, with balances and finance charges
+    in cents as columns indexed by path.
+
+    Every path deposits and withdraws on the same dates, so accrual segments
+    are shared, and each segment accrues every path's finance charge at
+    once.
+    '''
+    def __init__(self, name, paths, interest_rates, draw_term):
+        self.name = name
+        self.is_open = True
+        self.__paths = paths
+        # One InterestRate per path, or one for all paths.
+        self.__interest_rates = interest_rates
+        # Maps each year to the _scaled_daily_rates of every path, or None if
+        # the rates are unknown.
+        self.__daily_rates = {}
+        self.__draw_term = (draw_term.start_date.toordinal(), draw_term.end_date.toordinal())
+        count = paths.count
+        self.balances = [0] * count
+        self.period_finance_charges = [0] * count
+        self.due_finance_charges = [0] * count
+        self.__last_update = None
+
+    def deposit(self, ordinal, amounts):
+        self.__update_finance_charges(ordinal)
+        if any(self.due_finance_charges):
+            # Pay the finance charges due before paying the principal.
+            payments = [min(due, amount) for (due, amount) in zip(self.due_finance_charges, amounts)]
+            self.due_finance_charges = [due - payment for (due, payment) in zip(self.due_finance_charges, payments)]
+            self.__paths.pay_interest(ordinal, payments)
+            amounts = [amount - payment for (amount, payment) in zip(amounts, payments)]
+        self.balances = [balance + amount for (balance, amount) in zip(self.balances, amounts)]
+        self.__last_update = ordinal
+
+    def withdraw(self, ordinal, amounts):
+        self.__update_finance_charges(ordinal)
+        self.balances = [balance - amount for (balance, amount) in zip(self.balances, amounts)]
+        self.__last_update = ordinal
+
+    def __year_daily_rates(self, year):
+        try:
+            return self.__daily_rates[year]
+        except KeyError:
+            pass
+        try:
+            (rates, scale) = _scaled_daily_rates(self.__interest_rates, datetime.date(year, 1, 1))
+            if len(rates) == 1:
+                rates = rates * self.__paths.count
+            daily_rates = (rates, scale)
+        except NotImplementedError:
+            daily_rates = None
+        self.__daily_rates[year] = daily_rates
+        return daily_rates
+
+    def __update_finance_charges(self, ordinal):
+        '''
+        Like LineOfCreditAccount.__update_finance_charge, for every path.
+        '''
+        now = self.__last_update
+        if now is None:
+            return
+        paths = self.__paths
+        (draw_start, draw_end) = self.__draw_term
+        while now < ordinal:
+            date = datetime.date.fromordinal(now)
+            if date.day == 1:
+                # Like LineOfCreditAccount, this only checks that charges
+                # are paid by the end of the next month, not within the
+                # payment window.
+                if any(self.due_finance_charges):
+                    paths.fail([due != 0 for due in self.due_finance_charges], _UNPAID_FINANCE_CHARGE)
+                self.due_finance_charges = self.period_finance_charges
+                self.period_finance_charges = [0] * paths.count
+            segment_end = min(ordinal, moneycalc.time.ordinal_next_month_start(now))
+            if min(self.balances) < 0:
+                daily_rates = None
+                if not draw_start <= now < draw_end:
+                    paths.fail([balance < 0 for balance in self.balances], _UNDRAWN_BALANCE)
+                else:
+                    daily_rates = self.__year_daily_rates(date.year)
+                    if daily_rates is None:
+                        paths.fail([balance < 0 for balance in self.balances], _UNKNOWN_PRIME_RATE)
+                if daily_rates is not None:
+                    # Daily rates change every January 1st.
+                    segment_end = min(segment_end, datetime.date(date.year + 1, 1, 1).toordinal(), draw_end)
+                    days = segment_end - now
+                    (rates, scale) = daily_rates
+                    half = scale // 2
+                    # Each day accrues the same finance charge, rounded half
+                    # up to the cent like money().
+                    self.period_finance_charges = [
+                        charge + (rate * -balance + half) // scale * days if balance < 0 else charge
+                        for (charge, balance, rate) in zip(self.period_finance_charges, self.balances, rates)
+                    ]
+            now = segment_end
+        self.__last_update = ordinal
+
+class _PathAmortizedLoans(object):
+    '''
+    The AmortizedMonthlyLoan of every path, with balances in cents as a
+    column indexed by path. The loan opens on every path at once.
+
+    Payments (and so balances) differ between paths only if their interest
+    rates do, so each month's payment and interest are computed once per
+    distinct (rate, balance).
+    '''
+    def __init__(self, name, paths, interest_rates, amount, term):
+        self.name = name
+        self.__paths = paths
+        # One InterestRate per path, or one for all paths.
+        self.__interest_rates = interest_rates
+        self.__amount = amount
+        self.__term = term
+        self.is_open = False
+        self.balances = [0] * paths.count
+        # Per remaining month: the period interest rate of every path.
+        self.__monthly_rates = None
+        self.__next_payment_due = None
+        # Maps (interest rate, balance cents, months remaining) to (minimum
+        # payment, interest, payoff payment) in cents.
+        self.__payments = {}
+
+    def open(self, ordinal):
+        '''
+        Like creating the AmortizedMonthlyLoan and computing its schedule,
+        which needs the interest rate of every month of the term.
+        '''
+        paths = self.__paths
+        if self.is_open:
+            paths.fail([True] * paths.count, _UNSUPPORTED_LOAN_CHANGE)
+            return
+        term = self.__term
+        try:
+            months = moneycalc.time.diff_months(term.end_date, term.start_date)
+            monthly_rates = []
+            date = term.start_date
+            for _ in range(months):
+                next_date = moneycalc.time.add_month(date)
+                period = moneycalc.time.Period(date, next_date)
+                rates = [interest_rate.period_interest_rate(period) for interest_rate in self.__interest_rates]
+                monthly_rates.append(rates * paths.count if len(rates) == 1 else rates)
+                date = next_date
+        except NotImplementedError:
+            paths.fail([True] * paths.count, _UNKNOWN_PRIME_RATE)
+            return
+        self.__monthly_rates = monthly_rates
+        # Monthly rates are popped from the end.
+        monthly_rates.reverse()
+        self.__next_payment_due = term.start_date.toordinal()
+        self.balances = [self.__amount] * paths.count
+        self.is_open = True
+
+    def __due_payments(self, ordinal):
+        '''
+        Returns a column of (minimum payment, interest, payoff payment) in
+        cents for the payment due at the given date, or None (after failing
+        every path) if no payment is due.
+        '''
+        if not self.is_open or ordinal != self.__next_payment_due or not self.__monthly_rates:
+            self.__paths.fail([True] * self.__paths.count, _UNSUPPORTED_LOAN_CHANGE)
+            return None
+        months_remaining = len(self.__monthly_rates)
+        payments = self.__payments
+        due = []
+        for (rate, balance) in zip(self.__monthly_rates[-1], self.balances):
+            key = (rate, balance, months_remaining)
+            amounts = payments.get(key)
+            if amounts is None:
+                balance_amount = money_from_cents(balance)
+                interest = money(rate * balance_amount)
+                amounts = (
+                    money_to_cents(amortized_monthly_payment(balance_amount, rate, months_remaining)),
+                    money_to_cents(interest),
+                    money_to_cents(money(interest + balance_amount)),
+                )
+                payments[key] = amounts
+            due.append(amounts)
+        return due
+
+    def loan_payments(self, ordinal, extra_cents):
+        '''
+        Returns a column of the payment at the given date of every path: the
+        minimum payment plus extra_cents, but not more than pays the loan
+        off. Returns None if no payment is due.
+        '''
+        due = self.__due_payments(ordinal)
+        if due is None:
+            return None
+        if extra_cents:
+            return [min(minimum + extra_cents, payoff) for (minimum, _interest, payoff) in due]
+        return [minimum for (minimum, _interest, _payoff) in due]
+
+    def deposit(self, ordinal, amounts):
+        '''
+        Like AmortizedMonthlyLoan.deposit, for every path.
+        '''
+        paths = self.__paths
+        due = self.__due_payments(ordinal)
+        if due is None:
+            return
+        interests = [interest for (_minimum, interest, _payoff) in due]
+        principals = [amount - interest for (amount, interest) in zip(amounts, interests)]
+        unsupported = [amount < interest or principal > balance for (amount, interest, principal, balance) in zip(amounts, interests, principals, self.balances)]
+        if any(unsupported):
+            paths.fail(unsupported, _UNSUPPORTED_LOAN_CHANGE)
+        paths.pay_interest(ordinal, interests)
+        self.balances = [balance - principal for (balance, principal) in zip(self.balances, principals)]
+        self.__monthly_rates.pop()
+        self.__next_payment_due = moneycalc.time.add_month(datetime.date.fromordinal(ordinal)).toordinal()
+
+    def withdraw(self, ordinal, amounts):
+        # AmortizedMonthlyLoan-s cannot be withdrawn from.
+        self.__paths.fail([True] * self.__paths.count, _UNSUPPORTED_LOAN_CHANGE)
+
+class _Paths(object):
+    '''
+    Runs a moneycalc.plan.Plan for many prime rate paths at once.
+
+    Amounts which are the same on every path (such as salaries and
+    expenses) are computed once. Balances, finance charges, interest and
+    taxes, which depend on each path's prime rate, are columns indexed by
+    path.
+    '''
+    def __init__(self, plan, spec, prime_rates):
+        self.plan = plan
+        self.count = len(prime_rates)
+        # Per path: a moneycalc.runner.TaskError if the path stopped early,
+        # or None.
+        self.errors = [None] * self.count
+        self.interest = [0] * self.count
+        self.__accounts = [
+            self.__make_accounts(account_spec, parameters, prime_rates)
+            for (account_spec, (_account_type, parameters)) in zip(spec['accounts'], plan.accounts)
+        ]
+        # Maps each year to its [taxable cash income, withheld cash,
+        # deductible] in cents on every path.
+        self.__tax_totals = {}
+        # Maps each year to the deductible cents of each path on top of the
+        # year's shared deductible cents.
+        self.__path_deductibles = {}
+        # Maps INCOME arguments to (taxable cents, withheld cents, net cents).
+        self.__incomes = {}
+        self.__dispatch = {
+            moneycalc.plan.Opcode.YEAR_SUMMARY: self.__year_summary,
+            moneycalc.plan.Opcode.OPEN_LOAN: self.__open_loan,
+            moneycalc.plan.Opcode.DEPOSIT: self.__deposit,
+            moneycalc.plan.Opcode.WITHDRAW: self.__withdraw,
+            moneycalc.plan.Opcode.INCOME: self.__income,
+            moneycalc.plan.Opcode.TAX_PAYMENT: self.__tax_payment,
+            moneycalc.plan.Opcode.LOAN_PAYMENT: self.__loan_payment,
+        }
+        for opcode in set(plan.opcodes):
+            if opcode not in self.__dispatch:
+                raise moneycalc.plan.SpecError('Opcode {} cannot be simulated over paths'.format(opcode))
+
+    def __make_accounts(self, spec, parameters, prime_rates):
+        if spec['type'] == 'checking':
+            return _PathCheckingAccounts(name=spec['name'], paths=self)
+        if spec['type'] == 'line_of_credit':
+            rate_type = spec['interest_rate']['type']
+            if rate_type == 'variable_daily':
+                interest_rates = [VariableDailyInterestRate(prime_rate=prime_rate) for prime_rate in prime_rates]
+            elif rate_type == 'fixed_daily':
+                interest_rates = [FixedDailyInterstRate(yearly_rate=Decimal(spec['interest_rate']['yearly_rate']))]
+            else:
+                raise moneycalc.plan.SpecError('Interest rate type {} cannot be simulated over paths'.format(rate_type))
+            return _PathLinesOfCredit(
+                name=spec['name'],
+                paths=self,
+                interest_rates=interest_rates,
+                # Owing money during the repayment term is not implemented,
+                # so only the draw term matters.
+                draw_term=parameters['draw_term'],
+            )
+        if spec['type'] == 'amortized_loan':
+            rate_type = spec['interest_rate']['type']
+            if rate_type == 'variable_monthly':
+                interest_rates = [VariableMonthlyInterestRate(prime_rate=prime_rate) for prime_rate in prime_rates]
+            elif rate_type == 'fixed_monthly':
+                interest_rates = [FixedMonthlyInterestRate(yearly_rate=Decimal(spec['interest_rate']['yearly_rate']))]
+            else:
+                raise moneycalc.plan.SpecError('Interest rate type {} cannot be simulated over paths'.format(rate_type))
+            return _PathAmortizedLoans(
+                name=spec['name'],
+                paths=self,
+                interest_rates=interest_rates,
+                amount=parameters['amount'],
+                term=parameters['term'],
+            )
+        raise moneycalc.plan.SpecError('Account type {} cannot be simulated over paths'.format(spec['type']))
+
+    def run(self):
+        plan = self.plan
+        ordinals = plan.ordinals
+        opcodes = plan.opcodes
+        operands = plan.operands
+        arguments = plan.arguments
+        dispatch = self.__dispatch
+        for index in range(len(ordinals)):
+            dispatch[opcodes[index]](ordinals[index], arguments[operands[index]])
+
+    def measures(self):
+        '''
+        Returns a dict mapping each measure name (like
+        moneycalc.sweep.measure_scenario_result's) to a column of cents
+        indexed by path.
+        '''
+        total_taxes = [0] * self.count
+        for year in range(self.plan.start_date.year, self.plan.end_date.year):
+            total_taxes = [total + tax for (total, tax) in zip(total_taxes, self.__taxes(year))]
+        measures = {
+            'total_interest': self.interest,
+            'total_tax': total_taxes,
+        }
+        for account in self.__accounts:
+            if account.is_open:
+                measures['end_balance:{}'.format(account.name)] = account.balances
+        return measures
+
+    def fail(self, failed, error):
+        '''
+        Stops each path whose item in failed is true with the given
+        moneycalc.runner.TaskError (unless the path already stopped).
+        '''
+        errors = self.errors
+        for (path, path_failed) in enumerate(failed):
+            if path_failed and errors[path] is None:
+                errors[path] = error
+
+    def pay_interest(self, ordinal, payments):
+        year = datetime.date.fromordinal(ordinal).year
+        self.interest = [interest + payment for (interest, payment) in zip(self.interest, payments)]
+        self.__add_path_deductibles(year, payments)
+
+    def __add_path_deductibles(self, year, amounts):
+        deductibles = self.__path_deductibles.get(year)
+        if deductibles is None:
+            self.__path_deductibles[year] = list(amounts)
+        else:
+            self.__path_deductibles[year] = [deductible + amount for (deductible, amount) in zip(deductibles, amounts)]
+
+    def __add_tax(self, ordinal, cents, tax_effect):
+        '''
+        Like moneycalc.tax.TaxLedger.add, for an event on every path.
+        '''
+        if tax_effect == TaxEffect.NONE:
+            return
+        year = datetime.date.fromordinal(ordinal).year
+        totals = self.__tax_totals.setdefault(year, [0, 0, 0])
+        if tax_effect == TaxEffect.CASH_INCOME:
+            totals[0] += cents
+        elif tax_effect == TaxEffect.CASH_WITHHELD:
+            totals[1] += -cents
+        elif tax_effect == TaxEffect.DEDUCTIBLE:
+            totals[2] += abs(cents)
+        else:
+            raise ValueError('Unknown tax effect: {}'.format(tax_effect))
+
+    def __taxes(self, year):
+        '''
+        Returns a column of each path's tax in cents for the given year,
+        like moneycalc.tax.TaxLedger.tax.
+        '''
+        (income, _withheld, deductible) = self.__tax_totals.get(year, [0, 0, 0])
+        path_deductibles = self.__path_deductibles.get(year)
+        if path_deductibles is None:
+            return list(income_tax_cents(year, [max(income - deductible, 0)])) * self.count
+        return income_tax_cents(year, [max(income - deductible - path_deductible, 0) for path_deductible in path_deductibles])
+
+    def __year_summary(self, ordinal, arguments):
+        pass
+
+    def __open_loan(self, ordinal, arguments):
+        (account_index,) = arguments
+        self.__accounts[account_index].open(ordinal)
+
+    def __loan_payment(self, ordinal, arguments):
+        (from_index, to_index, extra_cents, _description) = arguments
+        loan = self.__accounts[to_index]
+        payments = loan.loan_payments(ordinal, extra_cents)
+        if payments is None:
+            return
+        self.__accounts[from_index].withdraw(ordinal, payments)
+        loan.deposit(ordinal, payments)
+
+    def __deposit(self, ordinal, arguments):
+        (account_index, cents, _description) = arguments
+        self.__accounts[account_index].deposit(ordinal, [cents] * self.count)
+
+    def __withdraw(self, ordinal, arguments):
+        (account_index, cents, _description, tax_effect) = arguments
+        self.__accounts[account_index].withdraw(ordinal, [cents] * self.count)
+        self.__add_tax(ordinal, -cents, tax_effect)
+
+    def __income(self, ordinal, arguments):
+        amounts = self.__incomes.get(arguments)
+        if amounts is None:
+            (_account_index, cents, _description, withholdings, other_taxes) = arguments
+            taxable_income = money_from_cents(cents)
+            withheld = sum(money_to_cents(money(taxable_income * rate)) for (_withholding_description, rate) in withholdings)
+            other_tax = sum(money_to_cents(money(taxable_income * rate)) for rate in other_taxes)
+            amounts = (cents, withheld, cents - withheld - other_tax)
+            self.__incomes[arguments] = amounts
+        (taxable_cents, withheld_cents, net_cents) = amounts
+        self.__add_tax(ordinal, -withheld_cents, TaxEffect.CASH_WITHHELD)
+        self.__add_tax(ordinal, taxable_cents, TaxEffect.CASH_INCOME)
+        self.__accounts[arguments[0]].deposit(ordinal, [net_cents] * self.count)
+
+    def __tax_payment(self, ordinal, arguments):
+        (account_index,) = arguments
+        account = self.__accounts[account_index]
+        year = datetime.date.fromordinal(ordinal).year
+        (_income, withheld, _deductible) = self.__tax_totals.get(year - 1, [0, 0, 0])
+        dues = [tax - withheld for tax in self.__taxes(year - 1)]
+        # Each path is either refunded or pays; the other amount is 0.
+        account.deposit(ordinal, [-due if due < 0 else 0 for due in dues])
+        payments = [due if due > 0 else 0 for due in dues]
+        account.withdraw(ordinal, payments)
+        self.__add_path_deductibles(year, payments)
+
+def _simulate_paths(task):
+    (spec, start_year, paths) = task
+    prime_rates = [PathPrimeRate(start_year=start_year, yearly_rates=path) for path in paths]
+    plan_paths = _Paths(moneycalc.plan.compile_spec(spec), spec, prime_rates)
+    plan_paths.run()
+    return (plan_paths.measures(), plan_paths.errors)
+
+def simulate(spec, model, count, seed, processes=None):
+    '''
+    Plays a scenario spec (see moneycalc.plan) for count prime rate paths
+    of the given model and returns a MonteCarloResult.
+
+    Every 'variable_daily' line of credit and 'variable_monthly' amortized
+    loan follows each path's prime rate instead of the spec's. Checking
+    accounts, daily-rate lines of credit and monthly-rate amortized loans
+    are supported.
+
+    All paths are played together (see _Paths), and they are split across
+    processes with moneycalc.runner.run_tasks.
+    '''
+    plan = moneycalc.plan.compile_spec(spec)
+    # Fail early on unsupported specs.
+    _Paths(plan, spec, prime_rates=[])
+    years = plan.end_date.year - model.start_year + 1
+    paths = model.paths(count=count, years=years, seed=seed)
+    if processes is None:
+        processes = multiprocessing.cpu_count()
+    chunk_size = max(1, -(-count // processes))
+    chunks = [paths[i:i + chunk_size] for i in range(0, count, chunk_size)]
+    tasks = [(spec, model.start_year, chunk) for chunk in chunks]
+    if processes == 1:
+        chunk_results = [moneycalc.runner.TaskResult(index=index, value=_simulate_paths(task)) for (index, task) in enumerate(tasks)]
+    else:
+        chunk_results = moneycalc.runner.run_tasks(func=_simulate_paths, args=tasks, processes=processes)
+
+    measure_names = None
+    rows = []
+    for (chunk, chunk_result) in zip(chunks, chunk_results):
+        if chunk_result.ok:
+            (measures, errors) = chunk_result.value
+            measure_names = sorted(measures)
+            for (index, error) in enumerate(errors):
+                if error is None:
+                    rows.append((dict((name, money_from_cents(measures[name][index])) for name in measure_names), None))
+                else:
+                    rows.append(({}, error))
+        else:
+            rows.extend(({}, chunk_result.error) for _path in chunk)
+    table = moneycalc.sweep.ResultTable(parameter_names=['path'], measure_names=measure_names or [])
+    for (path, (measures, error)) in enumerate(rows):
+        values = dict(measures)
+        values['path'] = path
+        values['error'] = error
+        table.append_row(values)
+    return MonteCarloResult(table=table)
+
+class TestMonteCarlo(unittest.TestCase):
+    def make_model(self, reversion):
+        return MeanRevertingPrimeRateModel(
+            start_yearly_rate=Decimal('0.0425'),
+            long_term_yearly_rate=Decimal('0.05'),
+            reversion=Decimal(reversion),
+            volatility=Decimal('0.005'),
+            start_year=2017,
+        )
+
+    def test_paths_are_seeded(self):
+        model = self.make_model('0.2')
+        self.assertEqual(model.paths(count=3, years=10, seed=42), model.paths(count=3, years=10, seed=42))
+        self.assertNotEqual(model.paths(count=3, years=10, seed=42), model.paths(count=3, years=10, seed=43))
+
+    def test_path_prime_rate_steps_yearly(self):
+        prime_rate = PathPrimeRate(start_year=2017, yearly_rates=[0.0425, 0.0475])
+        self.assertEqual(prime_rate.prime_rate_and_change_date(datetime.date(2017, 3, 4)), (Decimal('0.0425'), datetime.date(2018, 1, 1)))
+        self.assertEqual(prime_rate.prime_rate_and_change_date(datetime.date(2018, 12, 31)), (Decimal('0.0475'), datetime.date(2019, 1, 1)))
+        with self.assertRaises(NotImplementedError):
+            prime_rate.prime_rate_and_change_date(datetime.date(2019, 1, 1))
+
+    def test_percentile(self):
+        values = list(range(1, 101))
+        self.assertEqual(percentile(values, 50), 50)
+        self.assertEqual(percentile(values, 95), 95)
+        self.assertEqual(percentile(values, 100), 100)
+        self.assertEqual(percentile([7], 5), 7)
+
+    def make_spec(self, draw_end_date='2020-01-01'):
+        loc = 'HELOC'
+        return {
+            'name': 'Example',
+            'start_date': '2017-01-01',
+            'end_date': '2019-12-31',
+            'accounts': [
+                {'type': 'checking', 'name': 'Checking'},
+                {
+                    'type': 'line_of_credit',
+                    'name': loc,
+                    'interest_rate': {'type': 'variable_daily', 'prime_rate': {'type': 'yearly_stepping', 'start_yearly_rate': '0.0425', 'start_year': 2017, 'yearly_increase': '0.005'}},
+                    'draw_term': ['2017-01-01', draw_end_date],
+                    'repayment_term': [draw_end_date, '2020-01-01'],
+                },
+            ],
+            'events': [
+                {'category': 'purchase', 'when': {'rule': 'once', 'date': '2017-01-01'}, 'action': {'type': 'withdraw', 'account': loc, 'amount': '300000.00', 'description': 'Purchase'}},
+                {'category': 'tax payment', 'when': {'rule': 'on_day_of_months', 'day': 1, 'months': [4]}, 'action': {'type': 'tax_payment', 'account': loc}},
+                {'category': 'salary', 'when': {'rule': 'every_n_days', 'first_date': '2017-01-06', 'days': 14}, 'action': {'type': 'income', 'account': loc, 'amount': '7553.31', 'description': 'Salary', 'withholdings': [['US tax', 0.215]], 'other_taxes': [0.15]}},
+                {'category': 'expenses', 'when': {'rule': 'on_day_of_months', 'day': 15, 'months': list(range(1, 13))}, 'action': {'type': 'withdraw', 'account': loc, 'amount': '1873.61', 'description': 'Expenses'}},
+                {'category': 'property tax', 'when': {'rule': 'on_day_of_months', 'day': 10, 'months': [4, 12]}, 'action': {'type': 'withdraw', 'account': loc, 'amount': '4440.00', 'description': 'Property tax', 'tax_effect': TaxEffect.DEDUCTIBLE}},
+                {'category': 'savings', 'when': {'rule': 'on_day_of_months', 'day': 20, 'months': list(range(1, 13))}, 'action': {'type': 'deposit', 'account': 'Checking', 'amount': '100.00', 'description': 'Savings'}},
+            ],
+        }
+
+    def execute_path(self, spec, yearly_rates):
+        '''
+        Runs spec with a moneycalc.plan.Execution, with every variable rate
+        account following the given prime rate path.
+        '''
+        plan = moneycalc.plan.compile_spec(spec)
+        prime_rate = PathPrimeRate(start_year=2017, yearly_rates=yearly_rates)
+        variable_rate_classes = {'variable_daily': VariableDailyInterestRate, 'variable_monthly': VariableMonthlyInterestRate}
+        for (index, account_spec) in enumerate(spec['accounts']):
+            rate_class = variable_rate_classes.get(account_spec.get('interest_rate', {}).get('type'))
+            if rate_class is not None:
+                (account_type, parameters) = plan.accounts[index]
+                plan.accounts[index] = (account_type, dict(parameters, interest_rate=rate_class(prime_rate=prime_rate)))
+        execution = plan.execute()
+        result = {
+            'total_interest': execution.timeline.total_interest,
+            'total_tax': sum((execution.timeline.tax_ledger.tax(year) for year in [2017, 2018]), money(0)),
+            'error': execution.error,
+        }
+        for account in execution.accounts:
+            result['end_balance:{}'.format(account)] = account.balance
+        return result
+
+    def test_simulated_paths_match_executed_plans(self):
+        model = self.make_model('0.2')
+        spec = self.make_spec()
+        result = simulate(spec, model, count=6, seed=3, processes=1)
+        self.assertEqual(result.failures, 0)
+        paths = model.paths(count=6, years=3, seed=3)
+        self.assertEqual(len(result.table), len(paths))
+        for (row, path) in zip(result.table.rows(), paths):
+            expected = self.execute_path(spec, path)
+            self.assertIsNone(expected.pop('error'))
+            self.assertGreater(expected['total_interest'], 0)
+            self.assertEqual(dict((name, row[name]) for name in expected), expected)
+
+    def test_simulated_loans_match_executed_plans(self):
+        model = self.make_model('0.2')
+        spec = self.make_spec()
+        spec['accounts'].append({
+            'type': 'amortized_loan',
+            'name': 'Car loan',
+            'amount': '30000.00',
+            'interest_rate': {'type': 'variable_monthly', 'prime_rate': {'type': 'yearly_stepping', 'start_yearly_rate': '0.0425', 'start_year': 2017, 'yearly_increase': '0.005'}},
+            'term': ['2017-02-01', '2020-01-01'],
+        })
+        spec['events'].extend([
+            {'category': 'car', 'when': {'rule': 'once', 'date': '2017-01-20'}, 'action': {'type': 'open_loan', 'account': 'Car loan'}},
+            {'category': 'car payment', 'when': {'rule': 'on_day_of_months', 'day': 1, 'months': list(range(1, 13)), 'within': ['2017-02-01', '2020-01-01']}, 'action': {'type': 'loan_payment', 'from_account': 'HELOC', 'to_account': 'Car loan', 'extra': '150.00', 'description': 'Car payment'}},
+        ])
+        result = simulate(spec, model, count=6, seed=3, processes=1)
+        self.assertEqual(result.failures, 0)
+        paths = model.paths(count=6, years=3, seed=3)
+        for (row, path) in zip(result.table.rows(), paths):
+            expected = self.execute_path(spec, path)
+            self.assertIsNone(expected.pop('error'))
+            self.assertEqual(dict((name, row[name]) for name in expected), expected)
+        self.assertTrue(all(balance == 0 for balance in result.table.columns['end_balance:Car loan']))
+
+        # The car loan's rates after 2019 are unknown, like Execution, every
+        # path fails when it opens.
+        spec['accounts'][-1]['term'] = ['2017-02-01', '2022-02-01']
+        result = simulate(spec, model, count=2, seed=3, processes=1)
+        self.assertEqual(result.failures, 2)
+        self.assertIsNotNone(self.execute_path(spec, model.paths(count=1, years=3, seed=3)[0])['error'])
+
+    def test_paths_fail_independently(self):
+        # Paths with higher rates still owe money when the draw term ends.
+        model = MeanRevertingPrimeRateModel(
+            start_yearly_rate=Decimal('0.0425'),
+            long_term_yearly_rate=Decimal('0.0425'),
+            reversion=Decimal('0'),
+            volatility=Decimal('0.05'),
+            start_year=2017,
+        )
+        spec = self.make_spec(draw_end_date='2019-06-01')
+        spec['events'][0]['action']['amount'] = '193000.00'
+        result = simulate(spec, model, count=20, seed=1, processes=1)
+        paths = model.paths(count=20, years=3, seed=1)
+        for (row, path) in zip(result.table.rows(), paths):
+            expected = self.execute_path(spec, path)
+            if expected['error'] is None:
+                self.assertIsNone(row['error'])
+                self.assertEqual(row['total_interest'], expected['total_interest'])
+            else:
+                self.assertEqual(row['error'].type_name, 'NotImplementedError')
+        self.assertTrue(0 < result.failures < 20)
+
+    def test_simulate_reports_percentiles_over_paths(self):
+        model = self.make_model('1')
+        result = simulate(self.make_spec(), model, count=20, seed=1, processes=2)
+        self.assertEqual(result.failures, 0)
+        self.assertEqual(list(result.table.columns['path']), list(range(20)))
+        percentiles = result.percentiles('total_interest', percents=(0, 50, 100))
+        self.assertTrue(percentiles[0] <= percentiles[50] <= percentiles[100])
+
+    def test_unsupported_specs_are_errors(self):
+        spec = self.make_spec()
+        spec['accounts'][1]['interest_rate'] = {'type': 'fixed_monthly', 'yearly_rate': '0.05'}
+        with self.assertRaises(moneycalc.plan.SpecError):
+            simulate(spec, self.make_model('1'), count=2, seed=1, processes=1)
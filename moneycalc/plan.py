@@ -0,0 +1,480 @@
+from __future__ import absolute_import
+
+from decimal import Decimal
+from moneycalc.money import money
+from moneycalc.money import money_from_cents
+from moneycalc.money import money_to_cents
+from moneycalc.tax import TaxEffect
+from moneycalc.time import Period
+import array
+import datetime
+import json
+import moneycalc.account
+import moneycalc.curve
+import moneycalc.runner
+import moneycalc.time
+import moneycalc.timeline
+import unittest
+
+# A scenario spec is made of plain dicts, lists, strings and numbers, so it
+# can be written as JSON and sent to other processes cheaply:
+#
+#   {
+#     'name': 'Example',
+#     'start_date': '2017-01-01',
+#     'end_date': '2047-01-01',       # Inclusive.
+#     'accounts': [ACCOUNT, ...],
+#     'events': [EVENT, ...],
+#   }
+#
+# Dates are ISO 8601 strings. Money amounts are strings (e.g. '1873.61').
+# Rates are strings or numbers, and are converted with Decimal, so a number
+# such as 0.215 means Decimal(0.215), not Decimal('0.215').
+#
+# ACCOUNT is one of:
+#
+# * {'type': 'checking', 'name': ...}
+# * {'type': 'line_of_credit', 'name': ..., 'interest_rate': RATE,
+#   'draw_term': [start, end], 'repayment_term': [start, end]}
+# * {'type': 'amortized_loan', 'name': ..., 'amount': ...,
+#   'interest_rate': RATE, 'term': [start, end]}, which only exists after
+#   an 'open_loan' action opens it.
+#
+# RATE is {'type': 'fixed_daily' or 'fixed_monthly', 'yearly_rate': ...} or
+# {'type': 'variable_daily' or 'variable_monthly', 'prime_rate': PRIME_RATE}.
+# PRIME_RATE is {'type': 'yearly_stepping', 'start_yearly_rate': ...,
+# 'start_year': ..., 'yearly_increase': ...}.
+#
+# EVENT is {'category': ..., 'when': WHEN, 'action': ACTION}. Events on the
+# same date happen in the order they are listed. WHEN is one of (each with
+# an optional 'within': [start, end]):
+#
+# * {'rule': 'once', 'date': ...}
+# * {'rule': 'every_n_days', 'first_date': ..., 'days': ...}
+# * {'rule': 'on_day_of_months', 'day': ..., 'months': [...]}
+#
+# ACTION is one of:
+#
+# * {'type': 'year_summary'}: summarizes every account for the previous
+#   year.
+# * {'type': 'open_loan', 'account': ...}
+# * {'type': 'deposit', 'account': ..., 'amount': ..., 'description': ...}
+# * {'type': 'withdraw', 'account': ..., 'amount': ..., 'description': ...,
+#   'tax_effect': ...}, where tax_effect (a TaxEffect) is optional.
+# * {'type': 'income', 'account': ..., 'amount': ..., 'description': ...,
+#   'withholdings': [[name, rate], ...], 'other_taxes': [rate, ...]}:
+#   receives a gross salary, withholding each withholding as
+#   '<description> (withheld <name>)' and depositing what is left after
+#   withholdings and other taxes.
+# * {'type': 'tax_payment', 'account': ...}: pays (or is refunded) the
+#   previous year's tax due.
+# * {'type': 'loan_payment', 'from_account': ..., 'to_account': ...,
+#   'extra': ..., 'description': ...}: transfers a loan's minimum payment
+#   plus extra (but not more than pays the loan off).
+
+class Opcode(object):
+    # Indexes into Execution's dispatch table.
+    YEAR_SUMMARY = 0
+    OPEN_LOAN = 1
+    DEPOSIT = 2
+    WITHDRAW = 3
+    INCOME = 4
+    TAX_PAYMENT = 5
+    LOAN_PAYMENT = 6
+
+class SpecError(ValueError):
+    pass
+
+def _date(value):
+    return datetime.datetime.strptime(value, '%Y-%m-%d').date()
+
+def _period(value):
+    (start_date, end_date) = value
+    return Period(_date(start_date), _date(end_date))
+
+def _cents(value):
+    return money_to_cents(money(value))
+
+def describe_rule(rule):
+    '''
+    Returns the WHEN spec of a moneycalc.time.RecurrenceRule.
+    '''
+    if isinstance(rule, moneycalc.time.Within):
+        when = describe_rule(rule.rule)
+        when['within'] = [rule.period.start_date.isoformat(), rule.period.end_date.isoformat()]
+        return when
+    if isinstance(rule, moneycalc.time.Once):
+        return {'rule': 'once', 'date': rule.date.isoformat()}
+    if isinstance(rule, moneycalc.time.EveryNDays):
+        return {'rule': 'every_n_days', 'first_date': rule.first_date.isoformat(), 'days': rule.days}
+    if isinstance(rule, moneycalc.time.OnDayOfMonths):
+        return {'rule': 'on_day_of_months', 'day': rule.day, 'months': list(rule.months)}
+    raise SpecError('Cannot describe rule: {!r}'.format(rule))
+
+def _compile_rule(when):
+    rule_type = when['rule']
+    if rule_type == 'once':
+        rule = moneycalc.time.Once(_date(when['date']))
+    elif rule_type == 'every_n_days':
+        rule = moneycalc.time.EveryNDays(first_date=_date(when['first_date']), days=when['days'])
+    elif rule_type == 'on_day_of_months':
+        rule = moneycalc.time.OnDayOfMonths(day=when['day'], months=when['months'])
+    else:
+        raise SpecError('Unknown rule: {}'.format(rule_type))
+    if 'within' in when:
+        rule = moneycalc.time.Within(rule, _period(when['within']))
+    return rule
+
+def _compile_prime_rate(spec):
+    if spec['type'] == 'yearly_stepping':
+        return moneycalc.curve.CachedPrimeRate(moneycalc.account.YearlySteppingPrimeRate(
+            start_yearly_rate=Decimal(spec['start_yearly_rate']),
+            start_year=spec['start_year'],
+            yearly_increase=Decimal(spec['yearly_increase']),
+        ))
+    raise SpecError('Unknown prime rate type: {}'.format(spec['type']))
+
+def _compile_interest_rate(spec):
+    rate_type = spec['type']
+    if rate_type == 'fixed_daily':
+        interest_rate = moneycalc.account.FixedDailyInterstRate(yearly_rate=Decimal(spec['yearly_rate']))
+    elif rate_type == 'fixed_monthly':
+        interest_rate = moneycalc.account.FixedMonthlyInterestRate(yearly_rate=Decimal(spec['yearly_rate']))
+    elif rate_type == 'variable_daily':
+        interest_rate = moneycalc.account.VariableDailyInterestRate(prime_rate=_compile_prime_rate(spec['prime_rate']))
+    elif rate_type == 'variable_monthly':
+        interest_rate = moneycalc.account.VariableMonthlyInterestRate(prime_rate=_compile_prime_rate(spec['prime_rate']))
+    else:
+        raise SpecError('Unknown interest rate type: {}'.format(rate_type))
+    return moneycalc.curve.InterestRateCurve(interest_rate)
+
+_ACCOUNT_CLASSES = {
+    'checking': moneycalc.account.CheckingAccount,
+    'line_of_credit': moneycalc.account.LineOfCreditAccount,
+    'amortized_loan': moneycalc.account.AmortizedMonthlyLoan,
+}
+
+def _compile_account(spec):
+    '''
+    Returns a tuple of the account's type and the parameters for
+    _make_account.
+    '''
+    account_type = spec['type']
+    parameters = {'name': spec['name']}
+    if account_type == 'checking':
+        pass
+    elif account_type == 'line_of_credit':
+        parameters['interest_rate'] = _compile_interest_rate(spec['interest_rate'])
+        parameters['draw_term'] = _period(spec['draw_term'])
+        parameters['repayment_term'] = _period(spec['repayment_term'])
+    elif account_type == 'amortized_loan':
+        # In cents, so the amount follows the money representation of each
+        # execution.
+        parameters['amount'] = _cents(spec['amount'])
+        parameters['interest_rate'] = _compile_interest_rate(spec['interest_rate'])
+        parameters['term'] = _period(spec['term'])
+    else:
+        raise SpecError('Unknown account type: {}'.format(account_type))
+    return (account_type, parameters)
+
+def _make_account(account_type, parameters):
+    if 'amount' in parameters:
+        parameters = dict(parameters, amount=money_from_cents(parameters['amount']))
+    return _ACCOUNT_CLASSES[account_type](**parameters)
+
+class Plan(object):
+    '''
+    A scenario spec compiled into a flat, sorted list of events.
+
+    Event i happens on date ordinals[i] and runs the action with opcode
+    opcodes[i] and arguments arguments[operands[i]].
+    '''
+    def __init__(self, name, start_date, end_date, accounts, ordinals, opcodes, operands, arguments, categories):
+        self.name = name
+        self.start_date = start_date
+        self.end_date = end_date
+        # List of (account type, parameters) pairs. Amortized loans open with
+        # an OPEN_LOAN event; other accounts are open from the start.
+        self.accounts = accounts
+        self.ordinals = ordinals
+        self.opcodes = opcodes
+        self.operands = operands
+        self.arguments = arguments
+        # Per operand: the category of the event's spec.
+        self.categories = categories
+
+    def __len__(self):
+        return len(self.ordinals)
+
+    def execute(self, sink=None, rollup=None, profile=None):
+        '''
+        Runs every event and returns the Execution.
+
+        sink, rollup and profile are like Scenario.play's.
+        '''
+        execution = Execution(self, sink=sink, rollup=rollup)
+        execution.run(profile=profile)
+        return execution
+
+def compile_spec(spec):
+    '''
+    Compiles a scenario spec (see the top of this module) into a Plan.
+
+    Raises SpecError if the spec is not valid.
+    '''
+    try:
+        name = spec['name']
+        start_date = _date(spec['start_date'])
+        end_date = _date(spec['end_date'])
+        accounts = []
+        account_indexes = {}
+        for account_spec in spec['accounts']:
+            account_indexes[account_spec['name']] = len(accounts)
+            accounts.append(_compile_account(account_spec))
+
+        schedule = moneycalc.time.Schedule()
+        event_opcodes = []
+        arguments = []
+        for event_spec in spec['events']:
+            (opcode, event_arguments) = _compile_action(event_spec['action'], account_indexes, accounts)
+            schedule.add(_compile_rule(event_spec['when']), handler=None, category=event_spec.get('category'))
+            event_opcodes.append(opcode)
+            arguments.append(event_arguments)
+    except (KeyError, TypeError) as e:
+        raise SpecError('Invalid spec: {!r}'.format(e))
+    (ordinals, operands) = schedule.expand(Period(start_date, end_date + datetime.timedelta(days=1)))
+    return Plan(
+        name=name,
+        start_date=start_date,
+        end_date=end_date,
+        accounts=accounts,
+        ordinals=ordinals,
+        opcodes=array.array('b', (event_opcodes[operand] for operand in operands)),
+        operands=operands,
+        arguments=arguments,
+        categories=schedule.categories,
+    )
+
+def _compile_action(action, account_indexes, accounts):
+    '''
+    Returns a tuple of the action's opcode and the arguments for its
+    Execution method.
+    '''
+    action_type = action['type']
+    def account(key):
+        name = action[key]
+        if name not in account_indexes:
+            raise SpecError('Unknown account: {}'.format(name))
+        return account_indexes[name]
+    def loan(key):
+        index = account(key)
+        (account_type, _parameters) = accounts[index]
+        if account_type != 'amortized_loan':
+            raise SpecError('Not an amortized loan: {}'.format(action[key]))
+        return index
+    if action_type == 'year_summary':
+        return (Opcode.YEAR_SUMMARY, ())
+    if action_type == 'open_loan':
+        return (Opcode.OPEN_LOAN, (loan('account'),))
+    if action_type == 'deposit':
+        return (Opcode.DEPOSIT, (account('account'), _cents(action['amount']), action['description']))
+    if action_type == 'withdraw':
+        return (Opcode.WITHDRAW, (account('account'), _cents(action['amount']), action['description'], action.get('tax_effect', TaxEffect.NONE)))
+    if action_type == 'income':
+        description = action['description']
+        withholdings = tuple(('{} (withheld {})'.format(description, name), Decimal(rate)) for (name, rate) in action.get('withholdings', []))
+        other_taxes = tuple(Decimal(rate) for rate in action.get('other_taxes', []))
+        return (Opcode.INCOME, (account('account'), _cents(action['amount']), description, withholdings, other_taxes))
+    if action_type == 'tax_payment':
+        return (Opcode.TAX_PAYMENT, (account('account'),))
+    if action_type == 'loan_payment':
+        return (Opcode.LOAN_PAYMENT, (account('from_account'), loan('to_account'), _cents(action.get('extra', '0.00')), action['description']))
+    raise SpecError('Unknown action type: {}'.format(action_type))
+
+class Execution(object):
+    '''
+    The state of a Plan being run: its timeline, accounts and year
+    summaries.
+    '''
+    def __init__(self, plan, sink=None, rollup=None):
+        self.plan = plan
+        self.timeline = moneycalc.timeline.Timeline(sink=sink, keep_events=sink is None, rollup=rollup)
+        # Per account index: the account, or None if it is not open.
+        self.__accounts = [
+            None if account_type == 'amortized_loan' else _make_account(account_type, parameters)
+            for (account_type, parameters) in plan.accounts
+        ]
+        # List of (year, [(account name, balance, deposited, withdrawn,
+        # description totals), ...]).
+        self.year_summaries = []
+        # A moneycalc.runner.TaskError if the plan stopped early, or None.
+        self.error = None
+        # Money amounts in the current money representation, by cents.
+        self.__amounts = {}
+        # Indexed by Opcode.
+        self.__dispatch = [
+            self.__year_summary,
+            self.__open_loan,
+            self.__deposit,
+            self.__withdraw,
+            self.__income,
+            self.__tax_payment,
+            self.__loan_payment,
+        ]
+
+    @property
+    def accounts(self):
+        '''
+        The open accounts, in the order of the spec.
+        '''
+        return [account for account in self.__accounts if account is not None]
+
+    def run(self, profile=None):
+        plan = self.plan
+        ordinals = plan.ordinals
+        opcodes = plan.opcodes
+        operands = plan.operands
+        arguments = plan.arguments
+        dispatch = self.__dispatch
+        from_ordinal = datetime.date.fromordinal
+        try:
+            if profile is None:
+                for index in range(len(ordinals)):
+                    dispatch[opcodes[index]](from_ordinal(ordinals[index]), arguments[operands[index]])
+            else:
+                for index in range(len(ordinals)):
+                    operand = operands[index]
+                    handler = lambda date, handler=dispatch[opcodes[index]], event_arguments=arguments[operand]: handler(date, event_arguments)
+                    profile.call(plan.categories[operand], handler, from_ordinal(ordinals[index]), timeline=self.timeline)
+        except NotImplementedError as e:
+            self.error = moneycalc.runner.TaskError.from_exception(e)
+        self.timeline.flush()
+
+    def __amount(self, cents):
+        amount = self.__amounts.get(cents)
+        if amount is None:
+            amount = money_from_cents(cents)
+            self.__amounts[cents] = amount
+        return amount
+
+    def __year_summary(self, date, arguments):
+        year = date.year - 1
+        account_summaries = []
+        for account in self.accounts:
+            summary = self.timeline.account_summary(account=account, year=year)
+            account_summaries.append((str(account), account.balance, summary.deposited, summary.withdrawn, list(summary.description_totals.items())))
+        self.year_summaries.append((year, account_summaries))
+
+    def __open_loan(self, date, arguments):
+        (account_index,) = arguments
+        if self.__accounts[account_index] is not None:
+            raise NotImplementedError()
+        loan = _make_account(*self.plan.accounts[account_index])
+        loan.schedule()
+        self.__accounts[account_index] = loan
+
+    def __deposit(self, date, arguments):
+        (account_index, cents, description) = arguments
+        self.__accounts[account_index].deposit(timeline=self.timeline, date=date, amount=self.__amount(cents), description=description)
+
+    def __withdraw(self, date, arguments):
+        (account_index, cents, description, tax_effect) = arguments
+        self.__accounts[account_index].withdraw(timeline=self.timeline, date=date, amount=self.__amount(cents), description=description, tax_effect=tax_effect)
+
+    def __income(self, date, arguments):
+        (account_index, cents, description, withholdings, other_taxes) = arguments
+        timeline = self.timeline
+        taxable_income = self.__amount(cents)
+        net_income = taxable_income
+        for (withholding_description, rate) in withholdings:
+            withheld = money(taxable_income * rate)
+            net_income = net_income - withheld
+            timeline.add_withheld_cash(date=date, amount=withheld, description=withholding_description)
+        for rate in other_taxes:
+            net_income = net_income - money(taxable_income * rate)
+        timeline.add_income(date=date, amount=taxable_income, description='{} (taxable)'.format(description))
+        self.__accounts[account_index].deposit(timeline=timeline, date=date, amount=net_income, description='{} (net)'.format(description))
+
+    def __tax_payment(self, date, arguments):
+        (account_index,) = arguments
+        account = self.__accounts[account_index]
+        due = self.timeline.tax_ledger.tax_due(year=date.year - 1)
+        if due < 0:
+            account.deposit(timeline=self.timeline, date=date, amount=-due, description='Tax refund')
+        else:
+            account.withdraw(timeline=self.timeline, date=date, amount=due, description='Taxes', tax_effect=TaxEffect.DEDUCTIBLE)
+
+    def __loan_payment(self, date, arguments):
+        (from_index, to_index, extra_cents, description) = arguments
+        loan = self.__accounts[to_index]
+        if loan is None:
+            raise NotImplementedError('{} was paid before it was opened'.format(self.plan.accounts[to_index][1]['name']))
+        payment = loan.minimum_deposit(date=date)
+        if extra_cents:
+            payment = min(payment + self.__amount(extra_cents), loan.payoff_deposit(date=date))
+        moneycalc.account.transfer(timeline=self.timeline, date=date, from_account=self.__accounts[from_index], to_account=loan, amount=payment, description=description)
+
+class TestCompileSpec(unittest.TestCase):
+    def make_spec(self):
+        return {
+            'name': 'Example',
+            'start_date': '2017-01-01',
+            'end_date': '2017-12-31',
+            'accounts': [{'type': 'checking', 'name': 'Checking'}],
+            'events': [
+                {'category': 'gift', 'when': {'rule': 'once', 'date': '2017-01-01'}, 'action': {'type': 'deposit', 'account': 'Checking', 'amount': '10000.00', 'description': 'Gift'}},
+                {'category': 'rent', 'when': {'rule': 'on_day_of_months', 'day': 1, 'months': list(range(1, 13))}, 'action': {'type': 'withdraw', 'account': 'Checking', 'amount': '500.00', 'description': 'Rent'}},
+                {'category': 'salary', 'when': {'rule': 'every_n_days', 'first_date': '2017-01-06', 'days': 14, 'within': ['2017-01-01', '2017-03-01']}, 'action': {'type': 'income', 'account': 'Checking', 'amount': '1000.00', 'description': 'Salary', 'withholdings': [['US tax', '0.2']], 'other_taxes': ['0.1']}},
+            ],
+        }
+
+    def test_plans_run_in_date_order(self):
+        plan = compile_spec(json.loads(json.dumps(self.make_spec())))
+        self.assertEqual(len(plan), 12 + 1 + 4)
+        self.assertEqual(list(plan.opcodes[:3]), [Opcode.DEPOSIT, Opcode.WITHDRAW, Opcode.INCOME])
+        execution = plan.execute()
+        self.assertIsNone(execution.error)
+        self.assertEqual([str(account) for account in execution.accounts], ['Checking'])
+        self.assertEqual(execution.accounts[0].balance, money('10000.00') - 12 * money('500.00') + 4 * money('700.00'))
+        self.assertEqual(execution.timeline.tax_ledger.year_totals(2017).withheld_cash, 4 * money('200.00'))
+
+    def test_invalid_specs_are_errors(self):
+        spec = self.make_spec()
+        spec['events'][1]['action']['account'] = 'Savings'
+        with self.assertRaises(SpecError):
+            compile_spec(spec)
+        spec = self.make_spec()
+        del spec['accounts'][0]['type']
+        with self.assertRaises(SpecError):
+            compile_spec(spec)
+        spec = self.make_spec()
+        del spec['name']
+        with self.assertRaises(SpecError):
+            compile_spec(spec)
+        spec = self.make_spec()
+        spec['events'].append({'when': {'rule': 'once', 'date': '2017-02-01'}, 'action': {'type': 'loan_payment', 'from_account': 'Checking', 'to_account': 'Checking', 'description': 'Loan payment'}})
+        with self.assertRaises(SpecError):
+            compile_spec(spec)
+
+    def test_paying_unopened_loans_is_an_error(self):
+        spec = self.make_spec()
+        spec['accounts'].append({
+            'type': 'amortized_loan',
+            'name': 'Loan',
+            'amount': '5000.00',
+            'interest_rate': {'type': 'fixed_monthly', 'yearly_rate': '0.05'},
+            'term': ['2017-02-01', '2018-02-01'],
+        })
+        spec['events'].append({'when': {'rule': 'once', 'date': '2017-02-01'}, 'action': {'type': 'loan_payment', 'from_account': 'Checking', 'to_account': 'Loan', 'description': 'Loan payment'}})
+        execution = compile_spec(spec).execute()
+        self.assertEqual(execution.error.type_name, 'NotImplementedError')
+
+    def test_rules_round_trip(self):
+        rules = [
+            moneycalc.time.Once(datetime.date(2017, 1, 1)),
+            moneycalc.time.biweekly(datetime.date(2017, 1, 6)),
+            moneycalc.time.Within(moneycalc.time.monthly(day=19), Period(datetime.date(2016, 7, 19), datetime.date(2021, 7, 19))),
+        ]
+        period = Period(datetime.date(2016, 1, 1), datetime.date(2022, 1, 1))
+        for rule in rules:
+            self.assertEqual(_compile_rule(json.loads(json.dumps(describe_rule(rule)))).ordinals(period), rule.ordinals(period))
@@ -0,0 +1,257 @@
+from __future__ import absolute_import
+
+import multiprocessing
+import os
+import pickle
+import time
+import traceback
+import unittest
+
+try:
+    import queue
+except ImportError:
+    # Python 2.
+    import Queue as queue
+
+class TaskError(object):
+    '''
+    Describes why a task failed: it raised an exception, its process died, or
+    it timed out.
+    '''
+    def __init__(self, type_name, message, traceback_text=None):
+        self.type_name = type_name
+        self.message = message
+        self.traceback_text = traceback_text
+
+    @staticmethod
+    def from_exception(exception):
+        return TaskError(
+            type_name=type(exception).__name__,
+            message=str(exception),
+            traceback_text=traceback.format_exc(),
+        )
+
+    def __str__(self):
+        if self.traceback_text is not None:
+            return self.traceback_text
+        return '{}: {}'.format(self.type_name, self.message)
+
+class TaskResult(object):
+    def __init__(self, index, value=None, error=None):
+        self.index = index
+        self.value = value
+        self.error = error
+
+    @property
+    def ok(self):
+        return self.error is None
+
+def _worker_main(worker_id, func, task_connection, result_queue):
+    '''
+    Runs in a worker process: calls func for each (index, arg) received on
+    task_connection until it receives None, and puts (worker_id, index,
+    pickled (value, error)) on result_queue.
+    '''
+    while True:
+        try:
+            task = task_connection.recv()
+        except EOFError:
+            break
+        if task is None:
+            break
+        (index, arg) = task
+        try:
+            result = (func(arg), None)
+        except BaseException as e:
+            result = (None, TaskError.from_exception(e))
+        # Pickle here rather than in the queue's feeder thread, so a result
+        # which cannot be pickled becomes the task's error.
+        try:
+            payload = pickle.dumps(result, pickle.HIGHEST_PROTOCOL)
+        except Exception as e:
+            payload = pickle.dumps((None, TaskError.from_exception(e)), pickle.HIGHEST_PROTOCOL)
+        result_queue.put((worker_id, index, payload))
+    task_connection.close()
+
+class _Worker(object):
+    '''
+    A long-lived worker process which runs one task at a time.
+    '''
+    def __init__(self, worker_id, func, result_queue):
+        self.worker_id = worker_id
+        (child_connection, self.__connection) = multiprocessing.Pipe(duplex=False)
+        self.process = multiprocessing.Process(target=_worker_main, args=(worker_id, func, child_connection, result_queue))
+        self.process.daemon = True
+        self.process.start()
+        child_connection.close()
+        # The index of the running task and its deadline, or None if idle.
+        self.index = None
+        self.deadline = None
+
+    def start_task(self, index, arg, timeout):
+        self.__connection.send((index, arg))
+        self.index = index
+        self.deadline = None if timeout is None else time.time() + timeout
+
+    def finish_task(self):
+        self.index = None
+        self.deadline = None
+
+    def stop(self):
+        try:
+            self.__connection.send(None)
+        except (IOError, OSError):
+            # The process already exited.
+            pass
+        self.__connection.close()
+        self.process.join()
+
+    def kill(self):
+        self.process.terminate()
+        self.process.join()
+        self.__connection.close()
+
+def run_tasks(func, args, processes=None, timeout=None, check_interval=0.1):
+    '''
+    Calls func(arg) for each arg in a pool of at most the given number of
+    long-lived worker processes.
+
+    Returns a list of TaskResult-s in the order of args. A task which raises,
+    whose process dies, or which runs for longer than timeout seconds gets a
+    TaskError; other tasks are unaffected. A worker whose task times out or
+    kills it is replaced by a new worker.
+
+    Results are waited for without polling; every check_interval seconds,
+    workers are also checked for having died.
+    '''
+    args = list(args)
+    if processes is None:
+        processes = multiprocessing.cpu_count()
+    if processes < 1:
+        raise ValueError('processes must be at least 1')
+    results = [None] * len(args)
+    if not args:
+        return results
+    result_queue = multiprocessing.Queue()
+    workers = [_Worker(worker_id=i, func=func, result_queue=result_queue) for i in range(min(processes, len(args)))]
+    next_index = 0
+    remaining = len(args)
+    try:
+        while remaining:
+            for worker in workers:
+                if worker.index is None and next_index < len(args):
+                    worker.start_task(next_index, args[next_index], timeout)
+                    next_index += 1
+
+            wait = check_interval
+            deadlines = [worker.deadline for worker in workers if worker.deadline is not None]
+            if deadlines:
+                wait = max(min(wait, min(deadlines) - time.time()), 0)
+            try:
+                message = result_queue.get(timeout=wait)
+            except queue.Empty:
+                message = None
+            while message is not None:
+                (worker_id, index, payload) = message
+                worker = workers[worker_id]
+                # Ignore results of tasks which already timed out.
+                if worker.index == index:
+                    (value, error) = pickle.loads(payload)
+                    results[index] = TaskResult(index=index, value=value, error=error)
+                    remaining -= 1
+                    worker.finish_task()
+                try:
+                    message = result_queue.get_nowait()
+                except queue.Empty:
+                    message = None
+
+            now = time.time()
+            for (worker_id, worker) in enumerate(workers):
+                if worker.index is None:
+                    continue
+                if not worker.process.is_alive():
+                    error = _process_died_error(worker.process)
+                elif worker.deadline is not None and now > worker.deadline:
+                    error = TaskError(type_name='TimeoutError', message='Task timed out')
+                else:
+                    continue
+                results[worker.index] = TaskResult(index=worker.index, error=error)
+                remaining -= 1
+                worker.kill()
+                workers[worker_id] = _Worker(worker_id=worker_id, func=func, result_queue=result_queue)
+    finally:
+        for worker in workers:
+            if worker.index is None:
+                worker.stop()
+            else:
+                worker.kill()
+        result_queue.close()
+    return results
+
+def _process_died_error(process):
+    return TaskError(
+        type_name='ProcessDiedError',
+        message='Task process exited with code {}'.format(process.exitcode),
+    )
+
+def _play_scenario(scenario_factory):
+    return scenario_factory().play()
+
+def run_scenarios(scenario_factories, processes=None, timeout=None):
+    '''
+    Calls scenario_factory().play() for each scenario factory in parallel.
+
+    Returns a list of TaskResult-s in the order of scenario_factories, each
+    holding the scenario's play result or a TaskError.
+    '''
+    return run_tasks(func=_play_scenario, args=scenario_factories, processes=processes, timeout=timeout)
+
+def _square(x):
+    return x * x
+
+def _fail(x):
+    raise NotImplementedError('not yet: {}'.format(x))
+
+def _sleep(seconds):
+    time.sleep(seconds)
+    return seconds
+
+def _pid(_arg):
+    return os.getpid()
+
+def _exit_if_odd(x):
+    if x % 2:
+        os._exit(x)
+    return x
+
+class TestRunTasks(unittest.TestCase):
+    def test_results_are_in_argument_order(self):
+        results = run_tasks(func=_square, args=range(10), processes=3)
+        self.assertEqual([result.index for result in results], list(range(10)))
+        self.assertEqual([result.value for result in results], [x * x for x in range(10)])
+        self.assertTrue(all(result.ok for result in results))
+
+    def test_exceptions_are_captured_per_task(self):
+        results = run_tasks(func=_fail, args=[1, 2], processes=2)
+        self.assertFalse(results[0].ok)
+        self.assertEqual(results[0].error.type_name, 'NotImplementedError')
+        self.assertEqual(results[1].error.message, 'not yet: 2')
+
+    def test_slow_tasks_time_out(self):
+        results = run_tasks(func=_sleep, args=[0, 10], processes=2, timeout=0.5)
+        self.assertTrue(results[0].ok)
+        self.assertEqual(results[1].error.type_name, 'TimeoutError')
+
+    def test_workers_are_reused(self):
+        results = run_tasks(func=_pid, args=range(20), processes=2)
+        self.assertTrue(all(result.ok for result in results))
+        self.assertLessEqual(len(set(result.value for result in results)), 2)
+
+    def test_dead_and_timed_out_workers_are_replaced(self):
+        results = run_tasks(func=_sleep, args=[10, 0, 0], processes=1, timeout=0.5)
+        self.assertEqual(results[0].error.type_name, 'TimeoutError')
+        self.assertEqual([result.value for result in results[1:]], [0, 0])
+        results = run_tasks(func=_exit_if_odd, args=[3, 4], processes=1)
+        self.assertEqual(results[0].error.type_name, 'ProcessDiedError')
+        self.assertEqual(results[0].error.message, 'Task process exited with code 3')
+        self.assertEqual(results[1].value, 4)
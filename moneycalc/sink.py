@@ -0,0 +1,276 @@
+from moneycalc.money import money_from_cents
+from moneycalc.money import money_to_cents
+from moneycalc.tax import TaxEffect
+from moneycalc.timeline import Timeline
+import abc
+import csv
+import datetime
+import io
+import json
+import os
+import struct
+import unittest
+
+class TimelineSink(object):
+    '''
+    Receives the events of a moneycalc.timeline.Timeline and writes them to
+    out in batches of batch_size events, with one out.write call per batch.
+
+    Call flush (or Timeline.flush) after the last event.
+    '''
+    def __init__(self, out, batch_size=4096):
+        self.out = out
+        self.batch_size = batch_size
+        self.__batch = []
+
+    def add(self, date, account, amount, description, tax_effect):
+        batch = self.__batch
+        batch.append((date, account, amount, description, tax_effect))
+        if len(batch) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        if self.__batch:
+            self.out.write(self.format_batch(self.__batch))
+            self.__batch = []
+        self.out.flush()
+
+    @abc.abstractmethod
+    def format_batch(self, events):
+        '''
+        Returns the text or bytes to write for the given list of (date,
+        account, amount, description, tax effect) tuples.
+        '''
+        raise NotImplementedError()
+
+class _ListWriter(object):
+    def __init__(self):
+        self.parts = []
+
+    def write(self, part):
+        self.parts.append(part)
+
+class CSVTimelineSink(TimelineSink):
+    '''
+    Writes events as CSV text with a header row. Amounts are written like
+    str(money(...)); events without an account have an empty account.
+    '''
+    def __init__(self, out, batch_size=4096):
+        super(CSVTimelineSink, self).__init__(out=out, batch_size=batch_size)
+        self.__wrote_header = False
+
+    def format_batch(self, events):
+        parts = _ListWriter()
+        writer = csv.writer(parts, lineterminator='\n')
+        if not self.__wrote_header:
+            writer.writerow(['date', 'account', 'amount', 'description', 'tax_effect'])
+            self.__wrote_header = True
+        writer.writerows(
+            (date.isoformat(), '' if account is None else str(account), str(amount), description, tax_effect)
+            for (date, account, amount, description, tax_effect) in events)
+        return ''.join(parts.parts)
+
+class JSONLinesTimelineSink(TimelineSink):
+    '''
+    Writes each event as a JSON object on its own line. Amounts are strings
+    so they keep every digit.
+    '''
+    def format_batch(self, events):
+        lines = []
+        for (date, account, amount, description, tax_effect) in events:
+            lines.append(json.dumps({
+                'account': None if account is None else str(account),
+                'amount': str(amount),
+                'date': date.isoformat(),
+                'description': description,
+                'tax_effect': tax_effect,
+            }, sort_keys=True))
+            lines.append('\n')
+        return ''.join(lines)
+
+# The binary format is _BINARY_MAGIC followed by records. Each record starts
+# with a kind byte:
+#
+# * b'A': defines an account name: id (int32), name length (uint16), UTF-8
+#   name. Account id 0 is no account and is never defined.
+# * b'D': defines a description, like b'A'.
+# * b'E': an event: date ordinal (int32), account id (int32), amount in cents
+#   (int64), description id (int32), tax effect code (int8; an index into
+#   _BINARY_TAX_EFFECTS).
+#
+# Names are defined before the first event which uses them. Integers are
+# little-endian.
+_BINARY_MAGIC = b'moneycalc timeline 1\n'
+_BINARY_NAME = struct.Struct('<ciH')
+_BINARY_EVENT = struct.Struct('<ciiqib')
+_BINARY_TAX_EFFECTS = [TaxEffect.NONE, TaxEffect.CASH_INCOME, TaxEffect.CASH_WITHHELD, TaxEffect.DEDUCTIBLE]
+_BINARY_TAX_EFFECT_CODES = dict((tax_effect, code) for (code, tax_effect) in enumerate(_BINARY_TAX_EFFECTS))
+
+class BinaryTimelineSink(TimelineSink):
+    '''
+    Writes events in a compact binary format (see _BINARY_MAGIC) to a binary
+    file. read_binary_timeline reads them back.
+    '''
+    def __init__(self, out, batch_size=4096):
+        super(BinaryTimelineSink, self).__init__(out=out, batch_size=batch_size)
+        self.__wrote_magic = False
+        self.__account_ids = {None: 0}
+        self.__description_ids = {}
+
+    def format_batch(self, events):
+        parts = []
+        if not self.__wrote_magic:
+            parts.append(_BINARY_MAGIC)
+            self.__wrote_magic = True
+        account_ids = self.__account_ids
+        description_ids = self.__description_ids
+        for (date, account, amount, description, tax_effect) in events:
+            account_id = account_ids.get(account)
+            if account_id is None:
+                account_id = len(account_ids)
+                account_ids[account] = account_id
+                parts.append(_pack_name(b'A', account_id, str(account)))
+            description_id = description_ids.get(description)
+            if description_id is None:
+                description_id = len(description_ids)
+                description_ids[description] = description_id
+                parts.append(_pack_name(b'D', description_id, description))
+            parts.append(_BINARY_EVENT.pack(b'E', date.toordinal(), account_id, money_to_cents(amount), description_id, _BINARY_TAX_EFFECT_CODES[tax_effect]))
+        return b''.join(parts)
+
+def _pack_name(kind, name_id, name):
+    encoded = name.encode('utf-8')
+    return _BINARY_NAME.pack(kind, name_id, len(encoded)) + encoded
+
+def read_binary_timeline(data):
+    '''
+    Yields the events in the given output of a BinaryTimelineSink as
+    Timeline.Event-s whose accounts are account names.
+    '''
+    if data[:len(_BINARY_MAGIC)] != _BINARY_MAGIC:
+        raise ValueError('Not a binary timeline')
+    account_names = {0: None}
+    descriptions = {}
+    position = len(_BINARY_MAGIC)
+    while position < len(data):
+        kind = data[position:position + 1]
+        if kind == b'E':
+            (_kind, date_ordinal, account_id, cents, description_id, tax_effect_code) = _BINARY_EVENT.unpack_from(data, position)
+            position += _BINARY_EVENT.size
+            yield Timeline.Event(
+                date=datetime.date.fromordinal(date_ordinal),
+                account=account_names[account_id],
+                amount=money_from_cents(cents),
+                description=descriptions[description_id],
+                tax_effect=_BINARY_TAX_EFFECTS[tax_effect_code],
+            )
+        elif kind in (b'A', b'D'):
+            (_kind, name_id, length) = _BINARY_NAME.unpack_from(data, position)
+            position += _BINARY_NAME.size
+            name = data[position:position + length].decode('utf-8')
+            position += length
+            if kind == b'A':
+                account_names[name_id] = name
+            else:
+                descriptions[name_id] = name
+        else:
+            raise ValueError('Unknown record kind at byte {}'.format(position))
+
+# Maps format names to (sink class, file extension, open mode).
+SINK_FORMATS = {
+    'binary': (BinaryTimelineSink, 'bin', 'wb'),
+    'csv': (CSVTimelineSink, 'csv', 'w'),
+    'jsonl': (JSONLinesTimelineSink, 'jsonl', 'w'),
+}
+
+class StreamingScenarioFactory(object):
+    '''
+    A scenario factory whose scenarios stream their timelines to a file
+    named after the scenario in directory, in the given format (a key of
+    SINK_FORMATS), instead of keeping them in memory.
+    '''
+    def __init__(self, scenario_factory, directory, format='csv'):
+        if format not in SINK_FORMATS:
+            raise ValueError('Unknown timeline format: {}'.format(format))
+        self.scenario_factory = scenario_factory
+        self.directory = directory
+        self.format = format
+
+    @property
+    def __name__(self):
+        return self.scenario_factory.__name__
+
+    def __call__(self, *args, **kwargs):
+        return _StreamingScenario(self.scenario_factory(*args, **kwargs), directory=self.directory, format=self.format)
+
+class _StreamingScenario(object):
+    def __init__(self, scenario, directory, format):
+        self.__scenario = scenario
+        self.__directory = directory
+        self.__format = format
+
+    def __str__(self):
+        return str(self.__scenario)
+
+    def play(self, **kwargs):
+        (sink_class, extension, mode) = SINK_FORMATS[self.__format]
+        path = os.path.join(self.__directory, '{}.{}'.format(self.__scenario, extension))
+        with open(path, mode) as out:
+            return self.__scenario.play(sink=sink_class(out), **kwargs)
+
+class _CountingOut(object):
+    def __init__(self, out):
+        self.out = out
+        self.writes = 0
+
+    def write(self, data):
+        self.writes += 1
+        self.out.write(data)
+
+    def flush(self):
+        pass
+
+class TestTimelineSinks(unittest.TestCase):
+    def add_events(self, timeline):
+        checking = 'Checking'
+        for day in range(1, 11):
+            date = datetime.date(2017, 3, day)
+            timeline.add_income(date=date, amount=money_from_cents(10000 + day), description='Salary, gross')
+            timeline.add_generic_deposit(date=date, account=checking, amount=money_from_cents(8000 + day), description='Salary "net"')
+            timeline.add_interest_deposit(date=date, account=checking, amount=money_from_cents(-day), description='Interest')
+
+    def test_writes_are_batched(self):
+        out = _CountingOut(io.StringIO() if str is not bytes else io.BytesIO())
+        timeline = Timeline(sink=JSONLinesTimelineSink(out, batch_size=8), keep_events=False)
+        self.add_events(timeline)
+        timeline.flush()
+        self.assertEqual(out.writes, 4)
+        lines = out.out.getvalue().splitlines()
+        self.assertEqual(len(lines), 30)
+        self.assertEqual(json.loads(lines[1]), {
+            'account': 'Checking',
+            'amount': '80.01',
+            'date': '2017-03-01',
+            'description': 'Salary "net"',
+            'tax_effect': TaxEffect.NONE,
+        })
+
+    def test_csv_quotes_descriptions(self):
+        out = io.StringIO() if str is not bytes else io.BytesIO()
+        timeline = Timeline(sink=CSVTimelineSink(out))
+        self.add_events(timeline)
+        timeline.flush()
+        rows = list(csv.reader(out.getvalue().splitlines()))
+        self.assertEqual(rows[0], ['date', 'account', 'amount', 'description', 'tax_effect'])
+        self.assertEqual(rows[1], ['2017-03-01', '', '100.01', 'Salary, gross', TaxEffect.CASH_INCOME])
+        self.assertEqual(rows[2], ['2017-03-01', 'Checking', '80.01', 'Salary "net"', TaxEffect.NONE])
+        self.assertEqual(len(rows), 31)
+
+    def test_binary_round_trips(self):
+        out = io.BytesIO()
+        timeline = Timeline(sink=BinaryTimelineSink(out, batch_size=7))
+        self.add_events(timeline)
+        timeline.flush()
+        self.assertEqual(
+            [(event.date, event.account, event.amount, event.description, event.tax_effect) for event in read_binary_timeline(out.getvalue())],
+            [(event.date, event.account, event.amount, event.description, event.tax_effect) for event in timeline])
@@ -0,0 +1,279 @@
+from decimal import Decimal
+import moneycalc.sweep
+import unittest
+
+class SolveMethod(object):
+    # Halve the bracket every step. Always converges, one bit per
+    # evaluation.
+    BISECTION = 'BISECTION'
+    # Interpolate linearly between the bracket's ends (with the Illinois
+    # modification so one end cannot get stuck). Converges in far fewer
+    # evaluations when the objective is nearly linear, as most money
+    # outcomes are.
+    FALSE_POSITION = 'FALSE_POSITION'
+
+class SolveError(ValueError):
+    pass
+
+class SolveResult(object):
+    '''
+    The outcome of find_root or find_minimum.
+
+    value is the best parameter value found, and objective_value is the
+    objective at value. low and high bracket the root or minimum.
+    '''
+    def __init__(self, value, objective_value, low, high, evaluations, converged):
+        self.value = value
+        self.objective_value = objective_value
+        self.low = low
+        self.high = high
+        self.evaluations = evaluations
+        self.converged = converged
+
+    def __repr__(self):
+        return 'SolveResult(value={!r}, objective_value={!r}, evaluations={}, converged={})'.format(self.value, self.objective_value, self.evaluations, self.converged)
+
+def _number(value):
+    '''
+    Converts an objective value (e.g. a money() amount) to a number which
+    can be multiplied and divided.
+    '''
+    if isinstance(value, (Decimal, float, int)):
+        return value
+    return Decimal(str(value))
+
+def _sign(value):
+    return (value > 0) - (value < 0)
+
+def find_root(objective, low, high, target=0, tolerance=Decimal('0.01'), max_evaluations=64, method=SolveMethod.FALSE_POSITION, round_value=None):
+    '''
+    Returns a SolveResult with a value between low and high where
+    objective(value) crosses target.
+
+    objective(low) and objective(high) must be on opposite sides of target.
+    The search stops when the bracket is narrower than tolerance, when
+    objective(value) equals target, or after max_evaluations evaluations
+    (with converged=False).
+
+    If given, round_value rounds each value before it is evaluated (e.g. to
+    whole cents with moneycalc.money.money).
+    '''
+    if round_value is None:
+        round_value = lambda value: value
+    if method not in (SolveMethod.BISECTION, SolveMethod.FALSE_POSITION):
+        raise ValueError('Unknown solve method: {}'.format(method))
+    low = round_value(low)
+    high = round_value(high)
+    target = _number(target)
+    f_low = _number(objective(low)) - target
+    f_high = _number(objective(high)) - target
+    evaluations = 2
+    if f_low == 0:
+        return SolveResult(value=low, objective_value=f_low + target, low=low, high=low, evaluations=evaluations, converged=True)
+    if f_high == 0:
+        return SolveResult(value=high, objective_value=f_high + target, low=high, high=high, evaluations=evaluations, converged=True)
+    if _sign(f_low) == _sign(f_high):
+        raise SolveError('Objective does not cross {} between {} and {}'.format(target, low, high))
+
+    # The number of times f_low and f_high were halved for the
+    # interpolation, as the Illinois modification does each time the same
+    # end is kept twice in a row.
+    halvings_low = 0
+    halvings_high = 0
+    # Which end of the bracket was kept in the previous step (-1 for low, 1
+    # for high).
+    kept_side = 0
+    while True:
+        if abs(high - low) <= tolerance:
+            converged = True
+            break
+        if evaluations >= max_evaluations:
+            converged = False
+            break
+        if method == SolveMethod.BISECTION:
+            value = round_value((low + high) / 2)
+        else:
+            weighted_low = f_low / 2 ** halvings_low
+            weighted_high = f_high / 2 ** halvings_high
+            value = round_value(high - weighted_high * (high - low) / (weighted_high - weighted_low))
+        if not (low < value < high if low < high else high < value < low):
+            # Rounding or interpolation landed on the bracket; fall back to
+            # bisection so the bracket keeps shrinking.
+            value = round_value((low + high) / 2)
+            if value == low or value == high:
+                converged = True
+                break
+        f_value = _number(objective(value)) - target
+        evaluations += 1
+        if f_value == 0:
+            return SolveResult(value=value, objective_value=f_value + target, low=value, high=value, evaluations=evaluations, converged=True)
+        if _sign(f_value) == _sign(f_low):
+            low = value
+            f_low = f_value
+            halvings_low = 0
+            if kept_side == 1:
+                halvings_high += 1
+            kept_side = 1
+        else:
+            high = value
+            f_high = f_value
+            halvings_high = 0
+            if kept_side == -1:
+                halvings_low += 1
+            kept_side = -1
+    if abs(f_low) <= abs(f_high):
+        return SolveResult(value=low, objective_value=f_low + target, low=low, high=high, evaluations=evaluations, converged=converged)
+    else:
+        return SolveResult(value=high, objective_value=f_high + target, low=low, high=high, evaluations=evaluations, converged=converged)
+
+# 1 / golden ratio.
+_INVERSE_PHI = (Decimal(5).sqrt() - 1) / 2
+
+def find_minimum(objective, low, high, tolerance=Decimal('0.01'), max_evaluations=64, round_value=None):
+    '''
+    Returns a SolveResult with the value between low and high which
+    minimizes objective, found by golden-section search. objective must
+    decrease then increase between low and high.
+
+    To find a maximum, minimize the negated objective.
+    '''
+    if round_value is None:
+        round_value = lambda value: value
+    low = round_value(low)
+    high = round_value(high)
+    inverse_phi = _INVERSE_PHI if isinstance(low, Decimal) else float(_INVERSE_PHI)
+    values = {}
+    def evaluate(value):
+        if value not in values:
+            values[value] = _number(objective(value))
+        return values[value]
+    a = round_value(high - (high - low) * inverse_phi)
+    b = round_value(low + (high - low) * inverse_phi)
+    converged = False
+    while len(values) < max_evaluations:
+        if abs(high - low) <= tolerance or a >= b:
+            converged = True
+            break
+        if evaluate(a) <= evaluate(b):
+            high = b
+            b = a
+            a = round_value(high - (high - low) * inverse_phi)
+        else:
+            low = a
+            a = b
+            b = round_value(low + (high - low) * inverse_phi)
+    value = min(values, key=lambda value: values[value]) if values else low
+    return SolveResult(value=value, objective_value=evaluate(value), low=low, high=high, evaluations=len(values), converged=converged)
+
+class ScenarioObjective(object):
+    '''
+    Evaluates objective(result) of scenario_factory(**{parameter: value})
+    for parameter values chosen by find_root or find_minimum.
+
+    Every evaluation shares one moneycalc.sweep.SharedCache, so inputs such
+    as prime rate curves and amortization schedules are computed once.
+    Results are remembered by value.
+
+    If fork_date is given, a scenario with the default parameter value is
+    played until fork_date once, and each evaluation forks it with
+    parameter changed (see Scenario.fork). Only the time after fork_date is
+    simulated again, and value only takes effect from fork_date.
+    '''
+    def __init__(self, scenario_factory, parameter, objective, parameters=None, fork_date=None, shared=None):
+        self.scenario_factory = scenario_factory
+        self.parameter = parameter
+        self.objective = objective
+        self.parameters = dict(parameters or {})
+        self.fork_date = fork_date
+        self.shared = moneycalc.sweep.SharedCache() if shared is None else shared
+        self.__prefix = None
+        self.__objective_values = {}
+        self.plays = 0
+
+    def __call__(self, value):
+        objective_value = self.__objective_values.get(value)
+        if objective_value is None:
+            objective_value = self.objective(self.play(value))
+            self.__objective_values[value] = objective_value
+        return objective_value
+
+    def play(self, value):
+        '''
+        Returns the ScenarioResult of the scenario with the given parameter
+        value.
+        '''
+        self.plays += 1
+        if self.fork_date is None:
+            parameters = dict(self.parameters)
+            parameters[self.parameter] = value
+            result = self.scenario_factory(shared=self.shared, **parameters).play()
+        else:
+            if self.__prefix is None:
+                prefix = self.scenario_factory(shared=self.shared, **self.parameters)
+                prefix.start()
+                prefix.play_until(self.fork_date)
+                self.__prefix = prefix
+            scenario = self.__prefix.fork(**{self.parameter: value})
+            scenario.play_until(None)
+            result = scenario.finish()
+        if result.error is not None:
+            raise SolveError('Scenario failed with {}={}: {}'.format(self.parameter, value, result.error))
+        return result
+
+def total_interest(result):
+    return result.total_interest
+
+def total_tax(result):
+    return result.total_tax
+
+def end_balance(account_name):
+    '''
+    Returns an objective which is the given account's balance at the end of
+    a scenario.
+    '''
+    def objective(result):
+        return dict(result.end_balances)[account_name]
+    return objective
+
+def year_end_balance(account_name, year):
+    '''
+    Returns an objective which is the given account's balance at the end of
+    the given year of a scenario.
+    '''
+    def objective(result):
+        for year_summary in result.year_summaries:
+            if year_summary.year == year:
+                for account_summary in year_summary.account_summaries:
+                    if account_summary.account_name == account_name:
+                        return account_summary.balance
+        raise KeyError((account_name, year))
+    return objective
+
+class TestFindRoot(unittest.TestCase):
+    def test_methods_find_the_same_root(self):
+        def objective(value):
+            return (value - Decimal('123.45')) * 7 + (value * value) / 1000
+        for method in [SolveMethod.BISECTION, SolveMethod.FALSE_POSITION]:
+            result = find_root(objective, Decimal(0), Decimal(1000), tolerance=Decimal('0.001'), method=method)
+            self.assertTrue(result.converged)
+            self.assertAlmostEqual(float(result.value), 121.3465, places=3)
+            self.assertLessEqual(abs(result.high - result.low), Decimal('0.001'))
+        bisection = find_root(objective, Decimal(0), Decimal(1000), tolerance=Decimal('0.001'), method=SolveMethod.BISECTION)
+        false_position = find_root(objective, Decimal(0), Decimal(1000), tolerance=Decimal('0.001'), method=SolveMethod.FALSE_POSITION)
+        self.assertLess(false_position.evaluations, bisection.evaluations)
+
+    def test_rounded_values_stop_at_adjacent_values(self):
+        result = find_root(lambda value: value * 3 - 100, 0, 100, tolerance=0, round_value=int)
+        self.assertTrue(result.converged)
+        self.assertEqual((result.low, result.high), (33, 34))
+        self.assertEqual(result.value, 33)
+
+    def test_unbracketed_root_is_an_error(self):
+        with self.assertRaises(SolveError):
+            find_root(lambda value: value * value + 1, -10, 10)
+
+class TestFindMinimum(unittest.TestCase):
+    def test_finds_minimum(self):
+        result = find_minimum(lambda value: (value - Decimal('2.5')) ** 2, Decimal(-10), Decimal(10), tolerance=Decimal('0.0001'))
+        self.assertTrue(result.converged)
+        self.assertAlmostEqual(float(result.value), 2.5, places=3)
@@ -0,0 +1,192 @@
+import itertools
+import moneycalc.runner
+import multiprocessing
+import unittest
+
+class SharedCache(object):
+    '''
+    Holds objects which several scenarios can share instead of computing
+    them each time, such as prime rates and amortization schedules.
+
+    Values must not be mutated after they are computed.
+    '''
+    def __init__(self):
+        self.__values = {}
+        self.hits = 0
+        self.misses = 0
+
+    def __deepcopy__(self, memo):
+        # Copies of scenarios keep sharing.
+        return self
+
+    def get(self, key, compute):
+        try:
+            value = self.__values[key]
+        except KeyError:
+            self.misses += 1
+            value = compute()
+            self.__values[key] = value
+            return value
+        self.hits += 1
+        return value
+
+def grid(axes):
+    '''
+    Returns a list of parameter sets (dicts) for every combination of the
+    given axes. axes maps each parameter name to a list of its values.
+
+    Parameter sets vary fastest in the last parameter name (sorted).
+    '''
+    names = sorted(axes)
+    return [dict(zip(names, values)) for values in itertools.product(*[axes[name] for name in names])]
+
+class ResultTable(object):
+    '''
+    Column-oriented results of a sweep, with one row per parameter set.
+
+    Each column is a list. A column exists for each parameter name and each
+    measure name, plus an 'error' column holding None or a
+    moneycalc.runner.TaskError.
+    '''
+    def __init__(self, parameter_names, measure_names):
+        self.parameter_names = list(parameter_names)
+        self.measure_names = list(measure_names)
+        self.columns = dict((name, []) for name in self.column_names)
+
+    @property
+    def column_names(self):
+        return self.parameter_names + self.measure_names + ['error']
+
+    def __len__(self):
+        return len(self.columns['error'])
+
+    def append_row(self, values):
+        for name in self.column_names:
+            self.columns[name].append(values.get(name))
+
+    def rows(self):
+        names = self.column_names
+        for values in zip(*[self.columns[name] for name in names]):
+            yield dict(zip(names, values))
+
+    def write_csv(self, out):
+        names = self.column_names
+        out.write('{}\n'.format(','.join(names)))
+        for row in self.rows():
+            error = row['error']
+            row['error'] = '' if error is None else error.type_name
+            out.write('{}\n'.format(','.join('' if row[name] is None else str(row[name]) for name in names)))
+
+def measure_scenario_result(result):
+    '''
+    Returns the measures of a strager_mortgage.ScenarioResult-like object:
+    total interest, total tax, and each account's ending balance.
+    '''
+    measures = {
+        'total_interest': result.total_interest,
+        'total_tax': result.total_tax,
+    }
+    for (account_name, balance) in result.end_balances:
+        measures['end_balance:{}'.format(account_name)] = balance
+    return measures
+
+def _evaluate_chunk(task):
+    (scenario_factory, measure, parameter_sets) = task
+    shared = SharedCache()
+    rows = []
+    for parameters in parameter_sets:
+        try:
+            result = scenario_factory(shared=shared, **parameters).play()
+            rows.append((measure(result), getattr(result, 'error', None)))
+        except Exception as e:
+            rows.append(({}, moneycalc.runner.TaskError.from_exception(e)))
+    return rows
+
+def sweep(scenario_factory, parameter_sets, measure=measure_scenario_result, processes=None, timeout=None, chunk_size=None):
+    '''
+    Plays scenario_factory(shared=..., **parameters) for each parameter set
+    and returns a ResultTable of their measures.
+
+    Parameter sets are split into chunks which are played in parallel by
+    moneycalc.runner.run_tasks. Scenarios in the same chunk share a
+    SharedCache, so expensive inputs are computed once per chunk rather than
+    once per scenario. timeout applies to each chunk.
+    '''
+    parameter_sets = list(parameter_sets)
+    if chunk_size is None:
+        chunk_size = _default_chunk_size(len(parameter_sets), processes=processes)
+    chunks = [parameter_sets[i:i + chunk_size] for i in range(0, len(parameter_sets), chunk_size)]
+    if processes == 1:
+        chunk_results = [moneycalc.runner.TaskResult(index=index, value=_evaluate_chunk((scenario_factory, measure, chunk))) for (index, chunk) in enumerate(chunks)]
+    else:
+        chunk_results = moneycalc.runner.run_tasks(
+            func=_evaluate_chunk,
+            args=[(scenario_factory, measure, chunk) for chunk in chunks],
+            processes=processes,
+            timeout=timeout,
+        )
+
+    parameter_names = sorted(set(name for parameters in parameter_sets for name in parameters))
+    rows = []
+    for (chunk, chunk_result) in zip(chunks, chunk_results):
+        if chunk_result.ok:
+            rows.extend(zip(chunk, chunk_result.value))
+        else:
+            rows.extend((parameters, ({}, chunk_result.error)) for parameters in chunk)
+    measure_names = sorted(set(name for (_parameters, (measures, _error)) in rows for name in measures))
+    table = ResultTable(parameter_names=parameter_names, measure_names=measure_names)
+    for (parameters, (measures, error)) in rows:
+        values = dict(parameters)
+        values.update(measures)
+        values['error'] = error
+        table.append_row(values)
+    return table
+
+def _default_chunk_size(count, processes):
+    if processes is None:
+        processes = multiprocessing.cpu_count()
+    # Several chunks per process balance the load without paying for a
+    # process per scenario.
+    return max(1, -(-count // (processes * 4)))
+
+class _FakeResult(object):
+    def __init__(self, total_interest, total_tax, end_balances, error=None):
+        self.total_interest = total_interest
+        self.total_tax = total_tax
+        self.end_balances = end_balances
+        self.error = error
+
+class _FakeScenario(object):
+    def __init__(self, shared, rate, years):
+        self.__shared = shared
+        self.__rate = rate
+        self.__years = years
+
+    def play(self):
+        if self.__years < 0:
+            raise ValueError('negative years')
+        base = self.__shared.get('base', lambda: 1000)
+        interest = base * self.__rate * self.__years
+        return _FakeResult(total_interest=interest, total_tax=interest // 10, end_balances=[('Loan', base - interest)])
+
+class TestSweep(unittest.TestCase):
+    def test_grid_covers_every_combination(self):
+        self.assertEqual(grid({'years': [10, 20], 'rate': [1, 2, 3]}), [
+            {'rate': 1, 'years': 10},
+            {'rate': 1, 'years': 20},
+            {'rate': 2, 'years': 10},
+            {'rate': 2, 'years': 20},
+            {'rate': 3, 'years': 10},
+            {'rate': 3, 'years': 20},
+        ])
+
+    def test_sweep_measures_each_parameter_set_in_order(self):
+        parameter_sets = grid({'years': [10, 20, -1], 'rate': [1, 2]})
+        for processes in [1, 2]:
+            table = sweep(_FakeScenario, parameter_sets, processes=processes, chunk_size=2)
+            self.assertEqual(len(table), 6)
+            self.assertEqual(table.column_names, ['rate', 'years', 'end_balance:Loan', 'total_interest', 'total_tax', 'error'])
+            self.assertEqual(table.columns['years'], [10, 20, -1, 10, 20, -1])
+            self.assertEqual(table.columns['total_interest'], [10000, 20000, None, 20000, 40000, None])
+            self.assertEqual(table.columns['error'][0], None)
+            self.assertEqual(table.columns['error'][2].type_name, 'ValueError')
@@ -1,5 +1,15 @@
 from decimal import Decimal
+from moneycalc.money import Cents
 from moneycalc.money import money
+from moneycalc.money import money_from_cents
+from moneycalc.money import money_to_cents
+from moneycalc.util import _INT64_TYPECODE
+import array
+import bisect
+import itertools
+import numbers
+import operator
+import unittest
 
 class TaxEffect(object):
     CASH_INCOME = 'CASH_INCOME'
@@ -7,50 +17,367 @@ class TaxEffect(object):
     DEDUCTIBLE = 'DEDUCTIBLE'
     NONE = 'NONE'
 
+class TaxBracketTable(object):
+    '''
+    The progressive income tax brackets of one jurisdiction in one year.
+
+    thresholds are the ascending lower bounds of the brackets (the first is
+    0), and rates are the Decimal marginal rates of income at or above each
+    threshold.
+
+    tax (with Decimals) and tax_cents (with integer cents) compute the same
+    tax to the cent: the exact tax rounded like money().
+    '''
+    def __init__(self, jurisdiction, year, thresholds, rates):
+        if len(thresholds) != len(rates) or not thresholds or thresholds[0] != 0:
+            raise ValueError('Bracket thresholds must start at 0 and match the rates')
+        if any(low >= high for (low, high) in zip(thresholds, thresholds[1:])):
+            raise ValueError('Bracket thresholds must be ascending')
+        self.jurisdiction = jurisdiction
+        self.year = year
+        self.thresholds = [Decimal(threshold) for threshold in thresholds]
+        self.rates = [Decimal(rate) for rate in rates]
+        # The exact tax on the income below each threshold.
+        self.__base_taxes = [Decimal(0)]
+        for i in range(1, len(self.thresholds)):
+            self.__base_taxes.append(self.__base_taxes[-1] + (self.thresholds[i] - self.thresholds[i - 1]) * self.rates[i - 1])
+
+        # The same, scaled to integers: rates are in units of
+        # 1/__rate_scale, and taxes in units of 1/__rate_scale cents.
+        rate_places = max(max(-rate.as_tuple().exponent, 0) for rate in self.rates)
+        self.__rate_scale = 10 ** rate_places
+        self.__threshold_cents = [_decimal_to_cents(threshold) for threshold in self.thresholds]
+        self.__scaled_rates = [int(rate.scaleb(rate_places)) for rate in self.rates]
+        self.__scaled_base_taxes = [int(tax.scaleb(2 + rate_places)) for tax in self.__base_taxes]
+
+    def marginal_rate(self, amount):
+        '''
+        Returns the rate of the bracket containing the given income.
+        '''
+        return self.rates[max(bisect.bisect_right(self.thresholds, _to_decimal(amount)) - 1, 0)]
+
+    def tax(self, amount):
+        '''
+        Returns the progressive tax on the given income as a money()
+        amount.
+        '''
+        amount = _to_decimal(amount)
+        if amount <= 0:
+            return money(0)
+        i = bisect.bisect_right(self.thresholds, amount) - 1
+        return money(self.__base_taxes[i] + (amount - self.thresholds[i]) * self.rates[i])
+
+    def tax_cents(self, incomes_cents):
+        '''
+        Returns an array of the progressive tax in cents on each of the given
+        incomes in cents (any iterable of integers, such as an array).
+
+        Only integer arithmetic is used, so this is much faster than tax for
+        many incomes.
+        '''
+        incomes = [int(income) for income in incomes_cents]
+        # Find every income's bracket in one pass. thresholds[0] is 0, so
+        # each income's bracket is the number of later thresholds at or
+        # below it; incomes at or below 0 fall in bracket 0 and owe 0.
+        brackets = list(map(bisect.bisect_right, itertools.repeat(self.__threshold_cents[1:], len(incomes)), incomes))
+        threshold_cents = self.__threshold_cents
+        scaled_rates = self.__scaled_rates
+        scaled_base_taxes = self.__scaled_base_taxes
+        scale = self.__rate_scale
+        half = scale // 2
+        # Round half up, like money().
+        return array.array(_INT64_TYPECODE, [
+            (scaled_base_taxes[i] + (income - threshold_cents[i]) * scaled_rates[i] + half) // scale if income > 0 else 0
+            for (i, income) in zip(brackets, incomes)
+        ])
+
+def _to_decimal(amount):
+    if type(amount) is Cents:
+        return amount.to_decimal()
+    return Decimal(amount)
+
+def _decimal_to_cents(amount):
+    cents = amount.scaleb(2)
+    if cents != int(cents):
+        raise ValueError('Amount has fractional cents: {}'.format(amount))
+    return int(cents)
+
+class Jurisdiction(object):
+    US = 'US'
+    CA = 'CA'
+
+# Maps each jurisdiction to its TaxBracketTable-s sorted by year. A year
+# without a table uses the table of the latest earlier year (or the earliest
+# table).
+_bracket_tables = {}
+
+def register_bracket_table(table):
+    tables = _bracket_tables.setdefault(table.jurisdiction, [])
+    years = [t.year for t in tables]
+    i = bisect.bisect_left(years, table.year)
+    if i < len(tables) and tables[i].year == table.year:
+        tables[i] = table
+    else:
+        tables.insert(i, table)
+
+def bracket_table(jurisdiction, year):
+    '''
+    Returns the TaxBracketTable of the given jurisdiction for the given
+    year.
+    '''
+    tables = _bracket_tables.get(jurisdiction)
+    if not tables:
+        raise KeyError(jurisdiction)
+    i = bisect.bisect_right([table.year for table in tables], year) - 1
+    return tables[max(i, 0)]
+
+# Single filer brackets. Years after the newest table use it as is; they
+# are not indexed for inflation.
+register_bracket_table(TaxBracketTable(
+    jurisdiction=Jurisdiction.US,
+    year=2016,
+    thresholds=[0, 9276, 37651, 91151, 190151, 413351, 415051],
+    rates=['0.10', '0.15', '0.25', '0.28', '0.33', '0.35', '0.396'],
+))
+register_bracket_table(TaxBracketTable(
+    jurisdiction=Jurisdiction.US,
+    year=2018,
+    thresholds=[0, 9526, 38701, 82501, 157501, 200001, 500001],
+    rates=['0.10', '0.12', '0.22', '0.24', '0.32', '0.35', '0.37'],
+))
+# Includes the 1% mental health services tax on income over $1,000,000.
+register_bracket_table(TaxBracketTable(
+    jurisdiction=Jurisdiction.CA,
+    year=2016,
+    thresholds=[0, 7749, 18371, 28995, 40250, 50689, 259844, 311812, 519867, 1000000],
+    rates=['0.01', '0.02', '0.04', '0.06', '0.08', '0.093', '0.103', '0.113', '0.123', '0.133'],
+))
+
+JURISDICTIONS = (Jurisdiction.US, Jurisdiction.CA)
+
 def us_tax_rate(year, amount):
-    # TODO(strager): Account for year.
-    if amount < 9276:
-        return Decimal('0.10')
-    if amount < 37651:
-        return Decimal('0.15')
-    if amount < 91151:
-        return Decimal('0.25')
-    if amount < 190151:
-        return Decimal('0.28')
-    if amount < 413351:
-        return Decimal('0.33')
-    if amount < 415051:
-        return Decimal('0.35')
-    return Decimal('0.396')
+    '''
+    Returns the US marginal tax rate of the given income.
+    '''
+    return bracket_table(Jurisdiction.US, year).marginal_rate(amount)
 
 def ca_tax_rate(year, amount):
-    # TODO(strager): Account for year.
-    if amount < 7749:
-        return Decimal('0.01')
-    if amount < 18371:
-        return Decimal('0.02')
-    if amount < 28995:
-        return Decimal('0.04')
-    if amount < 40250:
-        return Decimal('0.06')
-    if amount < 50689:
-        return Decimal('0.08')
-    if amount < 259844:
-        return Decimal('0.093')
-    if amount < 311812:
-        return Decimal('0.103')
-    if amount < 519867:
-        return Decimal('0.113')
-    if amount < 1000000:
-        return Decimal('0.123')
-    return Decimal('0.133')
+    '''
+    Returns the California marginal tax rate of the given income.
+    '''
+    return bracket_table(Jurisdiction.CA, year).marginal_rate(amount)
+
+def income_tax(year, taxable_income, jurisdictions=JURISDICTIONS):
+    '''
+    Returns the total progressive tax on the given taxable income as a
+    money() amount.
+    '''
+    return sum((bracket_table(jurisdiction, year).tax(taxable_income) for jurisdiction in jurisdictions), money(0))
+
+def income_tax_cents(years, taxable_incomes_cents, jurisdictions=JURISDICTIONS):
+    '''
+    Returns an array of the total progressive tax in cents on each of the
+    given taxable incomes in cents, like income_tax but for many (year,
+    income) points at once, such as every year of every scenario in a sweep.
+
+    years is a single year or a sequence of years (one per income). Years
+    which use the same bracket tables are taxed together, one group at a
+    time.
+    '''
+    if isinstance(years, numbers.Integral):
+        return _group_income_tax_cents(
+            tables=[bracket_table(jurisdiction, years) for jurisdiction in jurisdictions],
+            incomes_cents=taxable_incomes_cents,
+        )
+    incomes_cents = list(taxable_incomes_cents)
+    if len(years) != len(incomes_cents):
+        raise ValueError('Expected one year per income')
+    tables_by_year = {}
+    positions_by_tables = {}
+    for (position, year) in enumerate(years):
+        tables = tables_by_year.get(year)
+        if tables is None:
+            tables = tuple(bracket_table(jurisdiction, year) for jurisdiction in jurisdictions)
+            tables_by_year[year] = tables
+        positions_by_tables.setdefault(tables, []).append(position)
+    if len(positions_by_tables) == 1:
+        (tables,) = positions_by_tables
+        return _group_income_tax_cents(tables=tables, incomes_cents=incomes_cents)
+    totals = array.array(_INT64_TYPECODE, [0]) * len(incomes_cents)
+    for (tables, positions) in positions_by_tables.items():
+        group_totals = _group_income_tax_cents(tables=tables, incomes_cents=[incomes_cents[position] for position in positions])
+        for (position, tax) in zip(positions, group_totals):
+            totals[position] = tax
+    return totals
+
+def _group_income_tax_cents(tables, incomes_cents):
+    incomes_cents = list(incomes_cents)
+    totals = None
+    for table in tables:
+        taxes = table.tax_cents(incomes_cents)
+        if totals is None:
+            totals = taxes
+        else:
+            totals = array.array(_INT64_TYPECODE, map(operator.add, totals, taxes))
+    if totals is None:
+        totals = array.array(_INT64_TYPECODE, [0]) * len(incomes_cents)
+    return totals
+
+class TaxLedger(object):
+    '''
+    Running totals of taxable events for each tax year.
+
+    Feed events to a TaxLedger as they happen, then ask for the tax due for
+    a year without revisiting the year's events.
+    '''
+    class YearTotals(object):
+        def __init__(self):
+            self.taxable_cash_income = money(0)
+            self.withheld_cash = money(0)
+            self.deductible = money(0)
+
+        def copy(self):
+            totals = TaxLedger.YearTotals()
+            totals.taxable_cash_income = self.taxable_cash_income
+            totals.withheld_cash = self.withheld_cash
+            totals.deductible = self.deductible
+            return totals
+
+    def __init__(self):
+        self.__year_totals = {}
+        # YearTotals shared with a fork. They are copied before they change.
+        self.__shared_totals = frozenset()
+
+    def fork(self):
+        '''
+        Returns a copy of this ledger which shares its year totals
+        copy-on-write. Events added to either ledger afterwards are not seen
+        by the other.
+        '''
+        ledger = TaxLedger()
+        ledger.__year_totals = dict(self.__year_totals)
+        shared_totals = frozenset(self.__year_totals.values())
+        self.__shared_totals = shared_totals
+        ledger.__shared_totals = shared_totals
+        return ledger
+
+    def add(self, year, amount, tax_effect):
+        if tax_effect == TaxEffect.NONE:
+            return
+        totals = self.__year_totals.get(year)
+        if totals is None:
+            totals = TaxLedger.YearTotals()
+            self.__year_totals[year] = totals
+        elif totals in self.__shared_totals:
+            totals = totals.copy()
+            self.__year_totals[year] = totals
+        if tax_effect == TaxEffect.CASH_INCOME:
+            totals.taxable_cash_income += amount
+        elif tax_effect == TaxEffect.CASH_WITHHELD:
+            totals.withheld_cash += -amount
+        elif tax_effect == TaxEffect.DEDUCTIBLE:
+            totals.deductible += abs(amount)
+        else:
+            raise ValueError('Unknown tax effect: {}'.format(tax_effect))
+
+    def year_totals(self, year):
+        totals = self.__year_totals.get(year)
+        if totals is None:
+            return TaxLedger.YearTotals()
+        return totals
+
+    def tax(self, year):
+        '''
+        Returns the total tax for the given year, before subtracting withheld
+        cash.
+        '''
+        totals = self.year_totals(year)
+        taxable_income = max((totals.taxable_cash_income - totals.deductible, money(0)))
+        return income_tax(year=year, taxable_income=taxable_income)
+
+    def tax_due(self, year):
+        total_due = self.tax(year)
+        net_due = total_due - self.year_totals(year).withheld_cash
+        return net_due
 
 def tax_due(events, year):
-    taxable_cash_income = sum(event.amount for event in events if event.tax_effect == TaxEffect.CASH_INCOME)
-    withheld_cash = sum(-event.amount for event in events if event.tax_effect == TaxEffect.CASH_WITHHELD)
-    deductible = sum(abs(event.amount) for event in events if event.tax_effect == TaxEffect.DEDUCTIBLE)
-    tax_rate = us_tax_rate(year=year, amount=taxable_cash_income) + ca_tax_rate(year=year, amount=taxable_cash_income)
-    taxable_income = max((taxable_cash_income - deductible, money(0)))
-    total_due = money(taxable_income * tax_rate)
-    net_due = total_due - withheld_cash
-    return net_due
+    ledger = TaxLedger()
+    for event in events:
+        ledger.add(year=year, amount=event.amount, tax_effect=event.tax_effect)
+    return ledger.tax_due(year=year)
+
+class TestTaxLedger(unittest.TestCase):
+    def test_ledger_matches_tax_due_of_events(self):
+        class Event(object):
+            def __init__(self, amount, tax_effect):
+                self.amount = amount
+                self.tax_effect = tax_effect
+        events = [
+            Event(money('90000.00'), TaxEffect.CASH_INCOME),
+            Event(money('-19350.00'), TaxEffect.CASH_WITHHELD),
+            Event(money('-7200.00'), TaxEffect.CASH_WITHHELD),
+            Event(money('-4440.00'), TaxEffect.DEDUCTIBLE),
+            Event(money('2000.00'), TaxEffect.DEDUCTIBLE),
+            Event(money('-1000.00'), TaxEffect.NONE),
+        ]
+        ledger = TaxLedger()
+        for event in events:
+            ledger.add(year=2017, amount=event.amount, tax_effect=event.tax_effect)
+        ledger.add(year=2018, amount=money('1000000.00'), tax_effect=TaxEffect.CASH_INCOME)
+        self.assertEqual(ledger.year_totals(2017).taxable_cash_income, money('90000.00'))
+        self.assertEqual(ledger.year_totals(2017).withheld_cash, money('26550.00'))
+        self.assertEqual(ledger.year_totals(2017).deductible, money('6440.00'))
+        self.assertEqual(ledger.tax_due(year=2017), tax_due(events=events, year=2017))
+        self.assertEqual(ledger.tax_due(year=2016), money(0))
+
+class TestTaxBracketTable(unittest.TestCase):
+    def test_marginal_rates(self):
+        self.assertEqual(us_tax_rate(year=2017, amount=money('9275.99')), Decimal('0.10'))
+        self.assertEqual(us_tax_rate(year=2017, amount=money('9276.00')), Decimal('0.15'))
+        self.assertEqual(us_tax_rate(year=2017, amount=money('1000000.00')), Decimal('0.396'))
+        self.assertEqual(us_tax_rate(year=2019, amount=money('1000000.00')), Decimal('0.37'))
+        self.assertEqual(ca_tax_rate(year=2030, amount=money('0.00')), Decimal('0.01'))
+        self.assertEqual(ca_tax_rate(year=2017, amount=money('1000000.00')), Decimal('0.133'))
+
+    def test_tables_are_chosen_by_year(self):
+        self.assertEqual(bracket_table(Jurisdiction.US, 2010).year, 2016)
+        self.assertEqual(bracket_table(Jurisdiction.US, 2017).year, 2016)
+        self.assertEqual(bracket_table(Jurisdiction.US, 2018).year, 2018)
+        self.assertEqual(bracket_table(Jurisdiction.US, 2047).year, 2018)
+
+    def test_tax_is_progressive(self):
+        table = bracket_table(Jurisdiction.US, 2016)
+        # 927.60 + 4256.25 + 3087.25
+        self.assertEqual(table.tax(money('50000.00')), money('8271.10'))
+        self.assertEqual(table.tax(money('0.00')), money(0))
+        self.assertEqual(table.tax(money('-5.00')), money(0))
+        self.assertEqual(income_tax(year=2016, taxable_income=money('50000.00')), money('8271.10') + bracket_table(Jurisdiction.CA, 2016).tax(money('50000.00')))
+
+    def test_cents_match_decimals(self):
+        incomes_cents = [0, 1, 5, 15, 927599, 927600, 927601, 5000000, 2598440, 2598445, 41505099, 99999999, 100000000, 123456789]
+        for year in [2016, 2018]:
+            for jurisdiction in JURISDICTIONS:
+                table = bracket_table(jurisdiction, year)
+                self.assertEqual(
+                    list(table.tax_cents(incomes_cents)),
+                    [money_to_cents(table.tax(money_from_cents(cents))) for cents in incomes_cents])
+
+    def test_income_tax_of_many_points(self):
+        years = [2016, 2018, 2016, 2030]
+        incomes_cents = [5000000, 5000000, 100000000, 2500]
+        expected = [money_to_cents(income_tax(year=year, taxable_income=money_from_cents(cents))) for (year, cents) in zip(years, incomes_cents)]
+        self.assertEqual(list(income_tax_cents(years, incomes_cents)), expected)
+        self.assertEqual(list(income_tax_cents(2016, incomes_cents[:1])), expected[:1])
+        self.assertEqual(list(income_tax_cents([2016, 2017, 2019, 2030], [5000000] * 4)), [expected[0], expected[0], expected[1], expected[1]])
+        self.assertEqual(list(income_tax_cents([], [])), [])
+
+    def test_income_tax_of_numpy_points(self):
+        try:
+            import numpy
+        except ImportError:
+            self.skipTest('NumPy is not installed')
+        years = numpy.array([2016, 2018, 2016, 2030])
+        incomes_cents = numpy.array([5000000, 5000000, 100000000, 2500])
+        expected = list(income_tax_cents(years.tolist(), incomes_cents.tolist()))
+        self.assertEqual(list(income_tax_cents(years, incomes_cents)), expected)
+        self.assertEqual(list(income_tax_cents(years[0], incomes_cents[:1])), expected[:1])
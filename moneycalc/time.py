@@ -1,30 +1,197 @@
+import abc
+import array
 import datetime
 import unittest
 
+class CalendarTable(object):
+    '''
+    Precomputed calendar facts for every date from January 1 of first_year
+    through December 31 of last_year, indexed by date ordinal.
+
+    Months are numbered by month index: 0 for January of first_year, 1 for
+    February of first_year, and so on. Methods raise IndexError for dates
+    outside the table.
+    '''
+    def __init__(self, first_year, last_year):
+        if first_year > last_year:
+            raise ValueError('first_year must not be after last_year')
+        self.first_year = first_year
+        self.last_year = last_year
+        self.first_ordinal = datetime.date(year=first_year, month=1, day=1).toordinal()
+        self.end_ordinal = datetime.date(year=last_year + 1, month=1, day=1).toordinal()
+        # Indexed by month index, plus a final entry for January of the year
+        # after last_year.
+        self.__month_start_ordinals = array.array('i')
+        for year in range(first_year, last_year + 1):
+            for month in range(1, 12 + 1):
+                self.__month_start_ordinals.append(datetime.date(year=year, month=month, day=1).toordinal())
+        self.__month_start_ordinals.append(self.end_ordinal)
+        # Indexed by ordinal - first_ordinal.
+        self.__month_indexes = array.array('H' if len(self.__month_start_ordinals) <= 0xffff else 'i')
+        for month_index in range(len(self.__month_start_ordinals) - 1):
+            days = self.__month_start_ordinals[month_index + 1] - self.__month_start_ordinals[month_index]
+            self.__month_indexes.extend([month_index] * days)
+
+    def contains_ordinal(self, ordinal):
+        return self.first_ordinal <= ordinal < self.end_ordinal
+
+    def month_index(self, ordinal):
+        index = ordinal - self.first_ordinal
+        if index < 0:
+            raise IndexError('Date is before the calendar table')
+        return self.__month_indexes[index]
+
+    def month_start_ordinal(self, month_index):
+        if month_index < 0:
+            raise IndexError('Month is before the calendar table')
+        return self.__month_start_ordinals[month_index]
+
+    def year_month_index(self, year, month):
+        return (year - self.first_year) * 12 + (month - 1)
+
+    def ymd(self, ordinal):
+        '''
+        Returns a tuple of the year, month and day of the given ordinal.
+        '''
+        month_index = self.month_index(ordinal)
+        (years, month) = divmod(month_index, 12)
+        return (self.first_year + years, month + 1, ordinal - self.__month_start_ordinals[month_index] + 1)
+
+    def ordinal(self, year, month, day):
+        month_index = self.year_month_index(year, month)
+        start = self.month_start_ordinal(month_index)
+        if not 1 <= month <= 12 or not 1 <= day <= self.__month_start_ordinals[month_index + 1] - start:
+            raise ValueError('Invalid date: {}-{}-{}'.format(year, month, day))
+        return start + day - 1
+
+    def add_months(self, ordinal, months):
+        '''
+        Returns the ordinal of the same day of the month the given number of
+        months after the given ordinal. Raises ValueError if that month has
+        no such day.
+        '''
+        month_index = self.month_index(ordinal)
+        day_offset = ordinal - self.__month_start_ordinals[month_index]
+        new_month_index = month_index + months
+        new_ordinal = self.month_start_ordinal(new_month_index) + day_offset
+        if new_ordinal >= self.__month_start_ordinals[new_month_index + 1]:
+            raise ValueError('day is out of range for month')
+        return new_ordinal
+
+    def diff_months(self, x, y):
+        '''
+        Returns the number of months from ordinal y to the same day of the
+        month at ordinal x.
+        '''
+        if x < y:
+            raise NotImplementedError()
+        x_month_index = self.month_index(x)
+        y_month_index = self.month_index(y)
+        if x - self.__month_start_ordinals[x_month_index] != y - self.__month_start_ordinals[y_month_index]:
+            raise NotImplementedError()
+        return x_month_index - y_month_index
+
+    def next_month_start_ordinal(self, ordinal):
+        '''
+        Returns the ordinal of the first day of the month after the given
+        ordinal's month.
+        '''
+        return self.__month_start_ordinals[self.month_index(ordinal) + 1]
+
+    def is_month(self, start_ordinal, end_ordinal):
+        '''
+        Returns whether start_ordinal is the first day of a month and
+        end_ordinal is the first day of the next month.
+        '''
+        month_index = self.month_index(start_ordinal)
+        return self.__month_start_ordinals[month_index] == start_ordinal and self.__month_start_ordinals[month_index + 1] == end_ordinal
+
+    def days_in_year(self, year):
+        month_index = self.year_month_index(year, 1)
+        return self.month_start_ordinal(month_index + 12) - self.month_start_ordinal(month_index)
+
+_calendar = CalendarTable(first_year=1900, last_year=2200)
+
+def calendar_table():
+    return _calendar
+
+def set_calendar_range(first_year, last_year):
+    '''
+    Replaces the CalendarTable used by this module's functions. Dates
+    outside the table still work, but are slower.
+    '''
+    global _calendar
+    _calendar = CalendarTable(first_year=first_year, last_year=last_year)
+
+def ordinal_add_month(ordinal):
+    try:
+        return _calendar.add_months(ordinal, 1)
+    except IndexError:
+        return add_month(datetime.date.fromordinal(ordinal)).toordinal()
+
+def ordinal_next_month_start(ordinal):
+    try:
+        return _calendar.next_month_start_ordinal(ordinal)
+    except IndexError:
+        date = datetime.date.fromordinal(ordinal)
+        return _slow_add_month(datetime.date(year=date.year, month=date.month, day=1)).toordinal()
+
 def add_month(date):
+    try:
+        return datetime.date.fromordinal(_calendar.add_months(date.toordinal(), 1))
+    except IndexError:
+        return _slow_add_month(date)
+
+def sub_month(date):
+    try:
+        return datetime.date.fromordinal(_calendar.add_months(date.toordinal(), -1))
+    except IndexError:
+        return _slow_sub_month(date)
+
+def add_years(date, years):
+    '''
+    Returns the same month and day the given number of years later, or the
+    last day of the month if it is shorter (i.e. February 29 becomes
+    February 28 outside leap years).
+    '''
+    return datetime.date.fromordinal(_day_of_month_ordinal(date.year + years, date.month, date.day))
+
+def diff_months(x, y):
+    try:
+        return _calendar.diff_months(x.toordinal(), y.toordinal())
+    except IndexError:
+        return _slow_diff_months(x, y)
+
+def days_in_year(year):
+    try:
+        return _calendar.days_in_year(year)
+    except IndexError:
+        return _slow_days_in_year(year)
+
+def _slow_add_month(date):
     if date.month == 12:
         return datetime.date(year=date.year + 1, month=1, day=date.day)
     else:
         return datetime.date(year=date.year, month=date.month + 1, day=date.day)
 
-def sub_month(date):
+def _slow_sub_month(date):
     if date.month == 1:
         return datetime.date(year=date.year - 1, month=12, day=date.day)
     else:
         return datetime.date(year=date.year, month=date.month - 1, day=date.day)
 
-def diff_months(x, y):
+def _slow_diff_months(x, y):
     if x < y:
         raise NotImplementedError()
     months = 0
     while x > y:
-        x = sub_month(x)
+        x = _slow_sub_month(x)
         months += 1
     if x != y:
         raise NotImplementedError()
     return months
 
-def days_in_year(year):
+def _slow_days_in_year(year):
     return (datetime.date(year=year + 1, month=1, day=1) - datetime.date(year=year, month=1, day=1)).days
 
 class Period(object):
@@ -32,30 +199,194 @@ class Period(object):
         assert start_date <= end_date
         self.start_date = start_date
         self.end_date = end_date
+        self.start_ordinal = start_date.toordinal()
+        self.end_ordinal = end_date.toordinal()
+
+    @staticmethod
+    def from_ordinals(start_ordinal, end_ordinal):
+        return Period(datetime.date.fromordinal(start_ordinal), datetime.date.fromordinal(end_ordinal))
 
     def __contains__(self, value):
-        if hasattr(value, 'start_date') and hasattr(value, 'end_date'):
+        if isinstance(value, Period):
+            return self.start_ordinal <= value.start_ordinal and value.end_ordinal <= self.end_ordinal
+        elif hasattr(value, 'start_date') and hasattr(value, 'end_date'):
             return self.start_date <= value.start_date and value.end_date <= self.end_date
         else:
             return self.start_date <= value and value < self.end_date
 
+    def contains_ordinal(self, ordinal):
+        return self.start_ordinal <= ordinal < self.end_ordinal
+
     def __repr__(self):
         return 'Period({}, {})'.format(repr(self.start_date), repr(self.end_date))
 
     @property
     def days(self):
-        return (self.end_date - self.start_date).days
+        return self.end_ordinal - self.start_ordinal
 
     @property
     def is_day(self):
-        return self.days == 1
+        return self.end_ordinal - self.start_ordinal == 1
 
     @property
     def is_month(self):
-        return self.start_date.day == 1 and self.end_date.day == 1 and add_month(self.start_date) == self.end_date
+        try:
+            return _calendar.is_month(self.start_ordinal, self.end_ordinal)
+        except IndexError:
+            return self.start_date.day == 1 and self.end_date.day == 1 and _slow_add_month(self.start_date) == self.end_date
 
     def intersects(self, other):
-        return self.start_date < other.end_date and other.start_date < self.end_date
+        return self.start_ordinal < other.end_ordinal and other.start_ordinal < self.end_ordinal
+
+class RecurrenceRule(object):
+    '''
+    A rule for dates on which something recurs, such as "every other
+    Friday" or "the 1st of every month".
+    '''
+    @abc.abstractmethod
+    def ordinals(self, period):
+        '''
+        Returns the date ordinals of the occurrences within the given period
+        as a sorted array('i').
+        '''
+        raise NotImplementedError()
+
+class Once(RecurrenceRule):
+    def __init__(self, date):
+        self.date = date
+
+    def ordinals(self, period):
+        if self.date in period:
+            return array.array('i', [self.date.toordinal()])
+        return array.array('i')
+
+class EveryNDays(RecurrenceRule):
+    '''
+    Recurs on first_date and every days days after.
+    '''
+    def __init__(self, first_date, days):
+        if days < 1:
+            raise ValueError('days must be at least 1')
+        self.first_date = first_date
+        self.days = days
+
+    def ordinals(self, period):
+        first = self.first_date.toordinal()
+        start = period.start_date.toordinal()
+        if start > first:
+            first += -(-(start - first) // self.days) * self.days
+        return array.array('i', range(first, period.end_date.toordinal(), self.days))
+
+class OnDayOfMonths(RecurrenceRule):
+    '''
+    Recurs on the given day of each of the given months every year.
+
+    months must be sorted. A month may be listed more than once, in which
+    case it recurs more than once on that day. In months with fewer than day
+    days (e.g. day 31 in April), it recurs on the month's last day instead.
+    '''
+    def __init__(self, day, months):
+        months = tuple(months)
+        if list(months) != sorted(months):
+            raise ValueError('months must be sorted')
+        if not 1 <= day <= 31:
+            raise ValueError('day must be between 1 and 31')
+        self.day = day
+        self.months = months
+
+    def ordinals(self, period):
+        start = period.start_date.toordinal()
+        end = period.end_date.toordinal()
+        ordinals = array.array('i')
+        for year in range(period.start_date.year, period.end_date.year + 1):
+            for month in self.months:
+                ordinal = _day_of_month_ordinal(year, month, self.day)
+                if start <= ordinal < end:
+                    ordinals.append(ordinal)
+        return ordinals
+
+def _day_of_month_ordinal(year, month, day):
+    '''
+    Returns the ordinal of the given day of the given month, or of the
+    month's last day if the month is shorter.
+    '''
+    try:
+        month_index = _calendar.year_month_index(year, month)
+        month_start = _calendar.month_start_ordinal(month_index)
+        next_month_start = _calendar.month_start_ordinal(month_index + 1)
+    except IndexError:
+        month_start_date = datetime.date(year=year, month=month, day=1)
+        month_start = month_start_date.toordinal()
+        next_month_start = _slow_add_month(month_start_date).toordinal()
+    return month_start + min(day, next_month_start - month_start) - 1
+
+class Within(RecurrenceRule):
+    '''
+    Recurs when rule does, but only within the given period.
+    '''
+    def __init__(self, rule, period):
+        self.rule = rule
+        self.period = period
+
+    def ordinals(self, period):
+        start_date = max(period.start_date, self.period.start_date)
+        end_date = min(period.end_date, self.period.end_date)
+        if start_date >= end_date:
+            return array.array('i')
+        return self.rule.ordinals(Period(start_date, end_date))
+
+def biweekly(first_date):
+    return EveryNDays(first_date=first_date, days=2 * 7)
+
+def monthly(day):
+    return OnDayOfMonths(day=day, months=range(1, 12 + 1))
+
+def quarterly(day, months=(1, 4, 7, 10)):
+    return OnDayOfMonths(day=day, months=months)
+
+def semiannually(day, months=(1, 7)):
+    return OnDayOfMonths(day=day, months=months)
+
+def yearly(month, day):
+    return OnDayOfMonths(day=day, months=[month])
+
+class Schedule(object):
+    '''
+    Recurrence rules, each with a handler to call on its occurrences and an
+    optional category (e.g. 'salary') describing the handler.
+    '''
+    def __init__(self):
+        self.__rules = []
+        self.handlers = []
+        self.categories = []
+
+    def add(self, rule, handler, category=None):
+        '''
+        Adds a rule and returns its handler's id.
+        '''
+        handler_id = len(self.handlers)
+        self.__rules.append(rule)
+        self.handlers.append(handler)
+        self.categories.append(category)
+        return handler_id
+
+    def expand(self, period):
+        '''
+        Returns a tuple of two arrays: the date ordinals of every occurrence
+        of every rule within the given period, sorted, and the id of the
+        handler of each occurrence.
+
+        Occurrences on the same date are ordered by handler id, i.e. in the
+        order their rules were added.
+        '''
+        handler_count = len(self.handlers)
+        keys = []
+        for (handler_id, rule) in enumerate(self.__rules):
+            keys.extend(ordinal * handler_count + handler_id for ordinal in rule.ordinals(period))
+        keys.sort()
+        ordinals = array.array('i', [key // handler_count for key in keys])
+        handler_ids = array.array('i', [key % handler_count for key in keys])
+        return (ordinals, handler_ids)
 
 class TestDateMath(unittest.TestCase):
     def test_add_month(self):
@@ -67,6 +398,51 @@ class TestDateMath(unittest.TestCase):
         # with self.assertRaises(Exception):
         #    datetime.date(2017, 1, 30)
 
+    def test_add_years_clamps_leap_days(self):
+        self.assertEqual(add_years(datetime.date(2017, 3, 19), 30), datetime.date(2047, 3, 19))
+        self.assertEqual(add_years(datetime.date(2016, 2, 29), 5), datetime.date(2021, 2, 28))
+        self.assertEqual(add_years(datetime.date(2016, 2, 29), 4), datetime.date(2020, 2, 29))
+        self.assertEqual(add_years(datetime.date(2196, 2, 29), 5), datetime.date(2201, 2, 28))
+
+    def test_table_matches_datetime(self):
+        table = CalendarTable(first_year=1999, last_year=2001)
+        date = datetime.date(1999, 1, 1)
+        while date < datetime.date(2002, 1, 1):
+            ordinal = date.toordinal()
+            self.assertEqual(table.ymd(ordinal), (date.year, date.month, date.day))
+            self.assertEqual(table.ordinal(date.year, date.month, date.day), ordinal)
+            if (date.year, date.month) < (2001, 12):
+                try:
+                    expected = _slow_add_month(date).toordinal()
+                except ValueError:
+                    with self.assertRaises(ValueError):
+                        table.add_months(ordinal, 1)
+                else:
+                    self.assertEqual(table.add_months(ordinal, 1), expected)
+            date += datetime.timedelta(days=1)
+        with self.assertRaises(IndexError):
+            table.ymd(datetime.date(1998, 12, 31).toordinal())
+        with self.assertRaises(IndexError):
+            table.add_months(datetime.date(2001, 12, 5).toordinal(), 1)
+        with self.assertRaises(ValueError):
+            table.ordinal(2001, 2, 29)
+
+    def test_dates_outside_table_fall_back(self):
+        self.assertEqual(add_month(datetime.date(2200, 12, 5)), datetime.date(2201, 1, 5))
+        self.assertEqual(sub_month(datetime.date(1900, 1, 5)), datetime.date(1899, 12, 5))
+        self.assertEqual(diff_months(datetime.date(2201, 3, 5), datetime.date(2200, 11, 5)), 4)
+        self.assertEqual(days_in_year(2400), 366)
+        self.assertTrue(Period(datetime.date(2400, 2, 1), datetime.date(2400, 3, 1)).is_month)
+
+    def test_diff_months(self):
+        self.assertEqual(diff_months(datetime.date(2047, 1, 1), datetime.date(2017, 1, 1)), 360)
+        self.assertEqual(diff_months(datetime.date(2017, 3, 19), datetime.date(2016, 7, 19)), 8)
+        self.assertEqual(diff_months(datetime.date(2017, 3, 19), datetime.date(2017, 3, 19)), 0)
+        with self.assertRaises(NotImplementedError):
+            diff_months(datetime.date(2017, 3, 19), datetime.date(2017, 3, 20))
+        with self.assertRaises(NotImplementedError):
+            diff_months(datetime.date(2017, 3, 20), datetime.date(2016, 7, 19))
+
     def test_days_in_year(self):
         self.assertEqual(days_in_year(1600), 366)
         self.assertEqual(days_in_year(1700), 365)
@@ -85,6 +461,13 @@ class TestDateMath(unittest.TestCase):
         self.assertEqual(days_in_year(2010), 365)
 
 class TestPeriod(unittest.TestCase):
+    def test_is_month(self):
+        self.assertTrue(Period(datetime.date(2017, 2, 1), datetime.date(2017, 3, 1)).is_month)
+        self.assertTrue(Period(datetime.date(2017, 12, 1), datetime.date(2018, 1, 1)).is_month)
+        self.assertFalse(Period(datetime.date(2017, 2, 1), datetime.date(2017, 4, 1)).is_month)
+        self.assertFalse(Period(datetime.date(2017, 2, 2), datetime.date(2017, 3, 2)).is_month)
+        self.assertFalse(Period(datetime.date(2017, 2, 1), datetime.date(2017, 2, 2)).is_month)
+
     def test_intersects(self):
         jan_to_feb = Period(datetime.date(2017, 1, 1), datetime.date(2017, 2, 1))
         feb_to_march = Period(datetime.date(2017, 2, 1), datetime.date(2017, 3, 1))
@@ -103,3 +486,74 @@ class TestPeriod(unittest.TestCase):
         self.assertTrue(jan_to_march.intersects(jan_to_feb))
         self.assertFalse(feb_to_march.intersects(jan_to_feb))
         self.assertTrue(jan_to_march.intersects(feb_to_march))
+
+class TestRecurrenceRules(unittest.TestCase):
+    def dates(self, rule, start_date, end_date):
+        return [datetime.date.fromordinal(ordinal) for ordinal in rule.ordinals(Period(start_date, end_date))]
+
+    def test_every_n_days_is_anchored_at_first_date(self):
+        rule = biweekly(datetime.date(2017, 1, 6))
+        self.assertEqual(self.dates(rule, datetime.date(2017, 1, 1), datetime.date(2017, 2, 4)), [
+            datetime.date(2017, 1, 6),
+            datetime.date(2017, 1, 20),
+            datetime.date(2017, 2, 3),
+        ])
+        self.assertEqual(self.dates(rule, datetime.date(2017, 1, 7), datetime.date(2017, 2, 3)), [
+            datetime.date(2017, 1, 20),
+        ])
+
+    def test_day_of_months_matches_add_month(self):
+        expected = []
+        date = datetime.date(2017, 1, 15)
+        while date < datetime.date(2020, 1, 1):
+            expected.append(date)
+            date = add_month(date)
+        self.assertEqual(self.dates(monthly(15), datetime.date(2017, 1, 1), datetime.date(2020, 1, 1)), expected)
+
+    def test_repeated_months_recur_repeatedly(self):
+        self.assertEqual(self.dates(OnDayOfMonths(day=1, months=[4, 7, 7]), datetime.date(2017, 1, 2), datetime.date(2017, 12, 31)), [
+            datetime.date(2017, 4, 1),
+            datetime.date(2017, 7, 1),
+            datetime.date(2017, 7, 1),
+        ])
+
+    def test_late_days_clamp_to_month_end(self):
+        period = Period(datetime.date(2016, 1, 1), datetime.date(2016, 5, 1))
+        self.assertEqual(self.dates(monthly(31), period.start_date, period.end_date), [
+            datetime.date(2016, 1, 31),
+            datetime.date(2016, 2, 29),
+            datetime.date(2016, 3, 31),
+            datetime.date(2016, 4, 30),
+        ])
+        self.assertEqual(self.dates(yearly(month=2, day=29), datetime.date(2017, 1, 1), datetime.date(2018, 1, 1)), [datetime.date(2017, 2, 28)])
+        # Outside the calendar table.
+        self.assertEqual(self.dates(yearly(month=2, day=30), datetime.date(2300, 1, 1), datetime.date(2301, 1, 1)), [datetime.date(2300, 2, 28)])
+        with self.assertRaises(ValueError):
+            monthly(32)
+        with self.assertRaises(ValueError):
+            monthly(0)
+
+    def test_within_bounds_rule(self):
+        rule = Within(monthly(19), Period(datetime.date(2016, 7, 19), datetime.date(2016, 10, 19)))
+        self.assertEqual(self.dates(rule, datetime.date(2016, 8, 1), datetime.date(2017, 1, 1)), [
+            datetime.date(2016, 8, 19),
+            datetime.date(2016, 9, 19),
+        ])
+        self.assertEqual(self.dates(rule, datetime.date(2017, 1, 1), datetime.date(2018, 1, 1)), [])
+
+    def test_schedule_orders_ties_by_rule(self):
+        schedule = Schedule()
+        schedule.add(yearly(month=4, day=1), 'taxes')
+        schedule.add(Once(datetime.date(2017, 1, 1)), 'purchase')
+        schedule.add(monthly(1), 'insurance')
+        (ordinals, handler_ids) = schedule.expand(Period(datetime.date(2017, 1, 1), datetime.date(2017, 5, 1)))
+        self.assertEqual(
+            [(datetime.date.fromordinal(ordinal), schedule.handlers[handler_id]) for (ordinal, handler_id) in zip(ordinals, handler_ids)],
+            [
+                (datetime.date(2017, 1, 1), 'purchase'),
+                (datetime.date(2017, 1, 1), 'insurance'),
+                (datetime.date(2017, 2, 1), 'insurance'),
+                (datetime.date(2017, 3, 1), 'insurance'),
+                (datetime.date(2017, 4, 1), 'taxes'),
+                (datetime.date(2017, 4, 1), 'insurance'),
+            ])
@@ -1,7 +1,53 @@
+from moneycalc.money import money
+from moneycalc.money import money_from_cents
+from moneycalc.money import money_to_cents
 from moneycalc.tax import TaxEffect
+from moneycalc.tax import TaxLedger
+from moneycalc.util import ChunkedArray
+from moneycalc.util import _INT64_TYPECODE
+import array
+import collections
+import copy
+import datetime
+import itertools
+import unittest
+
+_TAX_EFFECTS = [TaxEffect.NONE, TaxEffect.CASH_INCOME, TaxEffect.CASH_WITHHELD, TaxEffect.DEDUCTIBLE]
+_TAX_EFFECT_CODES = dict((tax_effect, code) for (code, tax_effect) in enumerate(_TAX_EFFECTS))
+
+class Rollup(object):
+    # One event per calendar month (dated the first of the month).
+    MONTH = 'MONTH'
+    # One event per calendar year (dated January 1).
+    YEAR = 'YEAR'
 
 class Timeline(object):
+    '''
+    An append-only record of money moving in and out of accounts.
+
+    Events are stored column by column: date ordinals, account ids, amounts
+    in cents, interned description ids and tax effect codes, each in a
+    ChunkedArray. Timeline.Event objects are created only when events are
+    read.
+
+    fork() and copy.deepcopy share the recorded events copy-on-write.
+
+    If sink (e.g. a moneycalc.sink.CSVTimelineSink) is given, every event is
+    also passed to the sink. If keep_events is False, events are not kept;
+    only the account summaries, the tax ledger and the total interest are,
+    so memory does not grow with the number of events, and the methods
+    which read events raise ValueError. Accounts do not record their
+    balance histories either (see Account.record_balance).
+
+    If rollup is a Rollup, kept events are merged as they are added: all
+    events in the same month (or year) with the same account, description,
+    tax effect and sign of amount become one event dated the start of the
+    period whose amount is their sum. Account summaries, the tax ledger and
+    the total interest are unaffected. The sink still gets every event.
+    '''
     class Event(object):
+        __slots__ = ('date', 'account', 'amount', 'description', 'tax_effect')
+
         def __init__(self, date, account, amount, description, tax_effect=TaxEffect.NONE):
             self.date = date
             self.account = account
@@ -9,6 +55,23 @@ class Timeline(object):
             self.description = description
             self.tax_effect = tax_effect
 
+        def __eq__(self, other):
+            if not isinstance(other, Timeline.Event):
+                return NotImplemented
+            return (self.date == other.date
+                and self.account is other.account
+                and self.amount == other.amount
+                and self.description == other.description
+                and self.tax_effect == other.tax_effect)
+
+        def __ne__(self, other):
+            equal = self.__eq__(other)
+            if equal is NotImplemented:
+                return equal
+            return not equal
+
+        __hash__ = None
+
         def __str__(self):
             return '{date}: {account} {amount:16} ({description})'.format(
                 account='N/A' if self.account is None else self.account,
@@ -16,32 +79,555 @@ class Timeline(object):
                 date=self.date,
                 description=self.description)
 
-    def __init__(self):
-        self.__events = []
+    class AccountSummary(object):
+        '''
+        Running totals of one account's events within one year.
+        '''
+        def __init__(self):
+            self.deposited = money(0)
+            self.withdrawn = money(0)
+            # Maps each description to the sum of its events' amounts, in
+            # order of each description's first event.
+            self.description_totals = collections.OrderedDict()
+
+        def add(self, amount, description):
+            if amount > 0:
+                self.deposited += amount
+            elif amount < 0:
+                self.withdrawn += amount
+            self.description_totals[description] = self.description_totals.get(description, money(0)) + amount
+
+        def copy(self):
+            summary = Timeline.AccountSummary()
+            summary.deposited = self.deposited
+            summary.withdrawn = self.withdrawn
+            summary.description_totals = collections.OrderedDict(self.description_totals)
+            return summary
+
+    def __init__(self, sink=None, keep_events=True, rollup=None):
+        if rollup not in (None, Rollup.MONTH, Rollup.YEAR):
+            raise ValueError('Unknown rollup: {}'.format(rollup))
+        self.__sink = sink
+        self.__keep_events = keep_events
+        self.__event_count = 0
+        self.__rollup = rollup
+        # With rollup, maps (period start ordinal, account id, description
+        # id, tax effect code, sign) to the row of the period's events with
+        # those properties.
+        self.__rollup_rows = {}
+
+        self.__date_ordinals = ChunkedArray('i')
+        self.__account_ids = ChunkedArray('i')
+        self.__amount_cents = ChunkedArray(_INT64_TYPECODE)
+        self.__description_ids = ChunkedArray('i')
+        self.__tax_effect_codes = ChunkedArray('b')
+
+        # Account id 0 is no account.
+        self.__accounts = [None]
+        self.__account_ids_by_account = {None: 0}
+        self.__descriptions = []
+        self.__description_ids_by_description = {}
+
+        # Indexes map keys to ChunkedArray-s of row numbers.
+        self.__rows_by_year = {}
+        self.__rows_by_account_id = {}
+        self.__rows_by_account_id_year = {}
+        self.__rows_by_year_tax_effect_code = {}
+        self.__rows_by_description_id = {}
+
+        self.__account_summaries = {}
+        # Index ChunkedArray-s and AccountSummary-s which are shared with a
+        # fork. They are copied before they change.
+        self.__shared_values = frozenset()
+        self.__tax_ledger = TaxLedger()
+        self.__total_interest = money(0)
+
+    def __len__(self):
+        '''
+        The number of events added to this timeline (before any rollup).
+        '''
+        return self.__event_count
+
+    @property
+    def rollup(self):
+        return self.__rollup
+
+    @property
+    def row_count(self):
+        '''
+        The number of events kept by this timeline (after any rollup).
+        '''
+        return len(self.__date_ordinals)
+
+    @property
+    def sink(self):
+        return self.__sink
+
+    @property
+    def keeps_events(self):
+        return self.__keep_events
+
+    def flush(self):
+        '''
+        Writes any events buffered by the sink.
+        '''
+        if self.__sink is not None:
+            self.__sink.flush()
+
+    def __check_keeps_events(self):
+        if not self.__keep_events:
+            raise ValueError('Timeline does not keep events')
+
+    def fork(self, map_account=None):
+        '''
+        Returns a copy of this timeline which shares its events, indexes and
+        summaries copy-on-write, so forking costs little more than copying
+        dicts. Events added to either timeline afterwards are not seen by
+        the other.
+
+        If given, map_account is called with each account of the recorded
+        events and returns the account the copy should use instead.
+        '''
+        if self.__sink is not None:
+            raise ValueError('Cannot fork a timeline which writes to a sink')
+        if map_account is None:
+            map_account = lambda account: account
+        timeline = Timeline.__new__(Timeline)
+        timeline.__sink = None
+        timeline.__keep_events = self.__keep_events
+        timeline.__event_count = self.__event_count
+        timeline.__rollup = self.__rollup
+        timeline.__rollup_rows = dict(self.__rollup_rows)
+        timeline.__date_ordinals = self.__date_ordinals.fork()
+        timeline.__account_ids = self.__account_ids.fork()
+        timeline.__amount_cents = self.__amount_cents.fork()
+        timeline.__description_ids = self.__description_ids.fork()
+        timeline.__tax_effect_codes = self.__tax_effect_codes.fork()
+
+        timeline.__accounts = [None if account is None else map_account(account) for account in self.__accounts]
+        timeline.__account_ids_by_account = dict((account, account_id) for (account_id, account) in enumerate(timeline.__accounts))
+        timeline.__descriptions = list(self.__descriptions)
+        timeline.__description_ids_by_description = dict(self.__description_ids_by_description)
+
+        timeline.__rows_by_year = dict(self.__rows_by_year)
+        timeline.__rows_by_account_id = dict(self.__rows_by_account_id)
+        timeline.__rows_by_account_id_year = dict(self.__rows_by_account_id_year)
+        timeline.__rows_by_year_tax_effect_code = dict(self.__rows_by_year_tax_effect_code)
+        timeline.__rows_by_description_id = dict(self.__rows_by_description_id)
+        timeline.__account_summaries = dict(
+            ((None if account is None else map_account(account), year), summary)
+            for ((account, year), summary) in self.__account_summaries.items()
+        )
+        shared_values = frozenset(itertools.chain(
+            self.__rows_by_year.values(),
+            self.__rows_by_account_id.values(),
+            self.__rows_by_account_id_year.values(),
+            self.__rows_by_year_tax_effect_code.values(),
+            self.__rows_by_description_id.values(),
+            self.__account_summaries.values(),
+        ))
+        self.__shared_values = shared_values
+        timeline.__shared_values = shared_values
+        timeline.__tax_ledger = self.__tax_ledger.fork()
+        timeline.__total_interest = self.__total_interest
+        return timeline
+
+    def __deepcopy__(self, memo):
+        return self.fork(map_account=lambda account: copy.deepcopy(account, memo))
+
+    def to_columns(self):
+        '''
+        Returns a tuple of the kept events' accounts (indexed by account id),
+        their descriptions (indexed by description id), and their columns:
+        array.array-s of date ordinals, account ids, amounts in cents,
+        description ids and tax effect codes.
+        '''
+        self.__check_keeps_events()
+        columns = []
+        for column in [self.__date_ordinals, self.__account_ids, self.__amount_cents, self.__description_ids, self.__tax_effect_codes]:
+            values = array.array(column.typecode)
+            for chunk in column.chunks():
+                values.extend(chunk)
+            columns.append(values)
+        return (list(self.__accounts), list(self.__descriptions), columns)
+
+    @staticmethod
+    def from_columns(accounts, descriptions, columns, event_count=None, total_interest=None):
+        '''
+        Returns a Timeline which keeps the events in the given output of
+        to_columns. The columns are copied into the timeline a chunk at a
+        time, and summaries, the tax ledger and indexes are computed in
+        cents, without creating events.
+
+        Interest deposits cannot be told apart from other deductible
+        deposits, so total_interest (the original timeline's) must be given
+        separately. event_count is the number of events before any rollup.
+        '''
+        (date_ordinals, account_ids, amount_cents, description_ids, tax_effect_codes) = columns
+        row_count = len(date_ordinals)
+        if any(len(column) != row_count for column in columns):
+            raise ValueError('Timeline columns have different lengths')
+        if not accounts or accounts[0] is not None:
+            raise ValueError('Account id 0 must be no account')
+        timeline = Timeline()
+        timeline.__event_count = row_count if event_count is None else event_count
+        timeline.__accounts = list(accounts)
+        timeline.__account_ids_by_account = dict((account, account_id) for (account_id, account) in enumerate(accounts))
+        timeline.__descriptions = list(descriptions)
+        timeline.__description_ids_by_description = dict((description, description_id) for (description_id, description) in enumerate(descriptions))
+        timeline.__date_ordinals.extend(date_ordinals)
+        timeline.__account_ids.extend(account_ids)
+        timeline.__amount_cents.extend(amount_cents)
+        timeline.__description_ids.extend(description_ids)
+        timeline.__tax_effect_codes.extend(tax_effect_codes)
+        if total_interest is not None:
+            timeline.__total_interest = total_interest
+
+        rows_by_year = {}
+        rows_by_account_id = {}
+        rows_by_account_id_year = {}
+        rows_by_year_tax_effect_code = {}
+        rows_by_description_id = {}
+        # Maps (account id, year) to [deposited cents, withdrawn cents,
+        # description id totals in cents].
+        summaries = collections.OrderedDict()
+        # Maps (year, tax effect code) to the total cents for the
+        # TaxLedger.
+        tax_totals = {}
+        years = {}
+        for (row, (date_ordinal, account_id, cents, description_id, tax_effect_code)) in enumerate(zip(date_ordinals, account_ids, amount_cents, description_ids, tax_effect_codes)):
+            year = years.get(date_ordinal)
+            if year is None:
+                year = datetime.date.fromordinal(date_ordinal).year
+                years[date_ordinal] = year
+            rows_by_year.setdefault(year, []).append(row)
+            rows_by_account_id.setdefault(account_id, []).append(row)
+            rows_by_account_id_year.setdefault((account_id, year), []).append(row)
+            rows_by_year_tax_effect_code.setdefault((year, tax_effect_code), []).append(row)
+            rows_by_description_id.setdefault(description_id, []).append(row)
+
+            summary = summaries.get((account_id, year))
+            if summary is None:
+                summary = [0, 0, collections.OrderedDict()]
+                summaries[(account_id, year)] = summary
+            if cents > 0:
+                summary[0] += cents
+            elif cents < 0:
+                summary[1] += cents
+            summary[2][description_id] = summary[2].get(description_id, 0) + cents
+            # Like TaxLedger.add, deductions add up regardless of sign.
+            tax_key = (year, tax_effect_code)
+            tax_totals[tax_key] = tax_totals.get(tax_key, 0) + (abs(cents) if _TAX_EFFECTS[tax_effect_code] == TaxEffect.DEDUCTIBLE else cents)
+
+        for (index, rows) in [
+            (timeline.__rows_by_year, rows_by_year),
+            (timeline.__rows_by_account_id, rows_by_account_id),
+            (timeline.__rows_by_account_id_year, rows_by_account_id_year),
+            (timeline.__rows_by_year_tax_effect_code, rows_by_year_tax_effect_code),
+            (timeline.__rows_by_description_id, rows_by_description_id),
+        ]:
+            for (key, key_rows) in rows.items():
+                index_rows = ChunkedArray('i')
+                index_rows.extend(key_rows)
+                index[key] = index_rows
+        for ((account_id, year), (deposited, withdrawn, description_totals)) in summaries.items():
+            summary = Timeline.AccountSummary()
+            summary.deposited = money_from_cents(deposited)
+            summary.withdrawn = money_from_cents(withdrawn)
+            for (description_id, cents) in description_totals.items():
+                summary.description_totals[descriptions[description_id]] = money_from_cents(cents)
+            timeline.__account_summaries[(accounts[account_id], year)] = summary
+        for ((year, tax_effect_code), cents) in sorted(tax_totals.items()):
+            timeline.__tax_ledger.add(year=year, amount=money_from_cents(cents), tax_effect=_TAX_EFFECTS[tax_effect_code])
+        return timeline
 
     def __iter__(self):
-        return iter(self.__events)
+        self.__check_keeps_events()
+        return self.__iter_rows(range(len(self.__date_ordinals)))
+
+    def __iter_rows(self, rows):
+        from_ordinal = datetime.date.fromordinal
+        date_ordinals = self.__date_ordinals
+        account_ids = self.__account_ids
+        amount_cents = self.__amount_cents
+        description_ids = self.__description_ids
+        tax_effect_codes = self.__tax_effect_codes
+        accounts = self.__accounts
+        descriptions = self.__descriptions
+        for row in rows:
+            yield Timeline.Event(
+                date=from_ordinal(date_ordinals[row]),
+                account=accounts[account_ids[row]],
+                amount=money_from_cents(amount_cents[row]),
+                description=descriptions[description_ids[row]],
+                tax_effect=_TAX_EFFECTS[tax_effect_codes[row]],
+            )
+
+    def __events_at_rows(self, index, key):
+        self.__check_keeps_events()
+        rows = index.get(key)
+        if rows is None:
+            return []
+        return list(self.__iter_rows(rows))
+
+    def events_in_year(self, year):
+        return self.__events_at_rows(self.__rows_by_year, year)
+
+    def events_for_account(self, account, year=None):
+        self.__check_keeps_events()
+        account_id = self.__account_ids_by_account.get(account)
+        if account_id is None:
+            return []
+        if year is None:
+            return self.__events_at_rows(self.__rows_by_account_id, account_id)
+        return self.__events_at_rows(self.__rows_by_account_id_year, (account_id, year))
+
+    def events_with_tax_effect(self, year, tax_effect):
+        return self.__events_at_rows(self.__rows_by_year_tax_effect_code, (year, _TAX_EFFECT_CODES[tax_effect]))
+
+    def events_with_description(self, description):
+        self.__check_keeps_events()
+        description_id = self.__description_ids_by_description.get(description)
+        if description_id is None:
+            return []
+        return self.__events_at_rows(self.__rows_by_description_id, description_id)
+
+    def account_summary(self, account, year):
+        '''
+        Returns the Timeline.AccountSummary of the given account's events in
+        the given year.
+        '''
+        summary = self.__account_summaries.get((account, year))
+        if summary is None:
+            return Timeline.AccountSummary()
+        return summary
+
+    @property
+    def tax_ledger(self):
+        '''
+        A moneycalc.tax.TaxLedger fed with every event added to this
+        timeline.
+        '''
+        return self.__tax_ledger
+
+    @property
+    def total_interest(self):
+        '''
+        The sum of all interest deposits.
+        '''
+        return self.__total_interest
 
     def add_event(self, event):
-        self.__events.append(event)
+        self.__add(
+            date=event.date,
+            account=event.account,
+            amount=event.amount,
+            description=event.description,
+            tax_effect=event.tax_effect,
+        )
+
+    def __add(self, date, account, amount, description, tax_effect=TaxEffect.NONE):
+        year = date.year
+        self.__event_count += 1
+        if self.__keep_events:
+            self.__keep_event(date, account, amount, description, tax_effect)
+        if self.__sink is not None:
+            self.__sink.add(date=date, account=account, amount=amount, description=description, tax_effect=tax_effect)
+
+        summary = self.__account_summaries.get((account, year))
+        if summary is None:
+            summary = Timeline.AccountSummary()
+            self.__account_summaries[(account, year)] = summary
+        elif summary in self.__shared_values:
+            summary = summary.copy()
+            self.__account_summaries[(account, year)] = summary
+        summary.add(amount=amount, description=description)
+        self.__tax_ledger.add(year=year, amount=amount, tax_effect=tax_effect)
+
+    def __keep_event(self, date, account, amount, description, tax_effect):
+        account_id = self.__account_ids_by_account.get(account)
+        if account_id is None:
+            account_id = len(self.__accounts)
+            self.__accounts.append(account)
+            self.__account_ids_by_account[account] = account_id
+        description_id = self.__description_ids_by_description.get(description)
+        if description_id is None:
+            description_id = len(self.__descriptions)
+            self.__descriptions.append(description)
+            self.__description_ids_by_description[description] = description_id
+        tax_effect_code = _TAX_EFFECT_CODES[tax_effect]
+        cents = money_to_cents(amount)
+
+        if self.__rollup is not None:
+            if self.__rollup == Rollup.MONTH:
+                date = datetime.date(date.year, date.month, 1)
+            else:
+                date = datetime.date(date.year, 1, 1)
+            bucket = (date.toordinal(), account_id, description_id, tax_effect_code, (cents > 0) - (cents < 0))
+            row = self.__rollup_rows.get(bucket)
+            if row is not None:
+                self.__amount_cents[row] += cents
+                return
+            self.__rollup_rows[bucket] = len(self.__date_ordinals)
+
+        row = len(self.__date_ordinals)
+        year = date.year
+        self.__date_ordinals.append(date.toordinal())
+        self.__account_ids.append(account_id)
+        self.__amount_cents.append(cents)
+        self.__description_ids.append(description_id)
+        self.__tax_effect_codes.append(tax_effect_code)
+
+        shared_values = self.__shared_values
+        _index_row(self.__rows_by_year, shared_values, year, row)
+        _index_row(self.__rows_by_account_id, shared_values, account_id, row)
+        _index_row(self.__rows_by_account_id_year, shared_values, (account_id, year), row)
+        _index_row(self.__rows_by_year_tax_effect_code, shared_values, (year, tax_effect_code), row)
+        _index_row(self.__rows_by_description_id, shared_values, description_id, row)
 
     def add_withheld_cash(self, date, amount, description):
-        self.add_event(Timeline.Event(date=date, account=None, amount=-amount, description=description, tax_effect=TaxEffect.CASH_WITHHELD))
+        self.__add(date=date, account=None, amount=-amount, description=description, tax_effect=TaxEffect.CASH_WITHHELD)
 
     def add_income(self, date, amount, description):
-        self.add_event(Timeline.Event(date=date, account=None, amount=amount, description=description, tax_effect=TaxEffect.CASH_INCOME))
+        self.__add(date=date, account=None, amount=amount, description=description, tax_effect=TaxEffect.CASH_INCOME)
 
     def add_tax_deduction(self, date, account, amount, description):
-        self.add_event(Timeline.Event(date=date, account=account, amount=amount, description=description, tax_effect=TaxEffect.DEDUCTIBLE))
+        self.__add(date=date, account=account, amount=amount, description=description, tax_effect=TaxEffect.DEDUCTIBLE)
 
     def add_generic_deposit(self, date, account, amount, description):
-        self.add_event(Timeline.Event(date=date, account=account, amount=amount, description=description))
+        self.__add(date=date, account=account, amount=amount, description=description)
 
     def add_principal_deposit(self, date, account, amount, description):
-        self.add_event(Timeline.Event(date=date, account=account, amount=amount, description=description))
+        self.__add(date=date, account=account, amount=amount, description=description)
 
     def add_interest_deposit(self, date, account, amount, description):
-        self.add_event(Timeline.Event(date=date, account=account, amount=amount, description=description, tax_effect=TaxEffect.DEDUCTIBLE))
+        self.__total_interest += amount
+        self.__add(date=date, account=account, amount=amount, description=description, tax_effect=TaxEffect.DEDUCTIBLE)
 
     def add_withdrawl(self, date, account, amount, description, tax_effect=TaxEffect.NONE):
-        self.add_event(Timeline.Event(date=date, account=account, amount=-amount, description=description, tax_effect=tax_effect))
+        self.__add(date=date, account=account, amount=-amount, description=description, tax_effect=tax_effect)
+
+def _index_row(index, shared_values, key, row):
+    rows = index.get(key)
+    if rows is None:
+        rows = ChunkedArray('i')
+        index[key] = rows
+    elif rows in shared_values:
+        rows = rows.fork()
+        index[key] = rows
+    rows.append(row)
+
+class TestTimeline(unittest.TestCase):
+    def test_indexes_and_summaries_match_scans(self):
+        checking = 'Checking'
+        savings = 'Savings'
+        timeline = Timeline()
+        timeline.add_income(date=datetime.date(2017, 1, 6), amount=money('100.00'), description='Salary')
+        timeline.add_generic_deposit(date=datetime.date(2017, 1, 6), account=checking, amount=money('80.00'), description='Salary')
+        timeline.add_withdrawl(date=datetime.date(2017, 3, 1), account=checking, amount=money('30.00'), description='Rent')
+        timeline.add_interest_deposit(date=datetime.date(2017, 4, 1), account=savings, amount=money('1.50'), description='Interest')
+        timeline.add_withdrawl(date=datetime.date(2018, 3, 1), account=checking, amount=money('30.00'), description='Rent')
+        timeline.add_withdrawl(date=datetime.date(2018, 4, 1), account=checking, amount=money('5.00'), description='Rent')
+        events = list(timeline)
+
+        self.assertEqual(timeline.events_in_year(2018), [e for e in events if e.date.year == 2018])
+        self.assertEqual(timeline.events_for_account(checking), [e for e in events if e.account is checking])
+        self.assertEqual(timeline.events_for_account(checking, year=2017), [e for e in events if e.account is checking and e.date.year == 2017])
+        self.assertEqual(timeline.events_with_tax_effect(year=2017, tax_effect=TaxEffect.DEDUCTIBLE), [events[3]])
+        self.assertEqual(timeline.events_with_description('Rent'), [events[2], events[4], events[5]])
+        self.assertEqual(timeline.events_for_account(savings, year=2018), [])
+
+        summary = timeline.account_summary(account=checking, year=2018)
+        self.assertEqual(summary.deposited, money(0))
+        self.assertEqual(summary.withdrawn, money('-35.00'))
+        self.assertEqual(list(summary.description_totals.items()), [('Rent', money('-35.00'))])
+        summary = timeline.account_summary(account=checking, year=2017)
+        self.assertEqual(summary.deposited, money('80.00'))
+        self.assertEqual(list(summary.description_totals.items()), [('Salary', money('80.00')), ('Rent', money('-30.00'))])
+
+    def test_fork_shares_history_but_not_new_events(self):
+        checking = 'Checking'
+        timeline = Timeline()
+        for day in range(1, 29):
+            timeline.add_generic_deposit(date=datetime.date(2017, 2, day), account=checking, amount=money('1.00'), description='Deposit')
+        fork = timeline.fork()
+        timeline.add_withdrawl(date=datetime.date(2017, 3, 1), account=checking, amount=money('5.00'), description='Rent')
+        fork.add_income(date=datetime.date(2017, 3, 2), amount=money('7.00'), description='Salary')
+
+        self.assertEqual(len(timeline), 29)
+        self.assertEqual(len(fork), 29)
+        self.assertEqual(list(timeline)[:28], list(fork)[:28])
+        self.assertEqual(timeline.events_with_description('Salary'), [])
+        self.assertEqual(fork.events_with_description('Rent'), [])
+        self.assertEqual(timeline.account_summary(account=checking, year=2017).withdrawn, money('-5.00'))
+        self.assertEqual(fork.account_summary(account=checking, year=2017).withdrawn, money(0))
+        self.assertEqual(fork.tax_ledger.year_totals(2017).taxable_cash_income, money('7.00'))
+        self.assertEqual(timeline.tax_ledger.year_totals(2017).taxable_cash_income, money(0))
+
+    def test_fork_maps_accounts(self):
+        old_account = object()
+        new_account = object()
+        timeline = Timeline()
+        timeline.add_generic_deposit(date=datetime.date(2017, 2, 1), account=old_account, amount=money('1.00'), description='Deposit')
+        fork = timeline.fork(map_account=lambda account: new_account)
+        self.assertTrue(list(fork)[0].account is new_account)
+        self.assertEqual(len(fork.events_for_account(new_account)), 1)
+        self.assertEqual(fork.account_summary(account=new_account, year=2017).deposited, money('1.00'))
+
+    def test_timelines_without_events_keep_summaries(self):
+        checking = 'Checking'
+        timelines = [Timeline(), Timeline(keep_events=False)]
+        for timeline in timelines:
+            timeline.add_income(date=datetime.date(2017, 1, 6), amount=money('100.00'), description='Salary')
+            timeline.add_generic_deposit(date=datetime.date(2017, 1, 6), account=checking, amount=money('80.00'), description='Salary')
+            timeline.add_interest_deposit(date=datetime.date(2017, 4, 1), account=checking, amount=money('-1.50'), description='Interest')
+        (kept, streamed) = timelines
+        self.assertEqual(len(streamed), len(kept))
+        self.assertEqual(streamed.total_interest, kept.total_interest)
+        self.assertEqual(streamed.tax_ledger.tax_due(2017), kept.tax_ledger.tax_due(2017))
+        self.assertEqual(
+            list(streamed.account_summary(account=checking, year=2017).description_totals.items()),
+            list(kept.account_summary(account=checking, year=2017).description_totals.items()))
+        with self.assertRaises(ValueError):
+            list(streamed)
+        with self.assertRaises(ValueError):
+            streamed.events_for_account(checking)
+
+    def test_rollup_merges_events_by_period(self):
+        checking = 'Checking'
+        timelines = [Timeline(), Timeline(rollup=Rollup.MONTH), Timeline(rollup=Rollup.YEAR)]
+        for timeline in timelines:
+            for day in range(1, 29):
+                for month in [1, 2]:
+                    date = datetime.date(2017, month, day)
+                    timeline.add_income(date=date, amount=money('100.00'), description='Salary')
+                    timeline.add_generic_deposit(date=date, account=checking, amount=money('80.00'), description='Salary')
+                    timeline.add_withdrawl(date=date, account=checking, amount=money('1.00') * day, description='Spending')
+            timeline.add_interest_deposit(date=datetime.date(2018, 1, 1), account=checking, amount=money('0.00'), description='Interest')
+            timeline.add_interest_deposit(date=datetime.date(2018, 1, 2), account=checking, amount=money('2.50'), description='Interest')
+            timeline.add_interest_deposit(date=datetime.date(2018, 1, 3), account=checking, amount=money('-1.50'), description='Interest')
+        (unrolled, monthly, yearly) = timelines
+        self.assertEqual([len(timeline) for timeline in timelines], [2 * 28 * 3 + 3] * 3)
+        self.assertEqual([timeline.row_count for timeline in timelines], [2 * 28 * 3 + 3, 2 * 3 + 3, 3 + 3])
+        self.assertEqual([(e.date, e.account, e.amount, e.description) for e in yearly.events_for_account(checking, year=2017)], [
+            (datetime.date(2017, 1, 1), checking, money('4480.00'), 'Salary'),
+            (datetime.date(2017, 1, 1), checking, money('-812.00'), 'Spending'),
+        ])
+        self.assertEqual([e.amount for e in monthly.events_with_description('Spending')], [money('-406.00'), money('-406.00')])
+        self.assertEqual([e.amount for e in monthly.events_with_description('Interest')], [money('0.00'), money('2.50'), money('-1.50')])
+        for timeline in [monthly, yearly]:
+            self.assertEqual(timeline.total_interest, unrolled.total_interest)
+            self.assertEqual(timeline.tax_ledger.tax_due(2017), unrolled.tax_ledger.tax_due(2017))
+            summary = timeline.account_summary(account=checking, year=2017)
+            self.assertEqual((summary.deposited, summary.withdrawn), (money('4480.00'), money('-812.00')))
+            self.assertEqual(sum(e.amount for e in timeline), sum(e.amount for e in unrolled))
+
+    def test_forked_rollups_are_independent(self):
+        checking = 'Checking'
+        timeline = Timeline(rollup=Rollup.MONTH)
+        timeline.add_generic_deposit(date=datetime.date(2017, 2, 1), account=checking, amount=money('1.00'), description='Deposit')
+        fork = timeline.fork()
+        timeline.add_generic_deposit(date=datetime.date(2017, 2, 2), account=checking, amount=money('2.00'), description='Deposit')
+        fork.add_generic_deposit(date=datetime.date(2017, 2, 3), account=checking, amount=money('3.00'), description='Deposit')
+        self.assertEqual([e.amount for e in timeline], [money('3.00')])
+        self.assertEqual([e.amount for e in fork], [money('4.00')])
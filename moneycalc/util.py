@@ -1,12 +1,285 @@
+import array
+import heapq
+import unittest
+
+try:
+    array.array('q')
+    _INT64_TYPECODE = 'q'
+except ValueError:
+    # Python 2's array has no 'q'. 'l' is 64 bits on LP64 platforms.
+    _INT64_TYPECODE = 'l'
+
+class MergedIterator(object):
+    '''
+    Yields the items of several sorted iterables in sorted order.
+
+    Items with equal keys are yielded in the order of their iterables. An
+    iterable stops at its first None item.
+
+    Nested MergedIterator-s which share the same key function and have not
+    yielded any items yet are flattened into a single heap, so yielding an
+    item costs O(log k) for k leaf iterables regardless of nesting.
+    '''
+    def __init__(self, iterables, key):
+        self.__iterables = list(iterables)
+        self.__key = key
+        self.__items = None
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self.__items is None:
+            self.__items = self.__iter_items()
+        return next(self.__items)
+
+    next = __next__
+
+    def __iter_items(self):
+        key = self.__key
+        heap = []
+        for (path, iterator) in self.__iter_leaf_iterators(path=()):
+            value = next(iterator, None)
+            if value is not None:
+                # path is unique, so value and iterator are never compared.
+                heap.append((key(value), path, value, iterator))
+        heapq.heapify(heap)
+        while heap:
+            (_key, path, value, iterator) = heap[0]
+            yield value
+            new_value = next(iterator, None)
+            if new_value is None:
+                heapq.heappop(heap)
+            else:
+                heapq.heapreplace(heap, (key(new_value), path, new_value, iterator))
+
+    def __iter_leaf_iterators(self, path):
+        for (index, iterable) in enumerate(self.__iterables):
+            if isinstance(iterable, MergedIterator) \
+                    and iterable.__key is self.__key \
+                    and iterable.__items is None:
+                # Claim the nested merge's leaves so it cannot be started
+                # separately.
+                iterable.__items = iter(())
+                for leaf in iterable.__iter_leaf_iterators(path=path + (index,)):
+                    yield leaf
+            else:
+                yield (path + (index,), iter(iterable))
+
 def iter_merge_sort(iterables, key):
-    iterators = list(map(iter, iterables))
-    cur_values = list(map(lambda iterator: next(iterator, None), iterators))
-    active_indexes = set(index for (index, value) in enumerate(cur_values) if value is not None)
-    while active_indexes:
-        index = min(active_indexes, key=lambda index: key(cur_values[index]))
-        assert cur_values[index] is not None
-        yield cur_values[index]
-        new_value = next(iterators[index], None)
-        cur_values[index] = new_value
-        if new_value is None:
-            active_indexes.remove(index)
+    return MergedIterator(iterables=iterables, key=key)
+
+class ChunkedArray(object):
+    '''
+    An append-only array of numbers stored in fixed-size array.array chunks.
+
+    fork() makes an independent copy which shares all chunks with the
+    original. A shared chunk is copied only when either copy appends to it
+    or changes it, so forking costs O(number of chunks) regardless of chunk
+    contents.
+    '''
+    CHUNK_SIZE = 4096
+
+    def __init__(self, typecode):
+        self.__typecode = typecode
+        self.__chunks = []
+        self.__length = 0
+        # Whether each chunk might be shared with a fork.
+        self.__chunks_shared = []
+
+    @property
+    def typecode(self):
+        return self.__typecode
+
+    def __len__(self):
+        return self.__length
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += self.__length
+        if not 0 <= index < self.__length:
+            raise IndexError('ChunkedArray index out of range')
+        (chunk_index, offset) = divmod(index, ChunkedArray.CHUNK_SIZE)
+        return self.__chunks[chunk_index][offset]
+
+    def __setitem__(self, index, value):
+        if index < 0:
+            index += self.__length
+        if not 0 <= index < self.__length:
+            raise IndexError('ChunkedArray index out of range')
+        (chunk_index, offset) = divmod(index, ChunkedArray.CHUNK_SIZE)
+        chunk = self.__chunks[chunk_index]
+        if self.__chunks_shared[chunk_index]:
+            chunk = array.array(self.__typecode, chunk)
+            self.__chunks[chunk_index] = chunk
+            self.__chunks_shared[chunk_index] = False
+        chunk[offset] = value
+
+    def __iter__(self):
+        for chunk in self.__chunks:
+            for value in chunk:
+                yield value
+
+    def chunks(self):
+        '''
+        Returns the array.array chunks holding this array's values, in
+        order. Do not modify them.
+        '''
+        return list(self.__chunks)
+
+    def append(self, value):
+        chunks = self.__chunks
+        if self.__length % ChunkedArray.CHUNK_SIZE == 0:
+            chunks.append(array.array(self.__typecode))
+            self.__chunks_shared.append(False)
+        elif self.__chunks_shared[-1]:
+            chunks[-1] = array.array(self.__typecode, chunks[-1])
+            self.__chunks_shared[-1] = False
+        chunks[-1].append(value)
+        self.__length += 1
+
+    def extend(self, values):
+        '''
+        Appends each of the given values, copying them a chunk at a time.
+        '''
+        if not isinstance(values, array.array) or values.typecode != self.__typecode:
+            values = array.array(self.__typecode, values)
+        chunk_size = ChunkedArray.CHUNK_SIZE
+        chunks = self.__chunks
+        position = 0
+        while position < len(values):
+            offset = self.__length % chunk_size
+            piece = values[position:position + chunk_size - offset]
+            if offset == 0:
+                chunks.append(piece)
+                self.__chunks_shared.append(False)
+            else:
+                if self.__chunks_shared[-1]:
+                    chunks[-1] = array.array(self.__typecode, chunks[-1])
+                    self.__chunks_shared[-1] = False
+                chunks[-1].extend(piece)
+            self.__length += len(piece)
+            position += len(piece)
+
+    def fork(self):
+        copy = ChunkedArray(self.__typecode)
+        copy.__chunks = list(self.__chunks)
+        copy.__length = self.__length
+        copy.__chunks_shared = [True] * len(self.__chunks)
+        self.__chunks_shared = [True] * len(self.__chunks)
+        return copy
+
+class TestChunkedArray(unittest.TestCase):
+    def test_fork_is_independent(self):
+        original = ChunkedArray('i')
+        for i in range(ChunkedArray.CHUNK_SIZE + 10):
+            original.append(i)
+        fork = original.fork()
+        original.append(-1)
+        fork.append(-2)
+        fork.append(-3)
+        original[0] = 100
+        fork[-3] = 200
+        self.assertEqual(len(original), ChunkedArray.CHUNK_SIZE + 11)
+        self.assertEqual(len(fork), ChunkedArray.CHUNK_SIZE + 12)
+        self.assertEqual(original[-1], -1)
+        self.assertEqual(list(fork)[-3:], [200, -2, -3])
+        self.assertEqual(original[0], 100)
+        self.assertEqual(fork[0], 0)
+        self.assertEqual(original[ChunkedArray.CHUNK_SIZE + 9], ChunkedArray.CHUNK_SIZE + 9)
+        self.assertFalse(fork.chunks()[0] is original.chunks()[0])
+
+    def test_fork_shares_full_chunks(self):
+        original = ChunkedArray('i')
+        for i in range(2 * ChunkedArray.CHUNK_SIZE + 1):
+            original.append(i)
+        fork = original.fork()
+        fork.append(0)
+        self.assertTrue(fork.chunks()[1] is original.chunks()[1])
+        self.assertFalse(fork.chunks()[2] is original.chunks()[2])
+
+    def test_changed_chunks_are_copied_once(self):
+        original = ChunkedArray('i')
+        for i in range(2 * ChunkedArray.CHUNK_SIZE):
+            original.append(i)
+        fork = original.fork()
+        fork[1] = -1
+        copied_chunk = fork.chunks()[0]
+        fork[2] = -2
+        self.assertIs(fork.chunks()[0], copied_chunk)
+        self.assertIsNot(copied_chunk, original.chunks()[0])
+        self.assertIs(fork.chunks()[1], original.chunks()[1])
+        self.assertEqual((original[1], original[2]), (1, 2))
+
+    def test_extend_fills_chunks_like_append(self):
+        appended = ChunkedArray('i')
+        extended = ChunkedArray('i')
+        for i in range(10):
+            appended.append(i)
+            extended.append(i)
+        fork = extended.fork()
+        values = list(range(2 * ChunkedArray.CHUNK_SIZE + 5))
+        for value in values:
+            appended.append(value)
+        extended.extend(array.array('i', values))
+        extended.extend([])
+        self.assertEqual(list(extended), list(appended))
+        self.assertEqual([len(chunk) for chunk in extended.chunks()], [len(chunk) for chunk in appended.chunks()])
+        self.assertEqual(list(fork), list(range(10)))
+
+class TestIterMergeSort(unittest.TestCase):
+    def test_merge_is_sorted_and_stable(self):
+        key = lambda item: item[0]
+        merged = iter_merge_sort([
+            [(1, 'a'), (3, 'a'), (3, 'a2')],
+            [],
+            [(1, 'c'), (2, 'c'), (3, 'c')],
+            [(0, 'd'), (3, 'd')],
+        ], key=key)
+        self.assertEqual(list(merged), [
+            (0, 'd'),
+            (1, 'a'),
+            (1, 'c'),
+            (2, 'c'),
+            (3, 'a'),
+            (3, 'a2'),
+            (3, 'c'),
+            (3, 'd'),
+        ])
+
+    def test_nested_merges_order_like_flat_merge(self):
+        key = lambda item: item[0]
+        streams = [[(day, name) for day in range(0, 30, step)] for (step, name) in [(3, 'a'), (2, 'b'), (5, 'c'), (7, 'd'), (1, 'e')]]
+        flat = list(iter_merge_sort(streams, key=key))
+        nested = list(iter_merge_sort([
+            iter_merge_sort(streams[0:2], key=key),
+            streams[2],
+            iter_merge_sort([streams[3], iter_merge_sort(streams[4:], key=key)], key=key),
+        ], key=key))
+        self.assertEqual(nested, flat)
+
+    def test_nested_merge_with_different_key_is_not_flattened(self):
+        merged = iter_merge_sort([
+            iter_merge_sort([[(1, 9)], [(2, 1)]], key=lambda item: item[1]),
+            [(3, 5)],
+        ], key=lambda item: item[0])
+        self.assertEqual(list(merged), [(2, 1), (1, 9), (3, 5)])
+
+    def test_merge_is_an_iterator(self):
+        merged = iter_merge_sort([[1, 4], [2, 3]], key=lambda item: item)
+        self.assertIs(iter(merged), merged)
+        self.assertEqual(next(merged), 1)
+        self.assertEqual(next(merged), 2)
+        self.assertEqual(list(merged), [3, 4])
+        self.assertEqual(list(merged), [])
+
+    def test_partially_consumed_nested_merge_is_not_flattened(self):
+        key = lambda item: item
+        inner = iter_merge_sort([[1, 5], [2, 6]], key=key)
+        self.assertEqual(next(inner), 1)
+        merged = iter_merge_sort([inner, [3, 4]], key=key)
+        self.assertEqual(list(merged), [2, 3, 4, 5, 6])
+
+    def test_none_ends_iterable(self):
+        merged = iter_merge_sort([[1, None, 2], [0, 3]], key=lambda item: item)
+        self.assertEqual(list(merged), [0, 1, 3])
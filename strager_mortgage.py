@@ -4,23 +4,65 @@ from decimal import Decimal
 from moneycalc.money import money
 from moneycalc.tax import TaxEffect
 import abc
-import collections
+import argparse
+import bisect
+import copy
 import datetime
+import io
+import json
 import moneycalc.account
-import moneycalc.tax
+import moneycalc.cache
+import moneycalc.curve
+import moneycalc.incremental
+import moneycalc.instrument
+import moneycalc.money
+import moneycalc.montecarlo
+import moneycalc.plan
+import moneycalc.runner
+import moneycalc.sink
+import moneycalc.solve
+import moneycalc.sweep
 import moneycalc.time
 import moneycalc.timeline
-import moneycalc.util
+import shutil
 import sys
-import traceback
+import tempfile
+import unittest
 
-def iter_salary_funcs(timeline, start_date, to_account):
+# The scenarios' assumptions, shared by their schedule rules and by
+# Scenario.spec. Amounts are strings so money() turns them into the money
+# representation in use when a scenario starts.
+BASE_SALARY = '7553.31'
+HALF_BONUS = '14728.95'
+QUARTER_BONUS = '18750.00'
+US_WITHHOLDING_RATE = Decimal('0.215')
+CA_WITHHOLDING_RATE = Decimal('0.080')
+OTHER_TAX_RATE = Decimal('0.15')
+EXPENSES = '1873.61'
+AUTO_PAYMENT = '2225.70'
+AUTO_PERIOD = moneycalc.time.Period(
+    datetime.date(year=2016, month=7, day=19),
+    datetime.date(year=2021, month=7, day=19),
+)
+PROPERTY_TAX_RATE = Decimal('0.0074')
+HOME_INSURANCE = '1000.00'
+TOOTH_FAIRY_GIFT = '5000.00'
+
+def quarter_bonus_months(october_quarter_bonus):
+    '''
+    Returns the months in which quarterly bonuses are paid. Scenarios have
+    always paid the fourth bonus a second time in July; with
+    october_quarter_bonus, it is paid in October instead.
+    '''
+    return (1, 4, 7, 10) if october_quarter_bonus else (1, 4, 7, 7)
+
+def add_salary_rules(schedule, timeline, inputs, start_date, to_account, october_quarter_bonus=False):
     def receive_income(date, gross_income):
         withheld_401k = money(0) # TODO(strager)
         taxable_income = gross_income - withheld_401k
-        withheld_us_income_tax = money(taxable_income * Decimal(0.215)) # FIXME(strager)
-        withheld_ca_income_tax = money(taxable_income * Decimal(0.080)) # FIXME(strager)
-        other_tax = money(taxable_income * Decimal(0.15)) # FIXME(strager)
+        withheld_us_income_tax = money(taxable_income * US_WITHHOLDING_RATE)
+        withheld_ca_income_tax = money(taxable_income * CA_WITHHOLDING_RATE)
+        other_tax = money(taxable_income * OTHER_TAX_RATE)
         net_income = gross_income - withheld_401k - withheld_us_income_tax - withheld_ca_income_tax - other_tax
         # TODO(strager): 401k.
 
@@ -29,169 +71,400 @@ def iter_salary_funcs(timeline, start_date, to_account):
         timeline.add_income(date=date, amount=taxable_income, description='Salary (taxable)')
         to_account.deposit(timeline=timeline, date=date, amount=net_income, description='Salary (net)')
 
-    def iter_base_salary_income_funcs():
-        now = start_date
-        while True:
-            yield (now, lambda date: receive_income(date, money('7553.31')))
-            now += datetime.timedelta(days=2 * 7)
-
-    def iter_half_bonus_income_funcs():
-        year = start_date.year
-        while True:
-            q1 = datetime.date(year=year, month=1, day=1)
-            q3 = datetime.date(year=year, month=7, day=1)
-            for now in [q1, q3]:
-                if now >= start_date:
-                    yield (now, lambda date: receive_income(date, money('14728.95')))
-            year += 1
-
-    def iter_quarter_bonus_income_funcs():
-        year = start_date.year
-        while True:
-            q1 = datetime.date(year=year, month=1, day=1)
-            q2 = datetime.date(year=year, month=4, day=1)
-            q3 = datetime.date(year=year, month=7, day=1)
-            q4 = datetime.date(year=year, month=10, day=1)
-            for now in [q1, q2, q3, q3]:
-                if now >= start_date:
-                    yield (now, lambda date: receive_income(date, money('18750.00')))
-            year += 1
-
-    return moneycalc.util.iter_merge_sort([iter_base_salary_income_funcs(), iter_half_bonus_income_funcs(), iter_quarter_bonus_income_funcs()], key=lambda (date, func): date)
-
-def iter_tax_payment_funcs(timeline, start_date, account):
+    base_salary = money(BASE_SALARY)
+    half_bonus = money(HALF_BONUS)
+    quarter_bonus = money(QUARTER_BONUS)
+    schedule.add(moneycalc.time.biweekly(start_date), lambda date: receive_income(date, inputs.get('salary', date, base_salary)), category='salary')
+    schedule.add(moneycalc.time.semiannually(day=1), lambda date: receive_income(date, inputs.get('half bonus', date, half_bonus)), category='bonus')
+    schedule.add(moneycalc.time.quarterly(day=1, months=quarter_bonus_months(october_quarter_bonus)), lambda date: receive_income(date, inputs.get('quarter bonus', date, quarter_bonus)), category='bonus')
+
+def add_tax_payment_rules(schedule, timeline, account):
     def tax_payment_func(date):
         tax_year = date.year - 1
-        tax_period = moneycalc.time.Period(datetime.date(year=tax_year, month=1, day=1), datetime.date(year=tax_year + 1, month=1, day=1))
-        due = moneycalc.tax.tax_due(events=[event for event in timeline if event.date in tax_period and event.tax_effect != moneycalc.tax.TaxEffect.NONE], year=tax_year)
+        due = timeline.tax_ledger.tax_due(year=tax_year)
         if due < 0:
             # TODO(strager): Treat as income.
             account.deposit(timeline=timeline, date=date, amount=-due, description='Tax refund')
         else:
             account.withdraw(timeline=timeline, date=date, amount=due, description='Taxes', tax_effect=TaxEffect.DEDUCTIBLE)
-    year = start_date.year
-    while True:
-        yield (datetime.date(year=year, month=4, day=1), tax_payment_func)
-        year += 1
-
-def iter_expenses_funcs(timeline, start_date, account):
-    def iter_misc_expenses_funcs():
-        def expenses_func(date):
-            account.withdraw(timeline=timeline, date=date, amount=money('1873.61'), description='Expenses')
-        now = datetime.date(year=start_date.year, month=start_date.month, day=15)
-        while True:
-            yield (now, expenses_func)
-            now = moneycalc.time.add_month(now)
-
-    def iter_auto_funcs():
-        # TODO(strager): Model as a loan.
-        def auto_func(date):
-            account.withdraw(timeline=timeline, date=date, amount=money('2225.70'), description='Auto')
-        period = moneycalc.time.Period(
-            datetime.date(year=2016, month=7, day=19),
-            datetime.date(year=2021, month=7, day=19),
-        )
-        now = datetime.date(year=start_date.year, month=start_date.month, day=19)
-        while now <= period.end_date:
-            if now in period:
-                yield (now, auto_func)
-            now = moneycalc.time.add_month(now)
-
-    return moneycalc.util.iter_merge_sort([iter_misc_expenses_funcs(), iter_auto_funcs()], key=lambda (date, func): date)
-
-def iter_property_expense_funcs(timeline, start_date, account, home_value):
-    def iter_tax_funcs():
-        year = start_date.year
-        tax_rate = Decimal('0.0074')
-        def tax_func(date):
-            amount = money(home_value * tax_rate / 2)
-            account.withdraw(timeline=timeline, date=date, amount=amount, description='Property tax', tax_effect=TaxEffect.DEDUCTIBLE)
-        while True:
-            h1 = datetime.date(year=year, month=4, day=10)
-            h2 = datetime.date(year=year, month=12, day=10)
-            for now in [h1, h2]:
-                if now >= start_date:
-                    yield (now, tax_func)
-            year += 1
-
-    def iter_insurance_funcs():
-        def insurance_func(date):
-            account.withdraw(timeline=timeline, date=date, amount=money('1000.00'), description='Home insurance')
-        now = datetime.date(year=start_date.year, month=start_date.month, day=1)
-        while True:
-            yield (now, insurance_func)
-            now = moneycalc.time.add_month(now)
-
-    return moneycalc.util.iter_merge_sort([iter_tax_funcs(), iter_insurance_funcs()], key=lambda (date, func): date)
+    schedule.add(moneycalc.time.yearly(month=4, day=1), tax_payment_func, category='tax payment')
+
+def add_expenses_rules(schedule, timeline, inputs, account):
+    expenses = money(EXPENSES)
+    def expenses_func(date):
+        account.withdraw(timeline=timeline, date=date, amount=inputs.get('expenses', date, expenses), description='Expenses')
+    schedule.add(moneycalc.time.monthly(day=15), expenses_func, category='expenses')
+
+    # TODO(strager): Model as a loan.
+    auto_payment = money(AUTO_PAYMENT)
+    def auto_func(date):
+        account.withdraw(timeline=timeline, date=date, amount=inputs.get('auto', date, auto_payment), description='Auto')
+    schedule.add(moneycalc.time.Within(moneycalc.time.monthly(day=19), AUTO_PERIOD), auto_func, category='auto')
+
+def add_property_expense_rules(schedule, timeline, inputs, account, home_value):
+    def tax_func(date):
+        amount = money(home_value * inputs.get('property tax rate', date, PROPERTY_TAX_RATE) / 2)
+        account.withdraw(timeline=timeline, date=date, amount=amount, description='Property tax', tax_effect=TaxEffect.DEDUCTIBLE)
+    schedule.add(moneycalc.time.OnDayOfMonths(day=10, months=(4, 12)), tax_func, category='property tax')
+
+    insurance = money(HOME_INSURANCE)
+    def insurance_func(date):
+        account.withdraw(timeline=timeline, date=date, amount=inputs.get('home insurance', date, insurance), description='Home insurance')
+    schedule.add(moneycalc.time.monthly(day=1), insurance_func, category='home insurance')
+
+class AccountYearSummary(object):
+    def __init__(self, account_name, balance, deposited, withdrawn, description_totals):
+        self.account_name = account_name
+        self.balance = balance
+        self.deposited = deposited
+        self.withdrawn = withdrawn
+        # List of (description, amount) pairs.
+        self.description_totals = description_totals
+
+class YearSummary(object):
+    def __init__(self, year, account_summaries):
+        self.year = year
+        self.account_summaries = account_summaries
+
+class ScenarioResult(object):
+    '''
+    The outcome of Scenario.play. Contains only plain data so it can be sent
+    between processes.
+    '''
+    def __init__(self, scenario_name, year_summaries, end_balances, total_interest, total_tax, timeline, error, profile=None, balance_histories=None):
+        self.scenario_name = scenario_name
+        self.year_summaries = year_summaries
+        # List of (account name, balance) pairs.
+        self.end_balances = end_balances
+        self.total_interest = total_interest
+        self.total_tax = total_tax
+        self.timeline = timeline
+        # A moneycalc.runner.TaskError if the scenario stopped early, or None.
+        self.error = error
+        # The moneycalc.instrument.ScenarioProfile given to Scenario.play, or
+        # None.
+        self.profile = profile
+        # List of (account name, moneycalc.account.BalanceHistory) pairs.
+        # Scenarios played to a sink do not record balance histories.
+        self.balance_histories = balance_histories
+
+def write_scenario_result(result, out):
+    out.write(' === {} ===\n'.format(result.scenario_name))
+    for year_summary in result.year_summaries:
+        out.write('Year {}:\n'.format(year_summary.year))
+        for summary in year_summary.account_summaries:
+            out.write('  {account}: {balance} balance ({deposited} deposited, {withdrawn} withdrawn)\n'.format(
+                account=summary.account_name,
+                balance=summary.balance,
+                deposited=summary.deposited,
+                withdrawn=summary.withdrawn,
+            ))
+            for (description, amount) in summary.description_totals:
+                out.write('    {description}: {amount}\n'.format(
+                    amount=amount,
+                    description=description,
+                ))
+
+def add_years(date, years):
+    return moneycalc.time.add_years(date, years)
 
 class Scenario(object):
-    def __init__(self):
+    def __init__(self, start_date=datetime.date(2017, 1, 1), years=30, home_purchase_amount='1200000.00', home_loan_amount='975000.00', shared=None, inputs=None, october_quarter_bonus=False):
+        '''
+        Handlers read amounts such as 'expenses' and 'salary' from inputs (a
+        moneycalc.incremental.Inputs), so they can be overridden for some
+        dates.
+
+        See quarter_bonus_months for october_quarter_bonus.
+        '''
+        self.start_date = start_date
+        self.end_date = add_years(start_date, years)
+        self.home_purchase_date = start_date
+        self.home_purchase_amount = money(home_purchase_amount)
+        self.home_loan_amount = money(home_loan_amount)
+        self.october_quarter_bonus = october_quarter_bonus
+        # A moneycalc.sweep.SharedCache of inputs shared with other
+        # scenarios.
+        self.shared = moneycalc.sweep.SharedCache() if shared is None else shared
+        self.inputs = moneycalc.incremental.Inputs() if inputs is None else inputs
         # timeline should not be used outside play.
         self.timeline = None
 
-    def play(self):
-        start_date = datetime.date(year=2017, month=1, day=1)
-        end_date = datetime.date(year=2047, month=1, day=1)
-        home_purchase_date = datetime.date(2017, 1, 1)
-        home_purchase_amount = money('1200000.00')
-        home_loan_amount = money('975000.00')
-        home_appraisal_amount = home_purchase_amount
-
-        self.timeline = moneycalc.timeline.Timeline()
-
-        funcs = [
-            self.__iter_year_summary_funcs(timeline=self.timeline, start_date=start_date),
-            [(home_purchase_date, lambda date: self.purchase_home(date, home_loan_amount))],
-            iter_tax_payment_funcs(timeline=self.timeline, start_date=start_date, account=self.primary_account),
-            iter_salary_funcs(timeline=self.timeline, start_date=start_date, to_account=self.primary_account),
-            iter_expenses_funcs(timeline=self.timeline, start_date=start_date, account=self.primary_account),
-            iter_property_expense_funcs(timeline=self.timeline, start_date=start_date, account=self.primary_account, home_value=home_appraisal_amount),
-            self.iter_activity_funcs(),
-        ]
-        for (date, func) in moneycalc.util.iter_merge_sort(funcs, key=lambda (date, func): date):
-            if date > end_date:
+    def __str__(self):
+        return type(self).__name__
+
+    def describe(self):
+        '''
+        Returns a tuple of plain values which is equal for scenarios which
+        play out the same way (given the same model code).
+        '''
+        return (
+            type(self).__name__,
+            self.start_date,
+            self.end_date,
+            self.home_purchase_date,
+            str(self.home_purchase_amount),
+            str(self.home_loan_amount),
+            self.october_quarter_bonus,
+            self.inputs.describe(),
+        )
+
+    def play(self, keep_timeline=False, profile=None, sink=None, rollup=None):
+        '''
+        Simulates the scenario and returns a ScenarioResult.
+
+        If keep_timeline is True, the result's timeline is the simulation's
+        moneycalc.timeline.Timeline. Otherwise, it is None.
+
+        If profile (a moneycalc.instrument.ScenarioProfile) is given, the
+        cost of each scheduled handler is recorded in it.
+
+        If sink (a moneycalc.sink.TimelineSink) is given, the timeline's
+        events are written to it instead of being kept in memory.
+
+        If rollup (a moneycalc.timeline.Rollup) is given, the timeline keeps
+        monthly or yearly totals instead of every event.
+        '''
+        self.start(profile=profile, sink=sink, rollup=rollup)
+        self.play_until(None)
+        return self.finish(keep_timeline=keep_timeline)
+
+    def start(self, profile=None, sink=None, rollup=None):
+        '''
+        Begins simulating the scenario. Call play_until to make progress
+        and finish to get the ScenarioResult.
+        '''
+        self.timeline = moneycalc.timeline.Timeline(sink=sink, keep_events=sink is None, rollup=rollup)
+        self.__profile = profile
+        self.__year_summaries = []
+        self.__error = None
+        self.__now = self.start_date
+        self.__start_schedule()
+
+    def __start_schedule(self):
+        schedule = moneycalc.time.Schedule()
+        self.__add_year_summary_rules(schedule, timeline=self.timeline, year_summaries=self.__year_summaries)
+        home_loan_amount = self.home_loan_amount
+        schedule.add(moneycalc.time.Once(self.home_purchase_date), lambda date: self.purchase_home(date, home_loan_amount), category='home purchase')
+        add_tax_payment_rules(schedule, timeline=self.timeline, account=self.primary_account)
+        add_salary_rules(schedule, timeline=self.timeline, inputs=self.inputs, start_date=self.start_date, to_account=self.primary_account, october_quarter_bonus=self.october_quarter_bonus)
+        add_expenses_rules(schedule, timeline=self.timeline, inputs=self.inputs, account=self.primary_account)
+        add_property_expense_rules(schedule, timeline=self.timeline, inputs=self.inputs, account=self.primary_account, home_value=self.home_purchase_amount)
+        self.add_activity_rules(schedule)
+
+        (self.__ordinals, self.__handler_ids) = schedule.expand(moneycalc.time.Period(self.start_date, self.end_date + datetime.timedelta(days=1)))
+        self.__handlers = schedule.handlers
+        self.__categories = schedule.categories
+        # Everything before __now already happened.
+        self.__next_index = bisect.bisect_left(self.__ordinals, self.__now.toordinal())
+
+    def play_until(self, date):
+        '''
+        Simulates everything which happens before the given date (or
+        everything, if date is None), up to the end of the scenario.
+        '''
+        if self.__handlers is None:
+            self.__start_schedule()
+        end_date = self.end_date
+        if date is None or date > end_date:
+            limit = end_date + datetime.timedelta(days=1)
+        else:
+            limit = date
+        ordinals = self.__ordinals
+        handler_ids = self.__handler_ids
+        handlers = self.__handlers
+        profile = self.__profile
+        limit_ordinal = limit.toordinal()
+        index = self.__next_index
+        while self.__error is None and index < len(ordinals):
+            ordinal = ordinals[index]
+            if ordinal >= limit_ordinal:
                 break
+            index += 1
+            handler_id = handler_ids[index - 1]
             try:
-                func(date)
-            except NotImplementedError:
-                traceback.print_exc()
-                break
+                if profile is None:
+                    handlers[handler_id](datetime.date.fromordinal(ordinal))
+                else:
+                    profile.call(self.__categories[handler_id], handlers[handler_id], datetime.date.fromordinal(ordinal), timeline=self.timeline)
+            except NotImplementedError as e:
+                self.__error = moneycalc.runner.TaskError.from_exception(e)
+        self.__next_index = index
+        self.__now = max(self.__now, limit)
 
-        print_timeline = False
-        if print_timeline:
-            sys.stdout.write('Timeline:\n\n')
-            for event in self.timeline:
-                sys.stdout.write('{}\n'.format(event))
+    def fork(self, **parameters):
+        '''
+        Returns an independent copy of a started scenario. Playing either
+        scenario does not affect the other.
 
+        The copy shares immutable inputs (such as interest rates and
+        amortization schedules), year summaries, and the history of its
+        timeline with this scenario.
+
+        parameters are passed to the copy's change_parameters, so they
+        affect only what happens after the fork.
+        '''
+        # Handlers refer to this scenario's timeline and accounts, so the copy
+        # makes its own schedule when it starts playing (see play_until).
+        # Forks which are never played (e.g. checkpoints) stay cheap. The copy
+        # is not profiled.
+        schedule = (self.__ordinals, self.__handler_ids, self.__handlers, self.__categories)
+        profile = self.__profile
+        (self.__ordinals, self.__handler_ids, self.__handlers, self.__categories) = (None, None, None, None)
+        self.__profile = None
+        # Year summaries do not change once they are made.
+        memo = dict((id(year_summary), year_summary) for year_summary in self.__year_summaries)
+        try:
+            scenario = copy.deepcopy(self, memo)
+        finally:
+            (self.__ordinals, self.__handler_ids, self.__handlers, self.__categories) = schedule
+            self.__profile = profile
+        scenario.change_parameters(**parameters)
+        return scenario
+
+    def state_key(self):
+        '''
+        Returns a tuple of plain values which is equal for started scenarios
+        which play out the same way from now on.
+
+        Besides accounts, the rest of the scenario depends on the previous
+        and current years' taxes and on the previous year's account
+        summaries (which are summarized on January 1).
+        '''
+        timeline = self.timeline
+        year = self.__now.year
+        tax_years = []
+        for tax_year in [year - 1, year]:
+            totals = timeline.tax_ledger.year_totals(tax_year)
+            tax_years.append((totals.taxable_cash_income, totals.withheld_cash, totals.deductible))
+        account_summaries = []
+        for account in self.all_accounts:
+            summary = timeline.account_summary(account=account, year=year - 1)
+            account_summaries.append((str(account), summary.deposited, summary.withdrawn, sorted(summary.description_totals.items())))
+        return (
+            self.__now,
+            None if self.__error is None else str(self.__error),
+            tuple((str(account), account.state_key()) for account in self.all_accounts),
+            tuple(tax_years),
+            tuple(account_summaries),
+        )
+
+    def change_parameters(self, **parameters):
+        '''
+        Changes constructor parameters of a scenario in the middle of
+        playing it. Only parameters which are read as the scenario plays
+        can be changed.
+        '''
+        if parameters:
+            raise ValueError('Cannot change parameters of {}: {}'.format(self, ', '.join(sorted(parameters))))
+
+    def finish(self, keep_timeline=False):
+        '''
+        Returns the ScenarioResult of a started scenario.
+        '''
+        start_date = self.start_date
+        end_date = self.end_date
+        self.timeline.flush()
+        result = ScenarioResult(
+            scenario_name=str(self),
+            year_summaries=self.__year_summaries,
+            end_balances=[(str(account), account.balance) for account in self.all_accounts],
+            total_interest=self.timeline.total_interest,
+            total_tax=sum((self.timeline.tax_ledger.tax(year) for year in range(start_date.year, end_date.year)), money(0)),
+            timeline=self.timeline if keep_timeline else None,
+            error=self.__error,
+            profile=self.__profile,
+            balance_histories=[(str(account), account.balance_history) for account in self.all_accounts],
+        )
         self.timeline = None
+        self.__handlers = None
+        return result
 
-    def __iter_year_summary_funcs(self, timeline, start_date):
+    def __add_year_summary_rules(self, schedule, timeline, year_summaries):
         def year_summary_func(date):
             assert date.month == 1
             assert date.day == 1
             year = date.year - 1
-            sys.stdout.write('Year {}:\n'.format(year))
-            events = [e for e in timeline if e.date.year == year]
+            account_summaries = []
             for account in self.all_accounts:
-                account_events = [e for e in events if e.account is account]
-                sys.stdout.write('  {account}: {balance} balance ({deposited} deposited, {withdrawn} withdrawn)\n'.format(
-                    account=account,
+                summary = timeline.account_summary(account=account, year=year)
+                account_summaries.append(AccountYearSummary(
+                    account_name=str(account),
                     balance=account.balance,
-                    deposited=sum(e.amount for e in account_events if e.amount > 0),
-                    withdrawn=sum(e.amount for e in account_events if e.amount < 0),
+                    deposited=summary.deposited,
+                    withdrawn=summary.withdrawn,
+                    description_totals=list(summary.description_totals.items()),
                 ))
-                grouped_events = collections.defaultdict(list)
-                for event in account_events:
-                    grouped_events[event.description].append(event)
-                for (description, event_group) in grouped_events.iteritems():
-                    sys.stdout.write('    {description}: {amount}\n'.format(
-                        amount=sum(e.amount for e in event_group),
-                        description=description,
-                    ))
-        year = start_date.year
-        while True:
-            yield (datetime.date(year=year, month=1, day=1), year_summary_func)
-            year += 1
+            year_summaries.append(YearSummary(year=year, account_summaries=account_summaries))
+        schedule.add(moneycalc.time.yearly(month=1, day=1), year_summary_func, category='year summary')
+
+    def spec(self):
+        '''
+        Returns a moneycalc.plan spec which plays out exactly like this
+        scenario (see SpecScenario).
+
+        Raises moneycalc.plan.SpecError if the scenario cannot be written as
+        a spec, e.g. because its inputs are overridden.
+        '''
+        if self.inputs.describe():
+            raise moneycalc.plan.SpecError('Scenarios with overridden inputs cannot be written as specs')
+        account = str(self.primary_account)
+        def event(category, rule, action):
+            return {'category': category, 'when': moneycalc.plan.describe_rule(rule), 'action': action}
+        def income(amount):
+            return {
+                'type': 'income',
+                'account': account,
+                'amount': amount,
+                'description': 'Salary',
+                'withholdings': [['US tax', str(US_WITHHOLDING_RATE)], ['CA tax', str(CA_WITHHOLDING_RATE)]],
+                'other_taxes': [str(OTHER_TAX_RATE)],
+            }
+        def withdraw(amount, description, tax_effect=TaxEffect.NONE):
+            return {'type': 'withdraw', 'account': account, 'amount': str(amount), 'description': description, 'tax_effect': tax_effect}
+        property_tax = money(self.home_purchase_amount * PROPERTY_TAX_RATE / 2)
+        # In the order of __start_schedule's rules.
+        events = [
+            event('year summary', moneycalc.time.yearly(month=1, day=1), {'type': 'year_summary'}),
+            event('home purchase', moneycalc.time.Once(self.home_purchase_date), self.purchase_home_action(self.home_loan_amount)),
+            event('tax payment', moneycalc.time.yearly(month=4, day=1), {'type': 'tax_payment', 'account': account}),
+            event('salary', moneycalc.time.biweekly(self.start_date), income(BASE_SALARY)),
+            event('bonus', moneycalc.time.semiannually(day=1), income(HALF_BONUS)),
+            event('bonus', moneycalc.time.quarterly(day=1, months=quarter_bonus_months(self.october_quarter_bonus)), income(QUARTER_BONUS)),
+            event('expenses', moneycalc.time.monthly(day=15), withdraw(EXPENSES, 'Expenses')),
+            event('auto', moneycalc.time.Within(moneycalc.time.monthly(day=19), AUTO_PERIOD), withdraw(AUTO_PAYMENT, 'Auto')),
+            event('property tax', moneycalc.time.OnDayOfMonths(day=10, months=(4, 12)), withdraw(property_tax, 'Property tax', tax_effect=TaxEffect.DEDUCTIBLE)),
+            event('home insurance', moneycalc.time.monthly(day=1), withdraw(HOME_INSURANCE, 'Home insurance')),
+        ]
+        events.extend(self.activity_event_specs())
+        return {
+            'name': str(self),
+            'start_date': self.start_date.isoformat(),
+            'end_date': self.end_date.isoformat(),
+            'accounts': self.account_specs(),
+            'events': events,
+        }
+
+    @abc.abstractmethod
+    def account_specs(self):
+        '''
+        Returns the ACCOUNT specs of all_accounts for spec.
+        '''
+        raise NotImplementedError()
+
+    @abc.abstractmethod
+    def purchase_home_action(self, amount):
+        '''
+        Returns the ACTION spec of purchase_home for spec.
+        '''
+        raise NotImplementedError()
+
+    @abc.abstractmethod
+    def activity_event_specs(self):
+        '''
+        Returns the EVENT specs of add_activity_rules for spec.
+        '''
+        raise NotImplementedError()
 
     @property
     @abc.abstractmethod
@@ -208,23 +481,63 @@ class Scenario(object):
         raise NotImplementedError()
 
     @abc.abstractmethod
-    def activity_funcs(self):
+    def add_activity_rules(self, schedule):
         raise NotImplementedError()
 
 class HELOCScenario(Scenario):
-    def __init__(self):
-        super(HELOCScenario, self).__init__()
+    def __init__(self, start_prime_rate=Decimal('0.0425'), prime_rate_yearly_increase=Decimal('0.005'), prime_rate=None, draw_years=15, **kwargs):
+        '''
+        The HELOC's interest follows prime_rate (a
+        moneycalc.account.PrimeRate) if given. Otherwise, the prime rate
+        starts at start_prime_rate and increases by
+        prime_rate_yearly_increase every year.
+        '''
+        super(HELOCScenario, self).__init__(**kwargs)
+        start_year = self.start_date.year
+        # The PRIME_RATE spec of the prime rate, or None if it is not
+        # yearly stepping.
+        self.__prime_rate_spec = None
+        if prime_rate is None:
+            self.__prime_rate_spec = {
+                'type': 'yearly_stepping',
+                'start_yearly_rate': str(start_prime_rate),
+                'start_year': start_year,
+                'yearly_increase': str(prime_rate_yearly_increase),
+            }
+            prime_rate = self.shared.get(
+                ('YearlySteppingPrimeRate', start_prime_rate, start_year, prime_rate_yearly_increase),
+                lambda: moneycalc.curve.CachedPrimeRate(moneycalc.account.YearlySteppingPrimeRate(
+                    start_yearly_rate=start_prime_rate,
+                    start_year=start_year,
+                    yearly_increase=prime_rate_yearly_increase,
+                )),
+            )
+        # The 'prime rate' input can override prime_rate, so the curve is not
+        # shared with other scenarios, and is forgotten when the input is
+        # overridden.
+        interest_rate = moneycalc.curve.InterestRateCurve(moneycalc.account.VariableDailyInterestRate(
+            prime_rate=moneycalc.incremental.InputPrimeRate(self.inputs, name='prime rate', prime_rate=prime_rate),
+        ))
+        def input_changed(name):
+            if name == 'prime rate':
+                interest_rate.clear()
+        self.inputs.add_listener(input_changed)
+        self.__interest_rate = interest_rate
+        self.__draw_years = draw_years
+        draw_end_date = add_years(self.home_purchase_date, draw_years)
+        self.__draw_term = moneycalc.time.Period(self.home_purchase_date, draw_end_date)
+        self.__repayment_term = moneycalc.time.Period(draw_end_date, max(draw_end_date, self.end_date))
         self.__heloc = moneycalc.account.LineOfCreditAccount(
             name='HELOC',
-            interest_rate=moneycalc.account.VariableDailyInterestRate(
-                prime_rate=moneycalc.account.YearlySteppingPrimeRate(
-                    start_yearly_rate=Decimal('0.0425'),
-                    start_year=2017,
-                    yearly_increase=Decimal('0.005'),
-                )
-            ),
-            draw_term=moneycalc.time.Period(datetime.date(2017, 1, 1), datetime.date(2032, 1, 1)),
-            repayment_term=moneycalc.time.Period(datetime.date(2032, 1, 1), datetime.date(2047, 1, 1)),
+            interest_rate=interest_rate,
+            draw_term=self.__draw_term,
+            repayment_term=self.__repayment_term,
+        )
+
+    def describe(self):
+        return super(HELOCScenario, self).describe() + (
+            self.__interest_rate.describe(),
+            self.__draw_years,
         )
 
     @property
@@ -238,15 +551,54 @@ class HELOCScenario(Scenario):
     def purchase_home(self, date, amount):
         self.__heloc.withdraw(timeline=self.timeline, date=date, amount=amount, description='Purchase')
 
-    def iter_activity_funcs(self):
+    def add_activity_rules(self, schedule):
+        pass
+
+    def account_specs(self):
+        if self.__prime_rate_spec is None:
+            raise moneycalc.plan.SpecError('Only yearly stepping prime rates can be written as specs')
+        return [{
+            'type': 'line_of_credit',
+            'name': str(self.__heloc),
+            'interest_rate': {'type': 'variable_daily', 'prime_rate': self.__prime_rate_spec},
+            'draw_term': [self.__draw_term.start_date.isoformat(), self.__draw_term.end_date.isoformat()],
+            'repayment_term': [self.__repayment_term.start_date.isoformat(), self.__repayment_term.end_date.isoformat()],
+        }]
+
+    def purchase_home_action(self, amount):
+        return {'type': 'withdraw', 'account': str(self.__heloc), 'amount': str(amount), 'description': 'Purchase'}
+
+    def activity_event_specs(self):
         return []
 
 class FixedRateMortgageScenario(Scenario):
-    def __init__(self):
-        super(FixedRateMortgageScenario, self).__init__()
+    def __init__(self, mortgage_rate=Decimal('0.04125'), mortgage_years=30, extra_monthly_payment='0.00', **kwargs):
+        '''
+        Every month, extra_monthly_payment is paid towards the mortgage in
+        addition to the minimum payment (until it is paid off).
+        '''
+        super(FixedRateMortgageScenario, self).__init__(**kwargs)
+        self.__mortgage_rate = mortgage_rate
+        self.__mortgage_years = mortgage_years
+        self.__extra_monthly_payment = money(extra_monthly_payment)
         self.__checking = moneycalc.account.CheckingAccount(name='Checking')
         self.__home_loan = None
 
+    def describe(self):
+        return super(FixedRateMortgageScenario, self).describe() + (
+            self.__mortgage_rate,
+            self.__mortgage_years,
+            str(self.__extra_monthly_payment),
+        )
+
+    def state_key(self):
+        return super(FixedRateMortgageScenario, self).state_key() + (str(self.__extra_monthly_payment),)
+
+    def change_parameters(self, extra_monthly_payment=None, **parameters):
+        super(FixedRateMortgageScenario, self).change_parameters(**parameters)
+        if extra_monthly_payment is not None:
+            self.__extra_monthly_payment = money(extra_monthly_payment)
+
     @property
     def all_accounts(self):
         accounts = [self.__checking]
@@ -264,24 +616,510 @@ class FixedRateMortgageScenario(Scenario):
         self.__home_loan = moneycalc.account.AmortizedMonthlyLoan(
             name='Mortgage',
             amount=amount,
-            interest_rate=moneycalc.account.FixedMonthlyInterestRate(yearly_rate=Decimal('0.04125')),
-            term=moneycalc.time.Period(date, datetime.date(year=date.year + 30, month=date.month, day=date.day)),
+            interest_rate=moneycalc.account.FixedMonthlyInterestRate(yearly_rate=self.__mortgage_rate),
+            term=moneycalc.time.Period(date, add_years(date, self.__mortgage_years)),
         )
+        self.__home_loan.follow_schedule(self.shared.get(
+            ('AmortizationSchedule', amount, self.__mortgage_rate, date, self.__mortgage_years),
+            self.__home_loan.schedule,
+        ))
 
-    def iter_activity_funcs(self):
-        yield (datetime.date(2017, 1, 1), lambda date: self.__checking.deposit(timeline=self.timeline, date=date, amount=money('5000.00'), description='Tooth fairy'))
+    def add_activity_rules(self, schedule):
+        schedule.add(moneycalc.time.Once(self.start_date), lambda date: self.__checking.deposit(timeline=self.timeline, date=date, amount=money(TOOTH_FAIRY_GIFT), description='Tooth fairy'), category='gift')
         def mortgage_payment_func(date):
             payment = self.__home_loan.minimum_deposit(date=date)
+            if self.__extra_monthly_payment:
+                payment = min(payment + self.__extra_monthly_payment, self.__home_loan.payoff_deposit(date=date))
             moneycalc.account.transfer(timeline=self.timeline, date=date, from_account=self.__checking, to_account=self.__home_loan, amount=payment, description='{} payment'.format(self.__home_loan))
-        now = datetime.date(2017, 1, 1) # FIXME(strager)
-        while now < datetime.date(2047, 1, 1): # FIXME(strager)
-            yield (now, mortgage_payment_func)
-            now = moneycalc.time.add_month(now)
+        mortgage_period = moneycalc.time.Period(self.home_purchase_date, add_years(self.home_purchase_date, self.__mortgage_years))
+        schedule.add(moneycalc.time.Within(moneycalc.time.monthly(day=self.home_purchase_date.day), mortgage_period), mortgage_payment_func, category='mortgage payment')
+
+    def account_specs(self):
+        mortgage_end_date = add_years(self.home_purchase_date, self.__mortgage_years)
+        return [
+            {'type': 'checking', 'name': str(self.__checking)},
+            {
+                'type': 'amortized_loan',
+                'name': 'Mortgage',
+                'amount': str(self.home_loan_amount),
+                'interest_rate': {'type': 'fixed_monthly', 'yearly_rate': str(self.__mortgage_rate)},
+                'term': [self.home_purchase_date.isoformat(), mortgage_end_date.isoformat()],
+            },
+        ]
+
+    def purchase_home_action(self, amount):
+        return {'type': 'open_loan', 'account': 'Mortgage'}
+
+    def activity_event_specs(self):
+        mortgage_period = moneycalc.time.Period(self.home_purchase_date, add_years(self.home_purchase_date, self.__mortgage_years))
+        return [
+            {
+                'category': 'gift',
+                'when': moneycalc.plan.describe_rule(moneycalc.time.Once(self.start_date)),
+                'action': {'type': 'deposit', 'account': str(self.__checking), 'amount': TOOTH_FAIRY_GIFT, 'description': 'Tooth fairy'},
+            },
+            {
+                'category': 'mortgage payment',
+                'when': moneycalc.plan.describe_rule(moneycalc.time.Within(moneycalc.time.monthly(day=self.home_purchase_date.day), mortgage_period)),
+                'action': {'type': 'loan_payment', 'from_account': str(self.__checking), 'to_account': 'Mortgage', 'extra': str(self.__extra_monthly_payment), 'description': 'Mortgage payment'},
+            },
+        ]
+
+class SpecScenario(object):
+    '''
+    A scenario played from a moneycalc.plan spec (such as Scenario.spec()),
+    compiled into a moneycalc.plan.Plan.
+
+    Specs are plain data, so SpecScenario-s are cheap to send to other
+    processes.
+    '''
+    def __init__(self, spec):
+        self.spec = spec
+
+    def __str__(self):
+        return self.spec['name']
+
+    def describe(self):
+        return ('SpecScenario', json.dumps(self.spec, sort_keys=True))
+
+    def play(self, keep_timeline=False, profile=None, sink=None, rollup=None):
+        '''
+        Like Scenario.play.
+        '''
+        plan = moneycalc.plan.compile_spec(self.spec)
+        execution = plan.execute(sink=sink, rollup=rollup, profile=profile)
+        timeline = execution.timeline
+        year_summaries = []
+        for (year, account_summaries) in execution.year_summaries:
+            year_summaries.append(YearSummary(year=year, account_summaries=[
+                AccountYearSummary(account_name=account_name, balance=balance, deposited=deposited, withdrawn=withdrawn, description_totals=description_totals)
+                for (account_name, balance, deposited, withdrawn, description_totals) in account_summaries
+            ]))
+        return ScenarioResult(
+            scenario_name=str(self),
+            year_summaries=year_summaries,
+            end_balances=[(str(account), account.balance) for account in execution.accounts],
+            total_interest=timeline.total_interest,
+            total_tax=sum((timeline.tax_ledger.tax(year) for year in range(plan.start_date.year, plan.end_date.year)), money(0)),
+            timeline=timeline if keep_timeline else None,
+            error=execution.error,
+            profile=profile,
+            balance_histories=[(str(account), account.balance_history) for account in execution.accounts],
+        )
+
+class SpecScenarioFactory(object):
+    '''
+    A scenario factory whose scenarios are SpecScenario-s of the spec of
+    scenario_factory's scenario.
+    '''
+    def __init__(self, scenario_factory):
+        self.__name__ = scenario_factory.__name__
+        self.spec = scenario_factory().spec()
+
+    def __call__(self):
+        return SpecScenario(self.spec)
+
+def year_end_net_worth(year):
+    '''
+    Returns a moneycalc.solve objective: the total balance of a scenario's
+    accounts at the end of the given year, with the mortgage's balance
+    counted as owed.
+    '''
+    def objective(result):
+        for year_summary in result.year_summaries:
+            if year_summary.year == year:
+                return sum((
+                    -account_summary.balance if account_summary.account_name == 'Mortgage' else account_summary.balance
+                    for account_summary in year_summary.account_summaries
+                ), money(0))
+        raise KeyError(year)
+    return objective
+
+def solve_break_even_prime_rate_increase(year, start_date=datetime.date(2017, 1, 1), method=moneycalc.solve.SolveMethod.FALSE_POSITION):
+    '''
+    Returns a moneycalc.solve.SolveResult with the HELOC's yearly prime rate
+    increase at which HELOCScenario and FixedRateMortgageScenario have the
+    same net worth at the end of the given year.
+    '''
+    # Nothing after the given year matters, so don't simulate it.
+    parameters = {'start_date': start_date, 'years': year + 1 - start_date.year}
+    net_worth = year_end_net_worth(year)
+    fixed_net_worth = net_worth(FixedRateMortgageScenario(**parameters).play())
+    objective = moneycalc.solve.ScenarioObjective(
+        HELOCScenario,
+        parameter='prime_rate_yearly_increase',
+        objective=lambda result: net_worth(result) - fixed_net_worth,
+        parameters=parameters,
+    )
+    return moneycalc.solve.find_root(objective, low=Decimal('0'), high=Decimal('0.01'), tolerance=Decimal('0.00001'), method=method)
+
+class TestScenarioDates(unittest.TestCase):
+    def test_scenarios_can_start_on_leap_days(self):
+        start_date = datetime.date(2016, 2, 29)
+        self.assertEqual(FixedRateMortgageScenario(start_date=start_date, years=5).end_date, datetime.date(2021, 2, 28))
+        scenario = HELOCScenario(start_date=start_date, years=5)
+        self.assertEqual(scenario.end_date, datetime.date(2021, 2, 28))
+        self.assertIsNone(scenario.play().error)
+
+    def test_fourth_quarter_bonus_is_paid_in_july_unless_flagged(self):
+        def bonus_dates(scenario):
+            timeline = scenario.play(keep_timeline=True).timeline
+            return sorted(set(event.date for event in timeline if event.description == 'Salary (taxable)' and event.date.day == 1 and event.date.year == 2017))
+        self.assertEqual(bonus_dates(FixedRateMortgageScenario(years=1)), [datetime.date(2017, 1, 1), datetime.date(2017, 4, 1), datetime.date(2017, 7, 1)])
+        self.assertEqual(bonus_dates(FixedRateMortgageScenario(years=1, october_quarter_bonus=True)), [datetime.date(2017, 1, 1), datetime.date(2017, 4, 1), datetime.date(2017, 7, 1), datetime.date(2017, 10, 1)])
+
+class TestMoneyRepresentations(unittest.TestCase):
+    def play(self, scenario_factory, representation):
+        with moneycalc.money.using_money_representation(representation):
+            result = scenario_factory().play(keep_timeline=True)
+        events = [
+            (event.date, str(event.account), event.amount, event.description, event.tax_effect)
+            for event in result.timeline
+        ]
+        year_summaries = [
+            (year_summary.year, summary.account_name, summary.balance, summary.deposited, summary.withdrawn, summary.description_totals)
+            for year_summary in result.year_summaries
+            for summary in year_summary.account_summaries
+        ]
+        return (events, year_summaries, result.total_interest, result.total_tax)
+
+    def test_cents_and_decimal_timelines_are_identical(self):
+        for scenario_factory in [HELOCScenario, FixedRateMortgageScenario]:
+            decimal_outcome = self.play(scenario_factory, moneycalc.money.MoneyRepresentation.DECIMAL)
+            cents_outcome = self.play(scenario_factory, moneycalc.money.MoneyRepresentation.CENTS)
+            self.assertTrue(decimal_outcome[0])
+            self.assertEqual(cents_outcome, decimal_outcome)
+
+class TestFork(unittest.TestCase):
+    def outcome(self, result):
+        events = [
+            (event.date, str(event.account), event.amount, event.description, event.tax_effect)
+            for event in result.timeline
+        ]
+        return (events, result.end_balances, result.total_interest, result.total_tax, len(result.year_summaries))
+
+    def test_forked_scenarios_finish_like_unforked_scenarios(self):
+        for scenario_factory in [HELOCScenario, FixedRateMortgageScenario]:
+            expected = self.outcome(scenario_factory(years=15).play(keep_timeline=True))
+
+            scenario = scenario_factory(years=15)
+            scenario.start()
+            scenario.play_until(datetime.date(2024, 6, 1))
+            forked = scenario.fork()
+            scenario.play_until(None)
+            forked.play_until(datetime.date(2027, 1, 1))
+            forked.play_until(None)
+            self.assertEqual(self.outcome(scenario.finish(keep_timeline=True)), expected)
+            self.assertEqual(self.outcome(forked.finish(keep_timeline=True)), expected)
+
+    def test_forked_scenarios_are_independent(self):
+        scenario = FixedRateMortgageScenario(years=5)
+        scenario.start()
+        scenario.play_until(datetime.date(2019, 1, 1))
+        forked = scenario.fork()
+        forked.primary_account.deposit(timeline=forked.timeline, date=datetime.date(2019, 1, 1), amount=money('100.00'), description='Gift')
+        forked.play_until(None)
+        scenario.play_until(None)
+        forked_result = forked.finish()
+        result = scenario.finish()
+        self.assertEqual(dict(forked_result.end_balances)['Checking'] - dict(result.end_balances)['Checking'], money('100.00'))
+        self.assertEqual(forked_result.end_balances[1], result.end_balances[1])
+
+class TestResultCache(unittest.TestCase):
+    def test_cached_results_match_played_results(self):
+        directory = tempfile.mkdtemp()
+        try:
+            cache = moneycalc.cache.ResultCache(directory)
+            for scenario_factory in [HELOCScenario, FixedRateMortgageScenario]:
+                expected = scenario_factory(years=5).play()
+                cache.play(scenario_factory(years=5))
+                result = cache.play(scenario_factory(years=5))
+                self.assertEqual(result.end_balances, expected.end_balances)
+                self.assertEqual(result.total_tax, expected.total_tax)
+                out = io.StringIO() if sys.version_info[0] >= 3 else io.BytesIO()
+                expected_out = io.StringIO() if sys.version_info[0] >= 3 else io.BytesIO()
+                write_scenario_result(result, out=out)
+                write_scenario_result(expected, out=expected_out)
+                self.assertEqual(out.getvalue(), expected_out.getvalue())
+            self.assertEqual((cache.statistics.hits, cache.statistics.misses), (2, 2))
+            self.assertNotEqual(
+                cache.key(HELOCScenario(years=5)),
+                cache.key(HELOCScenario(years=5, prime_rate_yearly_increase=Decimal('0.0025'))))
+        finally:
+            shutil.rmtree(directory)
+
+class TestProfile(unittest.TestCase):
+    def test_profiled_scenarios_play_like_unprofiled_scenarios(self):
+        expected = FixedRateMortgageScenario(years=3).play(keep_timeline=True)
+        profile = moneycalc.instrument.ScenarioProfile()
+        result = FixedRateMortgageScenario(years=3).play(keep_timeline=True, profile=profile)
+        self.assertEqual(result.end_balances, expected.end_balances)
+        self.assertIs(result.profile, profile)
+        self.assertEqual(sum(statistics.timeline_events for statistics in profile.categories.values()), len(result.timeline))
+        # The scenario's end date is inclusive.
+        self.assertEqual(profile.categories['mortgage payment'].calls, 3 * 12 + 1)
+        self.assertEqual(profile.categories['year summary'].calls, 3 + 1)
+        self.assertEqual(profile.categories['tax payment'].calls, 3)
+
+class TestStreaming(unittest.TestCase):
+    def test_streamed_timelines_match_kept_timelines(self):
+        for scenario_factory in [HELOCScenario, FixedRateMortgageScenario]:
+            expected = scenario_factory(years=5).play(keep_timeline=True)
+            out = io.BytesIO()
+            result = scenario_factory(years=5).play(sink=moneycalc.sink.BinaryTimelineSink(out, batch_size=100))
+            self.assertEqual(result.end_balances, expected.end_balances)
+            self.assertEqual(result.total_interest, expected.total_interest)
+            self.assertEqual(result.total_tax, expected.total_tax)
+            self.assertEqual(
+                [(event.date, event.account, event.amount, event.description, event.tax_effect) for event in moneycalc.sink.read_binary_timeline(out.getvalue())],
+                [(event.date, str(event.account) if event.account is not None else None, event.amount, event.description, event.tax_effect) for event in expected.timeline])
+
+class TestRollup(unittest.TestCase):
+    def test_rolled_up_scenarios_play_like_unrolled_scenarios(self):
+        for scenario_factory in [HELOCScenario, FixedRateMortgageScenario]:
+            expected = scenario_factory(years=5).play(keep_timeline=True)
+            result = scenario_factory(years=5).play(keep_timeline=True, rollup=moneycalc.timeline.Rollup.YEAR)
+            out = io.StringIO() if sys.version_info[0] >= 3 else io.BytesIO()
+            expected_out = io.StringIO() if sys.version_info[0] >= 3 else io.BytesIO()
+            write_scenario_result(result, out=out)
+            write_scenario_result(expected, out=expected_out)
+            self.assertEqual(out.getvalue(), expected_out.getvalue())
+            self.assertEqual(result.total_tax, expected.total_tax)
+            self.assertLess(result.timeline.row_count * 10, expected.timeline.row_count)
+
+class TestBalanceHistories(unittest.TestCase):
+    def test_balance_histories_match_year_summaries(self):
+        for scenario_factory in [HELOCScenario, FixedRateMortgageScenario]:
+            result = scenario_factory(years=5).play()
+            balance_histories = dict(result.balance_histories)
+            for year_summary in result.year_summaries:
+                for account_summary in year_summary.account_summaries:
+                    self.assertEqual(
+                        balance_histories[account_summary.account_name].balance_at(datetime.date(year_summary.year, 12, 31)),
+                        account_summary.balance)
+            for (account_name, balance) in result.end_balances:
+                self.assertEqual(balance_histories[account_name].balance_at(datetime.date(2100, 1, 1)), balance)
+
+class TestSolve(unittest.TestCase):
+    def test_forked_objective_changes_only_the_future(self):
+        fork_date = datetime.date(2020, 1, 1)
+        objective = moneycalc.solve.ScenarioObjective(
+            FixedRateMortgageScenario,
+            parameter='extra_monthly_payment',
+            objective=moneycalc.solve.year_end_balance('Mortgage', 2022),
+            parameters={'years': 6},
+            fork_date=fork_date,
+        )
+        expected = FixedRateMortgageScenario(years=6).play()
+        self.assertEqual(objective(money('0.00')), moneycalc.solve.year_end_balance('Mortgage', 2022)(expected))
+        result = objective.play(money('500.00'))
+        for year in range(2017, 2020):
+            mortgage_balance = moneycalc.solve.year_end_balance('Mortgage', year)
+            self.assertEqual(mortgage_balance(result), mortgage_balance(expected))
+        self.assertLess(objective(money('500.00')), objective(money('0.00')))
+
+    def test_break_even_prime_rate_increase(self):
+        result = solve_break_even_prime_rate_increase(year=2025)
+        self.assertTrue(result.converged)
+        self.assertLess(abs(result.objective_value), money('100.00'))
+        net_worth = year_end_net_worth(2025)
+        fixed_net_worth = net_worth(FixedRateMortgageScenario().play())
+        self.assertGreater(net_worth(HELOCScenario(prime_rate_yearly_increase=result.low).play()), fixed_net_worth)
+        self.assertLess(net_worth(HELOCScenario(prime_rate_yearly_increase=result.high).play()), fixed_net_worth)
+
+class TestIncrementalRun(unittest.TestCase):
+    def outcome(self, result):
+        year_summaries = [
+            (year_summary.year, summary.account_name, summary.balance, summary.deposited, summary.withdrawn, summary.description_totals)
+            for year_summary in result.year_summaries
+            for summary in year_summary.account_summaries
+        ]
+        balance_histories = [(account_name, list(history.items())) for (account_name, history) in result.balance_histories]
+        return (year_summaries, result.end_balances, result.total_interest, result.total_tax, balance_histories)
+
+    def test_changes_match_played_scenarios(self):
+        edits = [
+            ('expenses', money('2000.00'), datetime.date(2019, 3, 1), datetime.date(2019, 4, 1)),
+            ('prime rate', Decimal('0.07'), datetime.date(2020, 7, 1), datetime.date(2021, 1, 1)),
+            ('salary', money('8000.00'), datetime.date(2021, 1, 1), None),
+        ]
+        for scenario_factory in [HELOCScenario, FixedRateMortgageScenario]:
+            run = moneycalc.incremental.IncrementalRun(scenario_factory(years=8))
+            self.assertEqual(self.outcome(run.result), self.outcome(scenario_factory(years=8).play()))
+            inputs = moneycalc.incremental.Inputs()
+            for (name, value, start_date, end_date) in edits:
+                result = run.change(name, value, start_date=start_date, end_date=end_date)
+                inputs.set(name, value, start_date=start_date, end_date=end_date)
+                self.assertEqual(self.outcome(result), self.outcome(scenario_factory(years=8, inputs=inputs).play()))
+
+    def test_unread_inputs_replay_nothing(self):
+        run = moneycalc.incremental.IncrementalRun(FixedRateMortgageScenario(years=8))
+        result = run.change('prime rate', Decimal('0.07'), start_date=datetime.date(2020, 1, 1))
+        self.assertIsNone(run.last_replay)
+        self.assertIs(result, run.result)
+        run.change('auto', money('0.00'), start_date=datetime.date(2022, 1, 1))
+        self.assertIsNone(run.last_replay)
+
+    def test_replays_stop_when_state_converges(self):
+        run = moneycalc.incremental.IncrementalRun(HELOCScenario(years=8))
+        expected = self.outcome(run.result)
+        run.change('expenses', money('1873.61'), start_date=datetime.date(2020, 3, 1), end_date=datetime.date(2020, 4, 1))
+        self.assertEqual((run.last_replay.start_date, run.last_replay.end_date), (datetime.date(2020, 1, 1), datetime.date(2021, 1, 1)))
+        self.assertEqual(self.outcome(run.result), expected)
+
+    def test_changes_replay_from_the_nearest_checkpoint(self):
+        run = moneycalc.incremental.IncrementalRun(HELOCScenario(years=8))
+        inputs = moneycalc.incremental.Inputs()
+        # Spending more once changes every later balance, so these replays
+        # never converge, except for the last one, which spends the usual
+        # amount. Each replay starts at the checkpoint (January 1) nearest
+        # to its edit, including checkpoints made by earlier replays.
+        edits = [
+            (money('1900.00'), datetime.date(2020, 3, 1), datetime.date(2020, 4, 1), datetime.date(2020, 1, 1), datetime.date(2025, 1, 1)),
+            (money('1900.00'), datetime.date(2023, 3, 1), datetime.date(2023, 4, 1), datetime.date(2023, 1, 1), datetime.date(2025, 1, 1)),
+            (money('1900.00'), datetime.date(2021, 6, 1), datetime.date(2021, 7, 1), datetime.date(2021, 1, 1), datetime.date(2025, 1, 1)),
+            (money('1873.61'), datetime.date(2018, 6, 1), datetime.date(2018, 7, 1), datetime.date(2018, 1, 1), datetime.date(2019, 1, 1)),
+            (money('1900.00'), datetime.date(2024, 6, 1), datetime.date(2024, 7, 1), datetime.date(2024, 1, 1), datetime.date(2025, 1, 1)),
+        ]
+        for (amount, start_date, end_date, replay_start_date, replay_end_date) in edits:
+            result = run.change('expenses', amount, start_date=start_date, end_date=end_date)
+            inputs.set('expenses', amount, start_date=start_date, end_date=end_date)
+            self.assertEqual(self.outcome(result), self.outcome(HELOCScenario(years=8, inputs=inputs).play()))
+            self.assertEqual((run.last_replay.start_date, run.last_replay.end_date), (replay_start_date, replay_end_date))
+
+class TestSpecScenario(unittest.TestCase):
+    def outcome(self, result):
+        events = [
+            (event.date, str(event.account), event.amount, event.description, event.tax_effect)
+            for event in result.timeline
+        ]
+        year_summaries = [
+            (year_summary.year, summary.account_name, summary.balance, summary.deposited, summary.withdrawn, summary.description_totals)
+            for year_summary in result.year_summaries
+            for summary in year_summary.account_summaries
+        ]
+        balance_histories = [(account_name, list(history.items())) for (account_name, history) in result.balance_histories]
+        return (events, year_summaries, result.end_balances, result.total_interest, result.total_tax, str(result.error), balance_histories)
+
+    def test_specs_play_like_scenarios(self):
+        scenario_factories = [
+            HELOCScenario,
+            FixedRateMortgageScenario,
+            lambda: FixedRateMortgageScenario(years=10, extra_monthly_payment='700.00'),
+            lambda: HELOCScenario(years=5, october_quarter_bonus=True),
+        ]
+        for scenario_factory in scenario_factories:
+            spec = json.loads(json.dumps(scenario_factory().spec()))
+            result = SpecScenario(spec).play(keep_timeline=True)
+            expected = scenario_factory().play(keep_timeline=True)
+            self.assertTrue(expected.timeline)
+            self.assertEqual(result.scenario_name, expected.scenario_name)
+            self.assertEqual(self.outcome(result), self.outcome(expected))
+
+    def test_profiled_specs_count_categories(self):
+        profile = moneycalc.instrument.ScenarioProfile()
+        SpecScenario(FixedRateMortgageScenario(years=3).spec()).play(profile=profile)
+        self.assertEqual(profile.categories['mortgage payment'].calls, 3 * 12 + 1)
+        self.assertEqual(profile.categories['tax payment'].calls, 3)
+
+    def test_unwritable_scenarios_are_errors(self):
+        inputs = moneycalc.incremental.Inputs()
+        inputs.set('expenses', money('2000.00'))
+        with self.assertRaises(moneycalc.plan.SpecError):
+            FixedRateMortgageScenario(inputs=inputs).spec()
+        prime_rate = moneycalc.account.YearlySteppingPrimeRate(start_yearly_rate=Decimal('0.04'), start_year=2017, yearly_increase=Decimal(0))
+        with self.assertRaises(moneycalc.plan.SpecError):
+            HELOCScenario(prime_rate=prime_rate).spec()
+
+class TestMonteCarlo(unittest.TestCase):
+    def test_simulated_paths_play_like_scenarios(self):
+        model = moneycalc.montecarlo.MeanRevertingPrimeRateModel(
+            start_yearly_rate=Decimal('0.0425'),
+            long_term_yearly_rate=Decimal('0.05'),
+            reversion=Decimal('0.2'),
+            volatility=Decimal('0.005'),
+            start_year=2017,
+        )
+        result = moneycalc.montecarlo.simulate(HELOCScenario(years=10, draw_years=10).spec(), model, count=3, seed=1, processes=1)
+        self.assertEqual(result.failures, 0)
+        paths = model.paths(count=3, years=11, seed=1)
+        for (row, path) in zip(result.table.rows(), paths):
+            prime_rate = moneycalc.montecarlo.PathPrimeRate(start_year=2017, yearly_rates=path)
+            expected = HELOCScenario(years=10, draw_years=10, prime_rate=prime_rate).play()
+            self.assertIsNone(expected.error)
+            self.assertEqual(row['total_interest'], expected.total_interest)
+            self.assertEqual(row['total_tax'], expected.total_tax)
+            self.assertEqual([(account_name, row['end_balance:{}'.format(account_name)]) for (account_name, _balance) in expected.end_balances], expected.end_balances)
+
+    def test_simulated_mortgages_play_like_scenarios(self):
+        model = moneycalc.montecarlo.MeanRevertingPrimeRateModel(
+            start_yearly_rate=Decimal('0.0425'),
+            long_term_yearly_rate=Decimal('0.05'),
+            reversion=Decimal('0.2'),
+            volatility=Decimal('0.005'),
+            start_year=2017,
+        )
+        scenario = FixedRateMortgageScenario(years=5, extra_monthly_payment='200.00')
+        result = moneycalc.montecarlo.simulate(scenario.spec(), model, count=2, seed=1, processes=1)
+        self.assertEqual(result.failures, 0)
+        expected = scenario.play()
+        self.assertIsNone(expected.error)
+        for row in result.table.rows():
+            self.assertEqual(row['total_interest'], expected.total_interest)
+            self.assertEqual(row['total_tax'], expected.total_tax)
+            self.assertEqual([(account_name, row['end_balance:{}'.format(account_name)]) for (account_name, _balance) in expected.end_balances], expected.end_balances)
 
 def main():
-    for scenario in [HELOCScenario(), FixedRateMortgageScenario()]:
-        sys.stdout.write(' === {} ===\n'.format(scenario))
-        scenario.play()
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--jobs', type=int, default=None, help='number of scenarios to play in parallel (default: number of CPUs)')
+    parser.add_argument('--timeout', type=float, default=None, help='seconds after which to give up on a scenario')
+    parser.add_argument('--money', choices=['decimal', 'cents'], default='decimal', help='representation of money amounts')
+    parser.add_argument('--cache-dir', default=None, help='directory in which to cache scenario results between runs')
+    parser.add_argument('--profile', action='store_true', help='report the cost of each category of scheduled handler on stderr')
+    parser.add_argument('--timeline-dir', default=None, help='write each scenario\'s timeline to a file in this directory')
+    parser.add_argument('--timeline-format', choices=sorted(moneycalc.sink.SINK_FORMATS), default='csv', help='format of --timeline-dir files (default: %(default)s)')
+    parser.add_argument('--profile-stats', default=None, metavar='PREFIX', help='with --profile, also write cProfile statistics of each scenario to PREFIX.<scenario>.pstats')
+    parser.add_argument('--compiled', action='store_true', help='play each scenario from its compiled spec (see moneycalc.plan)')
+    parser.add_argument('--break-even-year', type=int, default=None, metavar='YEAR', help='instead of playing scenarios, find the yearly prime rate increase at which the HELOC and the fixed rate mortgage have the same net worth at the end of YEAR')
+    args = parser.parse_args()
+    if args.cache_dir is not None and (args.profile or args.timeline_dir is not None):
+        parser.error('--cache-dir cannot be used with --profile or --timeline-dir')
+    moneycalc.money.set_money_representation(args.money.upper())
+
+    if args.break_even_year is not None:
+        solve_result = solve_break_even_prime_rate_increase(year=args.break_even_year)
+        sys.stdout.write('Break-even yearly prime rate increase: {:.5%} ({} evaluations; {} net worth difference)\n'.format(
+            solve_result.value,
+            solve_result.evaluations,
+            solve_result.objective_value,
+        ))
+        return
+
+    scenario_factories = [HELOCScenario, FixedRateMortgageScenario]
+    if args.compiled:
+        scenario_factories = [SpecScenarioFactory(scenario_factory) for scenario_factory in scenario_factories]
+    if args.cache_dir is not None:
+        cache = moneycalc.cache.ResultCache(args.cache_dir)
+        scenario_factories = [moneycalc.cache.CachedScenarioFactory(scenario_factory, cache) for scenario_factory in scenario_factories]
+    if args.timeline_dir is not None:
+        scenario_factories = [moneycalc.sink.StreamingScenarioFactory(scenario_factory, directory=args.timeline_dir, format=args.timeline_format) for scenario_factory in scenario_factories]
+    if args.profile:
+        scenario_factories = [moneycalc.instrument.ProfiledScenarioFactory(scenario_factory, use_cprofile=args.profile_stats is not None) for scenario_factory in scenario_factories]
+    results = moneycalc.runner.run_scenarios(scenario_factories, processes=args.jobs, timeout=args.timeout)
+    for (scenario_factory, task_result) in zip(scenario_factories, results):
+        if task_result.ok:
+            scenario_result = task_result.value
+            write_scenario_result(scenario_result, out=sys.stdout)
+            if scenario_result.error is not None:
+                sys.stderr.write('{}\n'.format(scenario_result.error))
+            if scenario_result.profile is not None:
+                sys.stderr.write(' === {} profile ===\n'.format(scenario_result.scenario_name))
+                scenario_result.profile.write_report(out=sys.stderr)
+                if args.profile_stats is not None:
+                    scenario_result.profile.dump_stats('{}.{}.pstats'.format(args.profile_stats, scenario_result.scenario_name))
+        else:
+            sys.stdout.write(' === {} ===\n'.format(scenario_factory.__name__))
+            sys.stderr.write('{}\n'.format(task_result.error))
         sys.stdout.write('\n\n')
 
 if __name__ == '__main__':